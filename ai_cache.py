@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+ذاكرة دائمة لإجابات الذكاء الاصطناعي
+المفتاح: بصمة السؤال بعد التوحيد + أرقام سجلات الكتب المرسلة كسياق
+الأسئلة المتطابقة المتزامنة تُدمج في طلب واحد إلى Claude
+"""
+
+import os
+import time
+import asyncio
+import sqlite3
+import hashlib
+import logging
+import threading
+
+from arabic_text import tokenize
+from library_db import run_db
+from metrics import register_collector
+
+logger = logging.getLogger(__name__)
+
+AI_CACHE_PATH = os.getenv("AI_CACHE_PATH", "ai_cache.db")
+AI_CACHE_MAX_ENTRIES = int(os.getenv("AI_CACHE_MAX_ENTRIES", "20000"))
+AI_CACHE_MAX_AGE = float(os.getenv("AI_CACHE_MAX_AGE", str(7 * 24 * 3600)))
+
+# تنظيف الإجابات القديمة مرة كل عدد من الإضافات
+_PRUNE_EVERY = 100
+
+
+class AnswerCache:
+    """ذاكرة إجابات محفوظة في ملف SQLite مستقل عن قاعدة بيانات المكتبة"""
+
+    def __init__(self, path=AI_CACHE_PATH, max_entries=AI_CACHE_MAX_ENTRIES, max_age=AI_CACHE_MAX_AGE):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self._conn = None
+        self._lock = threading.Lock()
+        self._puts = 0
+        self._inflight = {}
+
+    def _connection(self):
+        """الاتصال بملف الذاكرة (يُنشأ عند أول استخدام)"""
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = NORMAL")
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS answers (
+                    key TEXT PRIMARY KEY,
+                    answer TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_answers_created ON answers(created_at);
+            """)
+            self._conn = conn
+        return self._conn
+
+    @staticmethod
+    def make_key(question, record_ids):
+        """بصمة السؤال الموحد مع أرقام السجلات المرسلة كسياق"""
+        normalized = ' '.join(tokenize(question))
+        ids = ','.join(sorted(str(record_id) for record_id in record_ids))
+        return hashlib.sha256(f'{normalized}|{ids}'.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """الإجابة المحفوظة إن وُجدت ولم تتجاوز عمرها الأقصى"""
+        with self._lock:
+            row = self._connection().execute(
+                "SELECT answer FROM answers WHERE key = ? AND created_at > ?",
+                (key, time.time() - self.max_age)
+            ).fetchone()
+
+        if row:
+            self.hits += 1
+            return row[0]
+
+        self.misses += 1
+        return None
+
+    def put(self, key, answer):
+        """حفظ إجابة، مع تنظيف دوري للإجابات القديمة والزائدة"""
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO answers (key, answer, created_at) VALUES (?, ?, ?)",
+                    (key, answer, time.time())
+                )
+
+            self._puts += 1
+            if self._puts % _PRUNE_EVERY == 0:
+                self._prune(conn)
+
+    def _prune(self, conn):
+        """حذف الإجابات المنتهية، ثم الأقدم إذا تجاوز العدد الحد الأقصى"""
+        with conn:
+            conn.execute("DELETE FROM answers WHERE created_at <= ?", (time.time() - self.max_age,))
+            conn.execute("""
+                DELETE FROM answers WHERE key IN (
+                    SELECT key FROM answers ORDER BY created_at DESC LIMIT -1 OFFSET ?
+                )
+            """, (self.max_entries,))
+
+    async def get_or_compute(self, key, compute):
+        """إجابة محفوظة، أو انتظار طلب جارٍ لنفس المفتاح، أو طلب جديد يُحفظ ناتجه"""
+        future = self._inflight.get(key)
+        if future is not None:
+            # نفس السؤال قيد المعالجة: ننتظر نتيجته بدلاً من طلب جديد
+            return await asyncio.shield(future)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+
+        try:
+            answer = await run_db(self.get, key)
+
+            if answer is None:
+                answer = await compute()
+                if answer is not None:
+                    await run_db(self.put, key, answer)
+
+            future.set_result(answer)
+            return answer
+
+        except BaseException:
+            if not future.done():
+                future.set_result(None)
+            raise
+
+        finally:
+            del self._inflight[key]
+
+    def close(self):
+        """إغلاق ملف الذاكرة"""
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+answer_cache = AnswerCache()
+
+
+@register_collector
+def answer_cache_metrics():
+    """عدادات ذاكرة الإجابات لخادم المقاييس"""
+    return [
+        ('bot_answer_cache_hits_total', 'counter', "إصابات ذاكرة إجابات الذكاء الاصطناعي", [({}, answer_cache.hits)]),
+        ('bot_answer_cache_misses_total', 'counter', "إخفاقات ذاكرة إجابات الذكاء الاصطناعي", [({}, answer_cache.misses)]),
+    ]
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+بناء طلب Claude بحجم محدود
+- التعليمات الثابتة في كتلة system لا تتغير بين الطلبات
+- الكتب في سطر مختصر لكل كتاب: حقول مقصوصة، بدون تكرار، حتى حد تقديري من الرموز
+"""
+
+import os
+import math
+
+# حد الرموز التقديري لقائمة الكتب في الطلب
+AI_CONTEXT_TOKENS = int(os.getenv("AI_CONTEXT_TOKENS", "1200"))
+
+# تقدير تقريبي: عدد الأحرف لكل رمز في النص العربي
+_CHARS_PER_TOKEN = 2.5
+
+# أقصى طول لكل حقل في سطر الكتاب، وأقصى عدد موضوعات
+FIELD_LIMITS = {'title': 80, 'author': 40, 'subject': 60}
+MAX_SUBJECTS = 2
+
+SYSTEM_PROMPT = """أنت مساعد مكتبة ذكي لمكتبة إسلامية. ستصلك أسئلة المستخدمين مع قائمة كتب من فهرس المكتبة.
+
+كل سطر في القائمة كتاب واحد بالصيغة: رقم السجل | العنوان | المؤلف | الموضوع | السنة
+(الحقول غير المعروفة تُترك فارغة، والأرقام المتعددة تعني نسخاً من نفس الكتاب)
+
+المطلوب:
+1. أجب على السؤال بناءً على الكتب المتوفرة فقط
+2. اذكر أسماء الكتب ذات الصلة
+3. كن مختصراً ومفيداً
+4. إذا لم تجد كتب مناسبة، اقترح كلمات بحث بديلة"""
+
+
+def estimate_tokens(text):
+    """تقدير عدد الرموز بدون محلل الرموز"""
+    return math.ceil(len(text) / _CHARS_PER_TOKEN)
+
+
+def _clip(value, limit):
+    """قص القيمة على حدود الكلمات"""
+    value = ' '.join(str(value).split()).rstrip(' /:;,،')
+    if len(value) <= limit:
+        return value
+    return value[:limit].rsplit(' ', 1)[0] + '…'
+
+
+def _subjects(subject):
+    """أول الموضوعات المختلفة (الموضوعات مفصولة بـ |)"""
+    parts = dict.fromkeys(part.strip() for part in subject.split('|') if part.strip())
+    return '، '.join(list(parts)[:MAX_SUBJECTS])
+
+
+def book_line(book, record_ids=None):
+    """سطر الكتاب المختصر"""
+    ids = dict.fromkeys(str(record_id) for record_id in record_ids or [book['record_id']])
+    fields = [
+        '، '.join(ids),
+        _clip(book['title'] or '', FIELD_LIMITS['title']),
+        _clip(book['author'] or '', FIELD_LIMITS['author']),
+        _clip(_subjects(book['subject'] or ''), FIELD_LIMITS['subject']),
+        str(book['year'] or '').removesuffix('.0'),
+    ]
+    return ' | '.join(fields)
+
+
+def build_books_context(books, budget=AI_CONTEXT_TOKENS):
+    """
+    قائمة الكتب المختصرة ضمن حد الرموز (بترتيب الصلة)
+    نسخ نفس الكتاب (نفس العنوان والمؤلف) تُدمج في سطر واحد بأرقام سجلاتها
+    تُرجع (النص، عدد الكتب المضمنة)
+    """
+    groups = {}
+    for book in books:
+        key = (_clip(book['title'] or '', FIELD_LIMITS['title']), _clip(book['author'] or '', FIELD_LIMITS['author']))
+        groups.setdefault(key, []).append(book)
+
+    lines = []
+    used = 0
+    included = 0
+    for copies in groups.values():
+        line = book_line(copies[0], [copy['record_id'] for copy in copies])
+        cost = estimate_tokens(line) + 1
+        if used + cost > budget:
+            break
+        lines.append(line)
+        used += cost
+        included += len(copies)
+
+    return '\n'.join(lines), included
+
+
+def build_messages(question, books, budget=AI_CONTEXT_TOKENS):
+    """(كتلة system الثابتة، رسائل الطلب): الجزء المتغير كله في رسالة المستخدم بعد التعليمات"""
+    context, included = build_books_context(books, budget)
+
+    content = f"السؤال: {question}\n\nالكتب المتاحة:\n{context or '(لا توجد كتب مطابقة)'}"
+    if included < len(books):
+        content += f"\n(و{len(books) - included} كتب أخرى أقل صلة)"
+
+    return SYSTEM_PROMPT, [{'role': 'user', 'content': content}]
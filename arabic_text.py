@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+توحيد النصوص العربية وتقطيعها وتجذيعها الخفيف
+تُستخدم نفس الدوال عند فهرسة الكتب وعند استقبال نص البحث
+حتى تتطابق أشكال الحروف المختلفة (أ/إ/آ/ا، ة/ه، ى/ي) والتشكيل والتطويل
+"""
+
+import re
+
+# التشكيل والألف الخنجرية
+_TASHKEEL_RE = re.compile('[ً-ْٰ]')
+# التطويل
+_TATWEEL = 'ـ'
+# الكلمات: أحرف وأرقام فقط
+_WORD_RE = re.compile(r'[^\W_]+', re.UNICODE)
+
+_CHAR_MAP = str.maketrans({
+    'أ': 'ا', 'إ': 'ا', 'آ': 'ا', 'ٱ': 'ا',
+    'ة': 'ه',
+    'ى': 'ي',
+    'ؤ': 'و',
+    'ئ': 'ي',
+    # الأرقام العربية الهندية والفارسية
+    '٠': '0', '١': '1', '٢': '2', '٣': '3', '٤': '4',
+    '٥': '5', '٦': '6', '٧': '7', '٨': '8', '٩': '9',
+    '۰': '0', '۱': '1', '۲': '2', '۳': '3', '۴': '4',
+    '۵': '5', '۶': '6', '۷': '7', '۸': '8', '۹': '9',
+})
+
+# السوابق واللواحق (بعد التوحيد، لذلك ة مكتوبة ه)، الأطول أولاً
+_PREFIXES = ('وال', 'بال', 'كال', 'فال', 'لل', 'ال')
+_SUFFIXES = ('ها', 'ان', 'ات', 'ون', 'ين', 'يه', 'ه', 'ي')
+
+# أقل طول مسموح للكلمة بعد حذف السابقة أو اللاحقة
+_MIN_STEM = 3
+
+
+def normalize_arabic(text):
+    """توحيد أشكال الحروف وحذف التشكيل والتطويل"""
+    if not text:
+        return ''
+
+    text = _TASHKEEL_RE.sub('', str(text))
+    text = text.replace(_TATWEEL, '')
+    return text.translate(_CHAR_MAP).lower()
+
+
+def light_stem(word):
+    """تجذيع خفيف: حذف سابقة واحدة ولاحقة واحدة"""
+    for prefix in _PREFIXES:
+        if word.startswith(prefix) and len(word) - len(prefix) >= _MIN_STEM:
+            word = word[len(prefix):]
+            break
+
+    for suffix in _SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= _MIN_STEM:
+            word = word[:-len(suffix)]
+            break
+
+    return word
+
+
+def split_words(text):
+    """تقطيع النص إلى كلمات موحدة (بدون تجذيع)"""
+    return _WORD_RE.findall(normalize_arabic(text))
+
+
+def tokenize(text):
+    """تقطيع النص إلى كلمات موحدة ومجذعة"""
+    return [light_stem(word) for word in split_words(text)]
+
+
+def index_text(text):
+    """الصيغة المخزنة في فهرس البحث لنص معين"""
+    if text is None:
+        return None
+    return ' '.join(tokenize(text))
+
+
+def register_functions(conn):
+    """تسجيل دالة ar_index في اتصال SQLite (تحتاجها مشغلات الفهرس القديمة قبل ترحيل أعمدة الظل)"""
+    conn.create_function('ar_index', 1, index_text, deterministic=True)
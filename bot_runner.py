@@ -0,0 +1,383 @@
+# -*- coding: utf-8 -*-
+"""
+تشغيل البوت عبر Webhook (خادم aiohttp مدمج) أو عبر الاستطلاع (polling) كبديل
+يُفعّل وضع Webhook بتعيين WEBHOOK_URL، ويُطلب من تليجرام فقط أنواع التحديثات التي لها معالجات
+مع BOT_WORKERS > 1 يوزع خادم الاستقبال التحديثات على عمليات عاملة حسب رقم المحادثة
+وكل عملية تعالج التحديثات تعرض مقاييسها على /metrics محلياً (انظر metrics.py)
+"""
+
+import os
+import hmac
+import signal
+import sqlite3
+import asyncio
+import secrets
+import logging
+import itertools
+import collections
+import multiprocessing
+
+from telegram import Update
+from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, InlineQueryHandler
+
+from send_queue import FloodControlLimiter, SEND_GLOBAL_PER_SECOND
+from metrics import serve_metrics, set_worker_index, ERRORS
+
+try:
+    from aiohttp import web
+except ImportError:
+    web = None
+
+logger = logging.getLogger(__name__)
+
+# عنوان Bot API (لتوجيه البوت إلى خادم تليجرام محلي أو وهمي أثناء الاختبار)
+TELEGRAM_BASE_URL = os.getenv("TELEGRAM_BASE_URL")
+
+# إعدادات Webhook: العنوان العام، والمسار، وعنوان ومنفذ الاستماع المحلي
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("PORT", "8443"))
+# الرمز السري الذي يرسله تليجرام في كل طلب (يُولّد عشوائياً إن لم يُعيّن)
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+
+# عدد العمليات العاملة في وضع Webhook (1 = عملية واحدة بدون توزيع)
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "1"))
+# الفترة بالثواني بين كل فحص للعمليات العاملة المتوقفة
+WORKER_CHECK_INTERVAL = 1.0
+
+_SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+# عدد العمليات التي تتقاسم حد الإرسال العام للبوت (يُعيّن في كل عملية عاملة)
+_send_shares = 1
+
+# نوع التحديث الذي يعالجه كل نوع من المعالجات
+_HANDLER_UPDATE_TYPES = (
+    (CallbackQueryHandler, Update.CALLBACK_QUERY),
+    (InlineQueryHandler, Update.INLINE_QUERY),
+    (CommandHandler, Update.MESSAGE),
+    (MessageHandler, Update.MESSAGE),
+)
+
+
+def application_builder(token, background_tasks=()):
+    """منشئ التطبيق مع التوكن وعنوان Bot API إن وُجد، ومهام خلفية تعمل طوال تشغيل البوت"""
+    # خادم المقاييس مهمة خلفية مثل غيرها (لا يعمل في خادم الاستقبال لأنه لا يهيئ التطبيق)
+    background_tasks = (serve_metrics, *background_tasks)
+
+    # كل الرسائل الصادرة تمر عبر محدد المعدل حتى لا يرفضها تليجرام بخطأ 429؛
+    # الحد العام للبوت كله، فتأخذ كل عملية عاملة حصتها منه
+    limiter = FloodControlLimiter(global_per_second=SEND_GLOBAL_PER_SECOND / _send_shares)
+    builder = Application.builder().token(token).rate_limiter(limiter)
+    if TELEGRAM_BASE_URL:
+        builder = builder.base_url(TELEGRAM_BASE_URL)
+
+    async def start_tasks(application):
+        application.bot_data['background_tasks'] = [asyncio.create_task(func()) for func in background_tasks]
+
+    async def stop_tasks(application):
+        for task in application.bot_data.pop('background_tasks', []):
+            task.cancel()
+
+    return builder.post_init(start_tasks).post_shutdown(stop_tasks)
+
+
+async def error_handler(update, context):
+    """معالج الأخطاء المشترك للبوتين (أخطاء البحث لا تُحفظ في الذاكرة المؤقتة كنتيجة فارغة)"""
+    ERRORS.inc()
+    logger.error(f"حدث خطأ: {context.error}")
+
+    if isinstance(update, Update) and update.message:
+        if isinstance(context.error, sqlite3.OperationalError):
+            # تجاوز مهلة الاستعلام أو قاعدة بيانات مشغولة: المحاولة التالية تبحث من جديد
+            await update.message.reply_text("⌛ تعذر إكمال البحث الآن، جرّب بحثاً أضيق أو أعد المحاولة بعد قليل.")
+            return
+        await update.message.reply_text("😔 عذراً، حدث خطأ. الرجاء المحاولة مرة أخرى.")
+
+
+def registered_update_types(application):
+    """أنواع التحديثات التي سُجلت لها معالجات فقط"""
+    update_types = set()
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            for handler_type, update_type in _HANDLER_UPDATE_TYPES:
+                if isinstance(handler, handler_type):
+                    update_types.add(update_type)
+                    break
+    return sorted(update_types)
+
+
+def make_webhook_app(dispatch, secret, path=WEBHOOK_PATH):
+    """تطبيق aiohttp يستقبل التحديثات ويسلمها إلى dispatch ثم يرد فوراً"""
+
+    async def receive_update(request):
+        token = request.headers.get(_SECRET_HEADER, '')
+        if not hmac.compare_digest(token, secret):
+            return web.Response(status=403)
+
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+
+        await dispatch(data)
+        return web.Response()
+
+    async def health(request):
+        return web.Response(text='ok')
+
+    app = web.Application()
+    app.router.add_post(f'/{path.strip("/")}', receive_update)
+    app.router.add_get('/healthz', health)
+    return app
+
+
+async def _start_server(app):
+    """تشغيل خادم aiohttp على عنوان ومنفذ الاستماع"""
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_LISTEN, WEBHOOK_PORT).start()
+    return runner
+
+
+def _webhook_settings():
+    """عنوان Webhook الكامل والرمز السري"""
+    url = f'{WEBHOOK_URL.rstrip("/")}/{WEBHOOK_PATH.strip("/")}'
+    return url, WEBHOOK_SECRET or secrets.token_urlsafe(32)
+
+
+async def _wait_for_stop():
+    """انتظار إشارة الإيقاف (SIGINT أو SIGTERM)"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            # Windows: الإيقاف عبر KeyboardInterrupt
+            pass
+    await stop.wait()
+
+
+async def serve_webhook(application, allowed_updates, stop_event=None):
+    """تشغيل البوت مع خادم Webhook حتى إشارة الإيقاف (أو stop_event عند الاختبار)"""
+    url, secret = _webhook_settings()
+
+    async def dispatch(data):
+        await application.update_queue.put(Update.de_json(data, application.bot))
+
+    async with application:
+        if application.post_init:
+            await application.post_init(application)
+
+        await application.bot.set_webhook(url=url, allowed_updates=allowed_updates, secret_token=secret)
+        await application.start()
+
+        runner = await _start_server(make_webhook_app(dispatch, secret))
+        logger.info(f"Webhook يعمل على المنفذ {WEBHOOK_PORT} ({', '.join(allowed_updates)})")
+
+        try:
+            await (stop_event.wait() if stop_event is not None else _wait_for_stop())
+        finally:
+            # يبقى Webhook مسجلاً فيحتفظ تليجرام بالتحديثات حتى التشغيل التالي
+            await runner.cleanup()
+            await application.stop()
+
+    if application.post_shutdown:
+        await application.post_shutdown(application)
+
+
+# ==================== التوزيع على عمليات عاملة ====================
+
+def update_chat_id(data):
+    """رقم المحادثة من تحديث خام (أو رقم المستخدم للاستعلامات المضمنة)"""
+    for value in data.values():
+        if isinstance(value, dict):
+            chat = value.get('chat') or (value.get('message') or {}).get('chat') or value.get('from')
+            if chat:
+                return chat['id']
+    return data.get('update_id', 0)
+
+
+def shard_for(data, workers):
+    """رقم العملية العاملة للتحديث: نفس المحادثة دائماً لنفس العملية"""
+    return update_chat_id(data) % workers
+
+
+async def _process_updates(application, updates, received):
+    """معالجة التحديثات من الطابور: المحادثات المختلفة بالتوازي، ورسائل المحادثة الواحدة بالترتيب
+
+    received: رقم آخر تحديث استُلم من الطابور (يعيد خادم الاستقبال ما بعده إذا توقفت العملية)
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(application.concurrent_updates)
+    # قفل لكل محادثة مع عدد التحديثات المنتظرة عليه
+    chat_locks = {}
+
+    async def process(chat_id, update):
+        entry = chat_locks[chat_id]
+        try:
+            # أقفال asyncio تُمنح بترتيب الطلب، فتبقى رسائل المحادثة بترتيب وصولها
+            async with entry[0], semaphore:
+                await application.process_update(update)
+        except Exception as e:
+            logger.error(f"خطأ في معالجة التحديث {update.update_id}: {e}")
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del chat_locks[chat_id]
+
+    tasks = set()
+    while True:
+        item = await loop.run_in_executor(None, updates.get)
+        if item is None:
+            break
+        sequence, data = item
+        received.value = sequence
+
+        chat_id = update_chat_id(data)
+        entry = chat_locks.setdefault(chat_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+
+        task = asyncio.create_task(process(chat_id, Update.de_json(data, application.bot)))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    if tasks:
+        await asyncio.wait(tasks)
+
+
+async def _serve_worker(application, updates, received):
+    """دورة حياة العملية العاملة: تهيئة التطبيق ثم معالجة الطابور حتى إشارة التوقف"""
+    async with application:
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        try:
+            await _process_updates(application, updates, received)
+        finally:
+            await application.stop()
+
+    if application.post_shutdown:
+        await application.post_shutdown(application)
+
+
+def _worker_main(build_application, updates, received, index, workers):
+    """نقطة دخول العملية العاملة (اتصالات قاعدة بيانات خاصة بها)"""
+    global _send_shares
+
+    # الإيقاف يأتي من خادم الاستقبال عبر الطابور، وليس من Ctrl+C
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    set_worker_index(index)
+    _send_shares = workers
+    logger.info(f"العملية العاملة {index} تعمل (PID {os.getpid()})")
+    asyncio.run(_serve_worker(build_application(), updates, received))
+
+
+async def serve_sharded(build_application, workers, stop_event=None):
+    """خادم استقبال يوزع التحديثات على عمليات عاملة ويعيد تشغيل المتوقف منها"""
+    application = build_application()
+    allowed_updates = registered_update_types(application)
+    url, secret = _webhook_settings()
+
+    # spawn: كل عملية تبدأ نظيفة وتفتح اتصالاتها بنفسها (لا تُورث اتصالات SQLite)
+    context = multiprocessing.get_context('spawn')
+    queues = [context.Queue() for _ in range(workers)]
+    processes = [None] * workers
+    # لكل عملية: رقم آخر تحديث استلمته، والتحديثات المرسلة إليها التي لم تستلمها بعد
+    received = [context.RawValue('q', 0) for _ in range(workers)]
+    backlog = [collections.deque() for _ in range(workers)]
+    sequences = itertools.count(1)
+
+    def pending(index):
+        """التحديثات التي لم تستلمها العملية من طابورها بعد"""
+        updates = backlog[index]
+        while updates and updates[0][0] <= received[index].value:
+            updates.popleft()
+        return updates
+
+    def start_worker(index):
+        if processes[index] is not None:
+            # عملية توقفت فجأة قد تترك قفل القراءة في طابورها محجوزاً، فتبدأ البديلة بطابور جديد
+            # فيه ما بقي في القديم (التحديث الذي كانت تعالجه لحظة توقفها لا يُعاد)
+            queues[index] = context.Queue()
+            updates = pending(index)
+            for item in updates:
+                queues[index].put(item)
+            if updates:
+                logger.info(f"نُقل {len(updates)} تحديث منتظر إلى طابور العملية العاملة {index}")
+        process = context.Process(
+            target=_worker_main,
+            args=(build_application, queues[index], received[index], index, workers),
+            name=f'bot-worker-{index}',
+            daemon=True,
+        )
+        process.start()
+        processes[index] = process
+
+    async def dispatch(data):
+        index = shard_for(data, workers)
+        item = (next(sequences), data)
+        pending(index).append(item)
+        queues[index].put(item)
+
+    async def supervise():
+        while True:
+            await asyncio.sleep(WORKER_CHECK_INTERVAL)
+            for index, process in enumerate(processes):
+                if not process.is_alive():
+                    logger.error(f"توقفت العملية العاملة {index} (رمز الخروج {process.exitcode})، جاري إعادة تشغيلها")
+                    start_worker(index)
+
+    for index in range(workers):
+        start_worker(index)
+
+    async with application.bot:
+        await application.bot.set_webhook(url=url, allowed_updates=allowed_updates, secret_token=secret)
+
+    runner = await _start_server(make_webhook_app(dispatch, secret))
+    supervisor = asyncio.create_task(supervise())
+    logger.info(f"Webhook يعمل على المنفذ {WEBHOOK_PORT} مع {workers} عمليات عاملة")
+
+    try:
+        await (stop_event.wait() if stop_event is not None else _wait_for_stop())
+    finally:
+        supervisor.cancel()
+        await runner.cleanup()
+
+        # إشارة توقف لكل عملية بعد آخر تحديث في طابورها
+        for updates in queues:
+            updates.put(None)
+        loop = asyncio.get_running_loop()
+        for process in processes:
+            await loop.run_in_executor(None, process.join, 30)
+            if process.is_alive():
+                process.terminate()
+
+
+def run_bot(build_application):
+    """تشغيل البوت عبر Webhook إذا عُيّن WEBHOOK_URL، وإلا عبر الاستطلاع"""
+    webhook = WEBHOOK_URL and web is not None
+
+    if webhook and BOT_WORKERS > 1:
+        main = serve_sharded(build_application, BOT_WORKERS)
+    else:
+        application = build_application()
+        allowed_updates = registered_update_types(application)
+
+        if not webhook:
+            if WEBHOOK_URL:
+                logger.warning("مكتبة aiohttp غير مثبتة، سيتم التشغيل عبر الاستطلاع (polling)")
+            elif BOT_WORKERS > 1:
+                logger.warning("BOT_WORKERS يتطلب وضع Webhook، سيتم التشغيل بعملية واحدة")
+
+            # الاستطلاع يحذف أي Webhook مسجل قبل البدء
+            application.run_polling(allowed_updates=allowed_updates)
+            return
+
+        main = serve_webhook(application, allowed_updates)
+
+    try:
+        asyncio.run(main)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+قاطع دائرة لطلبات الذكاء الاصطناعي
+يتابع آخر الطلبات (نسبة الأخطاء وزمن أول رد p95)، وعند تجاوز الحدود يُفتح
+فتُتخطى طلبات Claude وتُعرض نتائج البحث فوراً، ثم بعد مهلة يُجرب طلباً واحداً قبل الإغلاق
+كل الحالة في حلقة الأحداث نفسها، فلا حاجة لأقفال
+"""
+
+import os
+import math
+import time
+import logging
+from collections import deque
+
+from metrics import register_collector
+
+logger = logging.getLogger(__name__)
+
+# عدد الطلبات الأخيرة المحسوبة، وأقصى عمرها بالثواني
+AI_BREAKER_WINDOW = int(os.getenv("AI_BREAKER_WINDOW", "20"))
+AI_BREAKER_WINDOW_SECONDS = float(os.getenv("AI_BREAKER_WINDOW_SECONDS", "300"))
+# أقل عدد طلبات قبل الحكم على الحالة
+AI_BREAKER_MIN_CALLS = int(os.getenv("AI_BREAKER_MIN_CALLS", "5"))
+# نسبة الأخطاء التي تفتح الدائرة
+AI_BREAKER_ERROR_RATE = float(os.getenv("AI_BREAKER_ERROR_RATE", "0.5"))
+# ميزانية زمن أول رد (p95) بالثواني
+AI_LATENCY_BUDGET = float(os.getenv("AI_LATENCY_BUDGET", "8"))
+# مدة بقاء الدائرة مفتوحة قبل تجربة طلب واحد
+AI_BREAKER_COOLDOWN = float(os.getenv("AI_BREAKER_COOLDOWN", "30"))
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker:
+    """قاطع دائرة بنافذة متحركة من (الوقت، نجاح، الزمن)"""
+
+    def __init__(self, window=AI_BREAKER_WINDOW, window_seconds=AI_BREAKER_WINDOW_SECONDS,
+                 min_calls=AI_BREAKER_MIN_CALLS, error_rate=AI_BREAKER_ERROR_RATE,
+                 latency_budget=AI_LATENCY_BUDGET, cooldown=AI_BREAKER_COOLDOWN):
+        self.window_seconds = window_seconds
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.latency_budget = latency_budget
+        self.cooldown = cooldown
+        self.state = CLOSED
+        self.skipped = 0
+        self._calls = deque(maxlen=window)
+        self._opened_at = 0.0
+        self._probing = False
+
+    def _recent(self, now):
+        """الطلبات داخل النافذة الزمنية"""
+        while self._calls and self._calls[0][0] < now - self.window_seconds:
+            self._calls.popleft()
+        return self._calls
+
+    def stats(self, now=None):
+        """(عدد الطلبات، نسبة الأخطاء، زمن p95 للناجحة أو None)"""
+        calls = self._recent(time.monotonic() if now is None else now)
+        if not calls:
+            return 0, 0.0, None
+
+        errors = sum(1 for _, ok, _ in calls if not ok)
+        latencies = sorted(latency for _, ok, latency in calls if ok)
+        p95 = latencies[math.ceil(0.95 * len(latencies)) - 1] if latencies else None
+        return len(calls), errors / len(calls), p95
+
+    def allow(self, now=None):
+        """هل يُرسل الطلب؟ (الدائرة المفتوحة تسمح بطلب تجربة واحد بعد المهلة)"""
+        now = time.monotonic() if now is None else now
+
+        if self.state == OPEN and now - self._opened_at >= self.cooldown:
+            self.state = HALF_OPEN
+            self._probing = False
+
+        if self.state == HALF_OPEN and not self._probing:
+            self._probing = True
+            return True
+
+        if self.state == CLOSED:
+            return True
+
+        self.skipped += 1
+        return False
+
+    def release(self):
+        """انتهاء طلب بدون نتيجة من الخدمة (إلغاء محلي، مكتبة غير مثبتة...): يُسمح بطلب تجربة آخر"""
+        if self.state == HALF_OPEN:
+            self._probing = False
+
+    def record(self, ok, latency=None, now=None):
+        """تسجيل نتيجة طلب (latency: زمن أول رد للطلب الناجح)"""
+        now = time.monotonic() if now is None else now
+
+        if self.state == HALF_OPEN:
+            self._probing = False
+            if ok and (latency is None or latency <= self.latency_budget):
+                self._calls.clear()
+                self.state = CLOSED
+                logger.info("الذكاء الاصطناعي: تم إغلاق الدائرة بعد نجاح طلب التجربة")
+            else:
+                self._open(now, "فشل طلب التجربة")
+            return
+
+        self._calls.append((now, ok, latency))
+        if self.state != CLOSED:
+            return
+
+        count, error_rate, p95 = self.stats(now)
+        if count < self.min_calls:
+            return
+
+        if error_rate >= self.error_rate:
+            self._open(now, f"نسبة الأخطاء {error_rate:.0%}")
+        elif p95 is not None and p95 > self.latency_budget:
+            self._open(now, f"زمن الرد p95 {p95:.1f} ث")
+
+    def _open(self, now, reason):
+        self.state = OPEN
+        self._opened_at = now
+        logger.warning(f"الذكاء الاصطناعي: تم فتح الدائرة ({reason})، الإجابات بالبحث فقط لمدة {self.cooldown:.0f} ث")
+
+
+ai_breaker = CircuitBreaker()
+
+
+@register_collector
+def breaker_metrics():
+    """حالة قاطع الدائرة لخادم المقاييس"""
+    _, error_rate, p95 = ai_breaker.stats()
+    return [
+        ('bot_ai_breaker_state', 'gauge', "حالة قاطع الدائرة (1 للحالة الحالية)",
+         [({'state': state}, int(ai_breaker.state == state)) for state in (CLOSED, OPEN, HALF_OPEN)]),
+        ('bot_ai_breaker_skipped_total', 'counter', "طلبات الذكاء الاصطناعي المتخطاة والدائرة مفتوحة",
+         [({}, ai_breaker.skipped)]),
+        ('bot_ai_breaker_error_rate', 'gauge', "نسبة الأخطاء في نافذة القاطع", [({}, error_rate)]),
+        ('bot_ai_breaker_first_token_p95_seconds', 'gauge', "زمن أول رد p95 في نافذة القاطع",
+         [({}, p95)] if p95 is not None else []),
+    ]
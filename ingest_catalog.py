@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+أداة استيراد الفهرس من ملفات CSV أو MARC (ISO 2709)
+تقرأ الملف على دفعات (ذاكرة محدودة) وتضيف أو تحدّث الكتب حسب رقم السجل
+داخل معاملات قصيرة، فيبقى البوت يقرأ أثناء الاستيراد (وضع WAL)
+
+رقم السجل غير فريد في الفهرس الحالي (نسخ مكررة)، لذلك:
+- السجل المطابق لنسخة موجودة بنفس القيم لا يُكتب (بدون تغيير)
+- السجل الجديد أو النسخة الزائدة عن الموجود تُضاف
+- التحديث فقط لرقم سجل له صف واحد في القاعدة؛ ورقم السجل المكرر الذي لا يطابق أي نسخة
+  لا يُكتب ويُذكر في التقرير (لا يُعرف أي نسخة يقصد، والتحديث الجماعي يمحو النسخ المختلفة)
+- نسخ رقم السجل الواحد تُطابق معاً داخل الدفعة (النسخ المتتالية في الملف لا تُفصل بين دفعتين)،
+  فتبقى الذاكرة بحجم الدفعة مهما كبر الفهرس
+سجلات MARC التالفة تُعد وتُتجاهل، ويستأنف القارئ من فاصل السجلات التالي
+أعمدة الظل (fts_*) تُحسب هنا، وفهرس البحث ورقم إصدار الفهرس (ولقطة الإحصائيات تبعاً له)
+يتحدثان تلقائياً عبر المشغلات
+
+الاستخدام:
+    python ingest_catalog.py export.csv
+    python ingest_catalog.py export.mrc --db library.db --batch-size 2000
+"""
+
+import os
+import re
+import csv
+import time
+import sqlite3
+import argparse
+import logging
+
+from search_index import INDEX_COLUMNS, index_values
+from migrate_db import SCHEMA_VERSION, get_schema_version
+
+logger = logging.getLogger(__name__)
+
+DB_PATH = os.getenv("LIBRARY_DB_PATH", "library.db")
+BATCH_SIZE = 2000
+
+# حقول الكتاب المستوردة (بنفس أسماء أعمدة جدول الكتب)
+BOOK_FIELDS = ('record_id', 'title', 'author', 'publisher', 'year', 'pages', 'classification', 'subject', 'isbn')
+
+# القيم التي تعني "لا يوجد"
+_EMPTY_VALUES = {'', 'nan', 'none', 'null'}
+
+_YEAR_RE = re.compile(r'\d{3,4}')
+
+# MARC: فواصل ISO 2709
+_FIELD_TERMINATOR = b'\x1e'
+_SUBFIELD_DELIMITER = b'\x1f'
+_RECORD_TERMINATOR = b'\x1d'
+
+
+def clean_value(value):
+    """تنظيف القيمة وتحويل القيم الفارغة إلى None"""
+    if value is None:
+        return None
+    value = str(value).strip()
+    return None if value.lower() in _EMPTY_VALUES else value
+
+
+def fulltext_value(book):
+    """نص البحث الكامل بنفس ترتيب البيانات الحالية: العنوان المؤلف الموضوع الناشر"""
+    parts = (book.get('title'), book.get('author'), book.get('subject'), book.get('publisher'))
+    return ' '.join(part for part in parts if part)
+
+
+# ==================== قراءة CSV ====================
+
+def read_csv(path):
+    """قراءة ملف CSV سطراً سطراً (أسماء الأعمدة في السطر الأول بأسماء حقول الكتاب)"""
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        reader = csv.DictReader(f)
+        for row in reader:
+            row = {key.strip().lower(): value for key, value in row.items() if key}
+            yield {field: clean_value(row.get(field)) for field in BOOK_FIELDS}
+
+
+# ==================== قراءة MARC ====================
+
+def _subfields(data):
+    """تقسيم حقل MARC إلى قائمة (رمز، قيمة)"""
+    result = []
+    for chunk in data.split(_SUBFIELD_DELIMITER)[1:]:
+        if chunk:
+            result.append((chr(chunk[0]), chunk[1:].decode('utf-8', errors='replace').strip()))
+    return result
+
+
+def parse_marc_record(raw):
+    """تحويل سجل MARC خام إلى قاموس {الوسم: [قيم]}"""
+    base_address = int(raw[12:17])
+    directory = raw[24:base_address - 1]
+    fields = {}
+
+    for i in range(0, len(directory), 12):
+        entry = directory[i:i + 12]
+        if len(entry) < 12:
+            break
+        tag = entry[:3].decode('ascii', errors='replace')
+        length = int(entry[3:7])
+        start = int(entry[7:12])
+        data = raw[base_address + start:base_address + start + length].rstrip(_FIELD_TERMINATOR)
+
+        if tag < '010':
+            # حقول التحكم بدون مؤشرات أو حقول فرعية
+            fields.setdefault(tag, []).append(data.decode('utf-8', errors='replace').strip())
+        else:
+            fields.setdefault(tag, []).append(_subfields(data[2:]))
+
+    return fields
+
+
+def _first(fields, tag, codes):
+    """أول قيمة للحقول الفرعية المطلوبة في أول تكرار للوسم"""
+    for subfields in fields.get(tag, [])[:1]:
+        values = [value for code, value in subfields if code in codes]
+        if values:
+            return ' '.join(values)
+    return None
+
+
+def marc_to_book(fields):
+    """ربط حقول MARC 21 بحقول الكتاب"""
+    year_text = _first(fields, '260', 'c') or _first(fields, '264', 'c')
+    year_match = _YEAR_RE.search(year_text or '')
+
+    subjects = [
+        ' '.join(value for code, value in subfields if code in 'axyz')
+        for subfields in fields.get('650', [])
+    ]
+
+    book = {
+        'record_id': (fields.get('001') or [None])[0],
+        'title': _first(fields, '245', 'ab'),
+        'author': _first(fields, '100', 'a') or _first(fields, '110', 'a'),
+        'publisher': _first(fields, '260', 'b') or _first(fields, '264', 'b'),
+        'year': year_match.group(0) if year_match else None,
+        'pages': _first(fields, '300', 'a'),
+        'classification': _first(fields, '082', 'a'),
+        'subject': ' | '.join(subject for subject in subjects if subject) or None,
+        'isbn': _first(fields, '020', 'a'),
+    }
+    return {field: clean_value(value) for field, value in book.items()}
+
+
+def _skip_to_terminator(f):
+    """تخطي بقية سجل تالف حتى ما بعد فاصل السجلات التالي"""
+    while True:
+        chunk = f.read(4096)
+        if not chunk:
+            return
+        end = chunk.find(_RECORD_TERMINATOR)
+        if end >= 0:
+            f.seek(end + 1 - len(chunk), 1)
+            return
+
+
+def read_marc(path):
+    """
+    قراءة ملف MARC سجلاً سجلاً (طول السجل في أول 5 بايت من رأسه)
+    السجل التالف يُرجع None، والطول التالف يُتجاوز حتى فاصل السجلات التالي
+    """
+    with open(path, 'rb') as f:
+        while True:
+            start = f.tell()
+            length_bytes = f.read(5)
+            if not length_bytes or length_bytes.strip(b'\n\r') == b'':
+                break
+
+            try:
+                length = int(length_bytes)
+                if length < 24:
+                    raise ValueError(f"طول السجل {length} أقصر من الرأس")
+                raw = length_bytes + f.read(length - 5)
+                if not raw.endswith(_RECORD_TERMINATOR):
+                    raise ValueError("طول السجل لا يطابق موضع فاصل السجلات")
+            except ValueError as e:
+                logger.warning(f"تم تجاهل سجل MARC تالف عند البايت {start:,}: {e}")
+                f.seek(start + 5)
+                _skip_to_terminator(f)
+                yield None
+                continue
+
+            try:
+                yield marc_to_book(parse_marc_record(raw))
+            except (ValueError, IndexError) as e:
+                logger.warning(f"تم تجاهل سجل MARC تالف: {e}")
+                yield None
+
+
+# ==================== الكتابة في قاعدة البيانات ====================
+
+_SET_COLUMNS = BOOK_FIELDS[1:] + ('FULLTEXT_SEARCH',) + INDEX_COLUMNS
+
+_SELECT_SQL = f"SELECT id, {', '.join(BOOK_FIELDS[1:])} FROM books WHERE record_id = ? ORDER BY id"
+_UPDATE_SQL = "UPDATE books SET " + ', '.join(f"{col} = ?" for col in _SET_COLUMNS) + " WHERE id = ?"
+_INSERT_SQL = (
+    "INSERT INTO books (record_id, " + ', '.join(_SET_COLUMNS) + ") VALUES (" +
+    ', '.join('?' for _ in range(len(_SET_COLUMNS) + 1)) + ")"
+)
+
+# عدد أرقام السجلات المتعارضة المذكورة في التقرير
+_REPORT_CONFLICTS = 20
+
+
+def _comparable(value):
+    """القيمة للمقارنة فقط: فروق المسافات ليست تغييراً"""
+    return None if value is None else ' '.join(str(value).split())
+
+
+def _same_book(book, row):
+    """هل يطابق الكتاب المستورد صفاً موجوداً (الأعمدة المصدرية فقط، لا النص الكامل المشتق منها)"""
+    return all(_comparable(book[field]) == _comparable(value) for field, value in zip(BOOK_FIELDS[1:], row[1:]))
+
+
+def upsert_batch(conn, batch, counts, conflicts):
+    """
+    إضافة أو تحديث دفعة من الكتب في معاملة واحدة
+    conflicts: أرقام السجلات المكررة التي لم تُكتب
+    """
+    # الصفوف التي طابقتها الدفعة لكل رقم سجل (لا يطابق سجلان من الملف نفس الصف)
+    claimed = {}
+
+    with conn:
+        for book in batch:
+            rows = conn.execute(_SELECT_SQL, (book['record_id'],)).fetchall()
+            taken = claimed.setdefault(book['record_id'], set())
+            unclaimed = [row for row in rows if row[0] not in taken]
+
+            match = next((row for row in unclaimed if _same_book(book, row)), None)
+            if match is not None:
+                taken.add(match[0])
+                counts['unchanged'] += 1
+                continue
+
+            book = dict(book, FULLTEXT_SEARCH=fulltext_value(book))
+            values = [book[field] for field in BOOK_FIELDS[1:]] + [book['FULLTEXT_SEARCH']] + index_values(book)
+
+            if not unclaimed:
+                # رقم جديد، أو نسخة زائدة عن النسخ الموجودة
+                cursor = conn.execute(_INSERT_SQL, [book['record_id']] + values)
+                taken.add(cursor.lastrowid)
+                counts['inserted'] += 1
+            elif len(rows) == 1:
+                # رقم فريد تغيرت قيمه
+                conn.execute(_UPDATE_SQL, values + [rows[0][0]])
+                taken.add(rows[0][0])
+                counts['updated'] += 1
+            else:
+                counts['conflicts'] += 1
+                if len(conflicts) < _REPORT_CONFLICTS:
+                    conflicts.append(book['record_id'])
+
+
+def ingest(path, db_path=DB_PATH, file_format=None, batch_size=BATCH_SIZE):
+    """استيراد ملف كامل على دفعات"""
+    if file_format is None:
+        file_format = 'marc' if path.lower().endswith(('.mrc', '.marc')) else 'csv'
+
+    reader = read_marc(path) if file_format == 'marc' else read_csv(path)
+
+    conn = sqlite3.connect(db_path, timeout=30)
+    conn.execute("PRAGMA synchronous = NORMAL")
+
+    counts = {'inserted': 0, 'updated': 0, 'unchanged': 0, 'conflicts': 0, 'skipped': 0, 'malformed': 0}
+    conflicts = []
+    started = time.monotonic()
+
+    try:
+        version = get_schema_version(conn)
+        if version != SCHEMA_VERSION:
+            raise RuntimeError(f"إصدار قاعدة البيانات {version} والمطلوب {SCHEMA_VERSION}، قم بتشغيل migrate_db.py أولاً")
+
+        batch = []
+        for book in reader:
+            if book is None:
+                counts['malformed'] += 1
+                continue
+            if not book['record_id']:
+                counts['skipped'] += 1
+                continue
+
+            # الدفعة لا تنتهي وسط نسخ متتالية لنفس رقم السجل
+            if len(batch) >= batch_size and book['record_id'] != batch[-1]['record_id']:
+                upsert_batch(conn, batch, counts, conflicts)
+                batch = []
+                processed = sum(counts.values()) - counts['skipped'] - counts['malformed']
+                logger.info(f"تمت معالجة {processed:,} سجل ({time.monotonic() - started:.1f} ث)")
+
+            batch.append(book)
+
+        if batch:
+            upsert_batch(conn, batch, counts, conflicts)
+
+        # تحديث إحصائيات المخطط بعد التغييرات الكبيرة
+        conn.execute("PRAGMA optimize")
+
+    finally:
+        conn.close()
+
+    logger.info(
+        f"اكتمل الاستيراد في {time.monotonic() - started:.1f} ث: "
+        f"جديد {counts['inserted']:,}، محدث {counts['updated']:,}، "
+        f"بدون تغيير {counts['unchanged']:,}، متعارض {counts['conflicts']:,}، متجاهل {counts['skipped']:,}، "
+        f"تالف {counts['malformed']:,}"
+    )
+    if conflicts:
+        logger.warning(
+            f"{counts['conflicts']:,} سجل لم يُكتب: رقم السجل له عدة نسخ في القاعدة ولا يطابق أياً منها "
+            f"(راجعها يدوياً)، منها: {', '.join(conflicts)}"
+        )
+    return counts
+
+
+def main():
+    """تشغيل أداة الاستيراد"""
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+
+    parser = argparse.ArgumentParser(description="استيراد فهرس الكتب من CSV أو MARC")
+    parser.add_argument('path', help="مسار ملف الاستيراد")
+    parser.add_argument('--db', default=DB_PATH, help="مسار قاعدة البيانات")
+    parser.add_argument('--format', choices=('csv', 'marc'), help="صيغة الملف (تُستنتج من الامتداد افتراضياً)")
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help="عدد السجلات في كل معاملة")
+    args = parser.parse_args()
+
+    ingest(args.path, args.db, args.format, args.batch_size)
+
+
+if __name__ == '__main__':
+    main()
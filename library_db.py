@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+"""
+طبقة الوصول المشتركة لقاعدة بيانات المكتبة
+تحتفظ باتصال قراءة فقط طويل العمر لكل خيط (thread) بدلاً من فتح اتصال جديد مع كل رسالة
+وتدعم استبدال ملف قاعدة البيانات أثناء التشغيل دون إعادة تشغيل البوت:
+LIBRARY_DB_PATH رابط رمزي إلى ملف بإصدار (library-v2.db...) ويُستبدل الرابط ذرياً،
+فلكل ملف ملفا -wal و-shm الخاصان به. إعادة تسمية ملف فوق قاعدة WAL مفتوحة تربط الملف الجديد
+بملفات -wal/-shm القديمة (سيناريو إفساد موثق في SQLite)، لذلك تُرفض
+"""
+
+import os
+import time
+import asyncio
+import sqlite3
+import logging
+import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from migrate_db import SCHEMA_VERSION, get_schema_version
+from library_stats import compute_stats, get_catalog_version, install_snapshot
+from metrics import STAGE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+DB_PATH = os.getenv("LIBRARY_DB_PATH", "library.db")
+
+# إعدادات الأداء (قابلة للتعديل من المتغيرات البيئية)
+MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(256 * 1024 * 1024)))
+CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "65536"))
+CACHED_STATEMENTS = int(os.getenv("DB_CACHED_STATEMENTS", "256"))
+
+# حدود التزامن: عدد خيوط قاعدة البيانات، وأقصى مدة لاستعلام واحد بالثواني
+DB_WORKERS = int(os.getenv("DB_WORKERS", "4"))
+DB_QUERY_TIMEOUT = float(os.getenv("DB_QUERY_TIMEOUT", "5"))
+
+# الفترة بالثواني بين كل فحص لاستبدال ملف قاعدة البيانات (0 لتعطيل الفحص)
+DB_RELOAD_INTERVAL = float(os.getenv("DB_RELOAD_INTERVAL", "30"))
+
+# عدد تعليمات SQLite بين كل فحص للمهلة
+_PROGRESS_STEPS = 10000
+
+_local = threading.local()
+_connections = set()
+# الاتصالات التي ينفذ بها خيط عملاً الآن (لا تُغلق من خيط آخر)
+_in_use = set()
+_lock = threading.Lock()
+
+# رقم نسخة قاعدة البيانات المفتوحة: يزيد عند كل استبدال، فيعيد كل خيط فتح اتصاله
+_generation = 0
+# المسار الفعلي للملف الحالي (بعد تتبع الرابط الرمزي) وهويته (الجهاز، رقم inode)
+_db_file = None
+_file_id = None
+# هوية آخر ملف مرفوض حتى لا يُعاد فحصه في كل دورة
+_rejected_file_id = None
+# دوال تُستدعى بعد كل استبدال (مثل إفراغ ذاكرة النتائج)
+_reload_listeners = []
+
+_executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix='db')
+
+
+def _open_connection(db_path):
+    """فتح اتصال قراءة فقط مع إعدادات الأداء"""
+    conn = sqlite3.connect(
+        f'file:{db_path}?mode=ro',
+        uri=True,
+        cached_statements=CACHED_STATEMENTS,
+        # كل اتصال يستخدمه خيط واحد فقط، لكن الإغلاق قد يتم من الخيط الرئيسي
+        check_same_thread=False,
+    )
+    # وضع WAL يُضبط عند الترحيل ويبقى محفوظاً في الملف، هنا نضبط إعدادات الاتصال فقط
+    conn.execute(f"PRAGMA mmap_size = {MMAP_SIZE}")
+    conn.execute(f"PRAGMA cache_size = -{CACHE_SIZE_KB}")
+    conn.execute("PRAGMA query_only = ON")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    conn.set_progress_handler(_check_deadline, _PROGRESS_STEPS)
+    return conn
+
+
+def _check_deadline():
+    """إيقاف الاستعلام إذا تجاوز مهلته (قيمة غير صفرية تقطع التنفيذ)"""
+    deadline = getattr(_local, 'deadline', None)
+    return 1 if deadline is not None and time.monotonic() > deadline else 0
+
+
+def _call_with_deadline(func, timeout, submitted_at):
+    """تنفيذ الدالة داخل خيط قاعدة البيانات مع مهلة للاستعلامات (وقياس زمن الانتظار والتنفيذ)"""
+    started = time.monotonic()
+    operation = getattr(func.func, '__qualname__', 'db')
+    STAGE_SECONDS.observe(started - submitted_at, stage='db_wait', operation=operation)
+
+    _local.deadline = started + timeout if timeout else None
+    _local.in_call = True
+    _local.cache_hit = False
+    try:
+        return func()
+    finally:
+        _local.deadline = None
+        _local.in_call = False
+        _release_connection()
+        # النتيجة من الذاكرة المؤقتة لا تُحسب زمن استعلام
+        stage = 'cache' if _local.cache_hit else 'db'
+        STAGE_SECONDS.observe(time.monotonic() - started, stage=stage, operation=operation)
+
+
+def note_cache_lookup(found):
+    """تسجيل نتيجة آخر بحث في الذاكرة المؤقتة داخل عمل قاعدة البيانات الحالي (إصابة أو إخفاق)"""
+    _local.cache_hit = found
+
+
+async def run_db(func, *args, timeout=DB_QUERY_TIMEOUT, **kwargs):
+    """تنفيذ عمل قاعدة البيانات في مجموعة خيوط محدودة بدلاً من حلقة الأحداث"""
+    loop = asyncio.get_running_loop()
+    call = functools.partial(func, *args, **kwargs)
+    return await loop.run_in_executor(_executor, _call_with_deadline, call, timeout, time.monotonic())
+
+
+def submit_db(func, *args, **kwargs):
+    """تنفيذ عمل في الخلفية على خيوط قاعدة البيانات بدون مهلة (لا ينتظره الطلب الحالي)"""
+    call = functools.partial(func, *args, **kwargs)
+    return _executor.submit(_call_with_deadline, call, None, time.monotonic())
+
+
+def _get_file_id(db_path):
+    """هوية ملف قاعدة البيانات (تتبع الروابط الرمزية)"""
+    stat = os.stat(db_path)
+    return stat.st_dev, stat.st_ino
+
+
+def _release_connection():
+    """نهاية عمل الخيط الحالي: اتصاله قابل للإغلاق، ويُغلق فوراً إذا كان لنسخة قديمة"""
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        return
+
+    with _lock:
+        _in_use.discard(conn)
+        stale = _local.generation != _generation
+        if stale:
+            _connections.discard(conn)
+
+    if stale:
+        conn.close()
+        _local.conn = None
+
+
+def get_connection():
+    """اتصال الخيط الحالي (يُفتح مرة واحدة ثم يُعاد استخدامه حتى يُستبدل ملف قاعدة البيانات)"""
+    global _db_file, _file_id
+
+    conn = getattr(_local, 'conn', None)
+    in_call = getattr(_local, 'in_call', False)
+
+    with _lock:
+        # الملف استُبدل، أو أغلق التبديل الاتصال لأنه كان خاملاً
+        if conn is not None and (_local.generation != _generation or conn not in _connections):
+            _connections.discard(conn)
+            stale, conn = conn, None
+        else:
+            stale = None
+
+        if conn is not None and in_call:
+            _in_use.add(conn)
+
+        generation = _generation
+        if _db_file is None:
+            _db_file = os.path.realpath(DB_PATH)
+            _file_id = _get_file_id(_db_file)
+        db_file = _db_file
+
+    if stale is not None:
+        stale.close()
+
+    if conn is None:
+        conn = _open_connection(db_file)
+        _local.conn = conn
+        _local.generation = generation
+        with _lock:
+            _connections.add(conn)
+            if in_call:
+                _in_use.add(conn)
+        logger.info(f"تم فتح اتصال بقاعدة البيانات للخيط: {threading.current_thread().name} ({os.path.basename(db_file)})")
+
+    return conn
+
+
+def get_cursor():
+    """مؤشر جديد على اتصال الخيط الحالي"""
+    return get_connection().cursor()
+
+
+def add_reload_listener(func):
+    """تسجيل دالة تُستدعى بعد استبدال ملف قاعدة البيانات"""
+    _reload_listeners.append(func)
+
+
+def _warm_up(conn):
+    """قراءة صفحات الفهارس مسبقاً وحساب الإحصائيات على الملف الجديد قبل التبديل"""
+    cursor = conn.cursor()
+    cursor.execute("SELECT SUM(LENGTH(block)) FROM books_fts_data")
+    cursor.execute("SELECT COUNT(*) FROM books INDEXED BY idx_record_id")
+    return compute_stats(cursor), get_catalog_version(cursor)
+
+
+def _wal_files(db_file):
+    """ملفات -wal و-shm الموجودة بجانب ملف قاعدة البيانات"""
+    return [db_file + suffix for suffix in ('-wal', '-shm') if os.path.exists(db_file + suffix)]
+
+
+def reload_if_changed():
+    """استبدال قاعدة البيانات إذا تغير الملف الذي يشير إليه LIBRARY_DB_PATH
+
+    يُفتح الملف الجديد ويُسخّن في الخلفية، ثم تُزاد رقم النسخة فتنتقل إليه
+    الطلبات الجديدة وتُغلق الاتصالات الخاملة على الملف القديم فوراً،
+    بينما تكمل الاستعلامات الجارية عليه ثم تُغلق اتصالاتها عند انتهائها
+    """
+    global _generation, _db_file, _file_id, _rejected_file_id
+
+    try:
+        db_file = os.path.realpath(DB_PATH)
+        file_id = _get_file_id(db_file)
+    except FileNotFoundError:
+        # الملف قيد الاستبدال الآن
+        return False
+
+    if file_id == _file_id or file_id == _rejected_file_id or _file_id is None:
+        return False
+
+    logger.info(f"تم اكتشاف ملف جديد لقاعدة البيانات: {db_file}")
+    started = time.monotonic()
+
+    if db_file == _db_file and _wal_files(db_file):
+        # ملف جديد بنفس الاسم: ملفات -wal/-shm الموجودة تخص الملف القديم المفتوح
+        logger.error(
+            f"تم رفض الملف الجديد: استُبدل {db_file} بإعادة التسمية وبجانبه {', '.join(_wal_files(db_file))} "
+            f"للنسخة القديمة، وفتحه معها يفسده. استبدل الرابط الرمزي إلى ملف بإصدار جديد (انظر README)"
+        )
+        _rejected_file_id = file_id
+        return False
+
+    try:
+        conn = _open_connection(db_file)
+        try:
+            version = get_schema_version(conn)
+            if version != SCHEMA_VERSION:
+                raise RuntimeError(f"إصدار قاعدة البيانات {version} والمطلوب {SCHEMA_VERSION}")
+            stats, catalog_version = _warm_up(conn)
+        finally:
+            conn.close()
+    except (sqlite3.Error, RuntimeError) as e:
+        logger.error(f"تم رفض الملف الجديد والاستمرار على النسخة الحالية: {e}")
+        _rejected_file_id = file_id
+        return False
+
+    with _lock:
+        _generation += 1
+        _db_file = db_file
+        _file_id = file_id
+        # الاتصالات الخاملة على الملف القديم تُغلق الآن (الجارية تُغلق عند انتهاء عملها)
+        idle = [conn for conn in _connections if conn not in _in_use]
+        _connections.difference_update(idle)
+
+    for conn in idle:
+        conn.close()
+
+    install_snapshot(stats, catalog_version)
+    for listener in _reload_listeners:
+        listener()
+
+    logger.info(
+        f"تم التبديل إلى قاعدة البيانات الجديدة {os.path.basename(db_file)} (النسخة {_generation}) "
+        f"خلال {time.monotonic() - started:.2f} ث، وأُغلق {len(idle)} اتصال خامل"
+    )
+    return True
+
+
+async def watch_for_reload(interval=DB_RELOAD_INTERVAL):
+    """فحص دوري لاستبدال ملف قاعدة البيانات (يعمل كمهمة في خلفية البوت)"""
+    if not interval:
+        return
+    if not os.path.islink(DB_PATH):
+        # ملف عادي في وضع WAL: بجانبه -wal/-shm دائماً فيُرفض كل ملف بديل بنفس الاسم
+        logger.warning(
+            f"الاستبدال أثناء التشغيل معطل: {DB_PATH} ملف عادي وليس رابطاً رمزياً. "
+            f"لتفعيله اجعله رابطاً رمزياً إلى ملف بإصدار (انظر README)، وإلا أعد تشغيل البوت بعد الاستبدال"
+        )
+        return
+
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            # التسخين يقرأ الفهارس كاملة فلا يخضع لمهلة الاستعلام العادية
+            await run_db(reload_if_changed, timeout=None)
+        except Exception as e:
+            logger.error(f"خطأ في فحص ملف قاعدة البيانات: {e}")
+
+
+def close_all():
+    """إغلاق جميع الاتصالات المفتوحة (عند إيقاف البوت)"""
+    _executor.shutdown(wait=True)
+
+    with _lock:
+        connections = list(_connections)
+        _connections.clear()
+        _in_use.clear()
+
+    for conn in connections:
+        conn.close()
+
+    _local.conn = None
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+لقطة إحصائيات المكتبة
+تُحسب مرة واحدة ثم تُعاد من الذاكرة، ولا يُعاد حسابها إلا إذا تغير رقم إصدار الفهرس
+(يزيده مشغل على جدول الكتب عند أي إضافة أو تعديل أو حذف)
+"""
+
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+VERSION_TABLE = 'catalog_version'
+
+# عدد العناصر في قوائم "الأكثر"
+TOP_N = 5
+
+_snapshot = None
+_snapshot_version = None
+_lock = threading.Lock()
+
+
+def get_catalog_version(cursor):
+    """رقم إصدار الفهرس الحالي (قراءة صف واحد)"""
+    cursor.execute(f"SELECT version FROM {VERSION_TABLE} WHERE id = 1")
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+
+def compute_stats(cursor):
+    """حساب جميع الإحصائيات من جدول الكتب"""
+    stats = {}
+
+    # إجمالي الكتب/العناوين
+    cursor.execute("SELECT COUNT(*) FROM books")
+    stats['total_books'] = cursor.fetchone()[0]
+
+    # عدد المؤلفين والناشرين والتصنيفات والموضوعات الفريدة
+    for key, column in (('total_authors', 'author'), ('total_publishers', 'publisher'),
+                        ('total_classifications', 'classification'), ('total_subjects', 'subject')):
+        cursor.execute(f"SELECT COUNT(DISTINCT {column}) FROM books WHERE {column} IS NOT NULL")
+        stats[key] = cursor.fetchone()[0]
+
+    # أكثر المؤلفين والموضوعات
+    for key, column in (('top_authors', 'author'), ('top_subjects', 'subject')):
+        cursor.execute(f"""
+            SELECT {column}, COUNT(*) as count
+            FROM books
+            WHERE {column} IS NOT NULL
+            GROUP BY {column}
+            ORDER BY count DESC
+            LIMIT ?
+        """, (TOP_N,))
+        stats[key] = cursor.fetchall()
+
+    # أقدم وأحدث كتاب (قراءة طرف فهرس السنة الهجرية الرقمية)
+    cursor.execute("SELECT title, year_hijri FROM books WHERE year_hijri IS NOT NULL ORDER BY year_hijri LIMIT 1")
+    stats['oldest'] = cursor.fetchone()
+
+    cursor.execute("SELECT title, year_hijri FROM books WHERE year_hijri IS NOT NULL ORDER BY year_hijri DESC LIMIT 1")
+    stats['newest'] = cursor.fetchone()
+
+    return stats
+
+
+def get_stats_snapshot(cursor):
+    """الإحصائيات من الذاكرة، مع إعادة الحساب فقط عند تغير جدول الكتب"""
+    global _snapshot, _snapshot_version
+
+    version = get_catalog_version(cursor)
+    if _snapshot is not None and version == _snapshot_version:
+        return _snapshot
+
+    with _lock:
+        # ربما حسبها خيط آخر أثناء الانتظار
+        if _snapshot is None or version != _snapshot_version:
+            _snapshot = compute_stats(cursor)
+            _snapshot_version = version
+            logger.info(f"تم تحديث لقطة الإحصائيات (الإصدار {version})")
+
+    return _snapshot
+
+
+def install_snapshot(stats, version):
+    """تثبيت لقطة محسوبة مسبقاً (عند استبدال ملف قاعدة البيانات)"""
+    global _snapshot, _snapshot_version
+
+    with _lock:
+        _snapshot = stats
+        _snapshot_version = version
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+"""
+مقاييس الأداء بصيغة Prometheus النصية على عنوان محلي /metrics
+- عدادات ومقاييس لحظية ومدرجات زمنية، آمنة للاستخدام من خيوط قاعدة البيانات
+- زمن كل معالج، وزمن كل مرحلة (التحليل، قاعدة البيانات، التنسيق، الإرسال، الذكاء الاصطناعي)
+- الكائنات التي تحسب أرقامها بنفسها (الذاكرة المؤقتة، حد الطلبات...) تُقرأ عند الطلب عبر دوال تجميع
+بدون مكتبات خارجية؛ الخادم يحتاج aiohttp فقط
+"""
+
+import os
+import math
+import time
+import asyncio
+import logging
+import functools
+import threading
+from contextlib import contextmanager
+
+try:
+    from aiohttp import web
+except ImportError:
+    web = None
+
+logger = logging.getLogger(__name__)
+
+# منفذ وعنوان خادم المقاييس (0 لتعطيله)؛ العمليات العاملة تستخدم المنفذ + رقم العملية
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9091"))
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+
+# حدود المدرجات الزمنية بالثواني
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_metrics = []
+_collectors = []
+_worker_index = None
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (
+        (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """أساس المقاييس: قيمة لكل مجموعة تسميات"""
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def samples(self):
+        """(اللاحقة، قيم التسميات، تسميات إضافية، القيمة)"""
+        with self._lock:
+            return [('', key, (), value) for key, value in self._values.items()]
+
+
+class Counter(_Metric):
+    """عداد يزيد فقط"""
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """قيمة لحظية تزيد وتنقص"""
+    type = 'gauge'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    @contextmanager
+    def track(self, **labels):
+        """زيادة القيمة طوال تنفيذ الكتلة"""
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(_Metric):
+    """مدرج زمني: عدد القيم في كل حد، ومجموعها وعددها"""
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """قياس زمن تنفيذ الكتلة"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        result = []
+        with self._lock:
+            for key, (counts, total, count) in self._values.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    result.append(('_bucket', key, (('le', _format_value(bound)),), cumulative))
+                result.append(('_sum', key, (), total))
+                result.append(('_count', key, (), count))
+        return result
+
+
+# ==================== المقاييس المشتركة ====================
+
+UPDATES_IN_FLIGHT = Gauge('bot_updates_in_flight', "عدد التحديثات قيد المعالجة")
+HANDLER_SECONDS = Histogram('bot_handler_seconds', "زمن تنفيذ المعالج", ('handler',))
+HANDLER_ERRORS = Counter('bot_handler_errors_total', "الأخطاء غير المعالجة داخل المعالجات", ('handler',))
+ERRORS = Counter('bot_errors_total', "الأخطاء التي وصلت إلى معالج الأخطاء")
+EMPTY_RESULTS = Counter('bot_empty_results_total', "الردود بدون نتائج", ('handler',))
+STAGE_SECONDS = Histogram(
+    'bot_stage_seconds', "زمن كل مرحلة: parse، db، db_wait، cache، format، send، send_wait، ai", ('stage', 'operation'),
+)
+
+
+def register_collector(func):
+    """دالة تُستدعى عند كل طلب للمقاييس وتُرجع قائمة (الاسم، النوع، الوصف، [(تسميات، قيمة)])"""
+    _collectors.append(func)
+    return func
+
+
+def render():
+    """كل المقاييس بصيغة Prometheus النصية"""
+    lines = []
+
+    for metric in _metrics:
+        lines.append(f'# HELP {metric.name} {metric.documentation}')
+        lines.append(f'# TYPE {metric.name} {metric.type}')
+        for suffix, key, extra, value in metric.samples():
+            lines.append(f'{metric.name}{suffix}{_format_labels(metric.labelnames, key, extra)} {_format_value(value)}')
+
+    for collector in _collectors:
+        try:
+            families = collector()
+        except Exception as e:
+            logger.warning(f"تعذر جمع المقاييس من {collector.__name__}: {e}")
+            continue
+
+        for name, metric_type, documentation, samples in families:
+            lines.append(f'# HELP {name} {documentation}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            for labels, value in samples:
+                labels = dict(labels)
+                lines.append(f'{name}{_format_labels(tuple(labels), tuple(labels.values()))} {_format_value(value)}')
+
+    return '\n'.join(lines) + '\n'
+
+
+# ==================== القياس ====================
+
+def timed(stage, operation=None):
+    """مزخرف لدالة عادية: زمن تنفيذها في مرحلة stage (العملية = اسم الدالة افتراضياً)"""
+    def decorator(func):
+        name = operation or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with STAGE_SECONDS.time(stage=stage, operation=name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def track_handler(handler):
+    """مزخرف لمعالج تليجرام: زمنه، وعدد التحديثات الجارية، والأخطاء"""
+    name = handler.__name__
+
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        UPDATES_IN_FLIGHT.inc()
+        try:
+            return await handler(*args, **kwargs)
+        except Exception:
+            HANDLER_ERRORS.inc(handler=name)
+            raise
+        finally:
+            UPDATES_IN_FLIGHT.dec()
+            HANDLER_SECONDS.observe(time.perf_counter() - started, handler=name)
+
+    return wrapper
+
+
+# ==================== الخادم ====================
+
+def set_worker_index(index):
+    """رقم العملية العاملة (تستمع على منفذ المقاييس + رقمها)"""
+    global _worker_index
+    _worker_index = index
+
+
+async def serve_metrics():
+    """مهمة خلفية: خادم /metrics المحلي طوال تشغيل البوت"""
+    if not METRICS_PORT:
+        return
+    if web is None:
+        logger.warning("مكتبة aiohttp غير مثبتة، لن يعمل خادم المقاييس")
+        return
+
+    port = METRICS_PORT + (_worker_index or 0)
+
+    async def metrics_page(request):
+        return web.Response(text=render(), content_type='text/plain', charset='utf-8')
+
+    app = web.Application()
+    app.router.add_get('/metrics', metrics_page)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+
+    try:
+        await web.TCPSite(runner, METRICS_LISTEN, port).start()
+    except OSError as e:
+        logger.warning(f"تعذر تشغيل خادم المقاييس على المنفذ {port}: {e}")
+        await runner.cleanup()
+        return
+
+    logger.info(f"المقاييس متاحة على http://{METRICS_LISTEN}:{port}/metrics")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
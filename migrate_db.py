@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+أداة ترحيل قاعدة البيانات
+تطبق على ملف قاعدة بيانات موجود (LIBRARY_DB_PATH، افتراضياً library.db) الترحيلات المرقمة التي لم تُطبق بعد (حسب PRAGMA user_version):
+فهرس البحث النصي الكامل (FTS5) ومشغلاته، رقم إصدار الفهرس، أعمدة السنة الرقمية،
+تحويل القيم 'nan' إلى NULL، فهارس الاستعلامات الفعلية، وأعمدة الظل المفهرسة.
+البوتان يرفضان العمل على قاعدة غير محدثة
+
+الكتابة في جدول الكتب من خارج ingest_catalog.py لا تحدّث أعمدة الظل (fts_*)، فيجب بعدها
+تشغيل الأداة مع --rebuild-index لإعادة حسابها وبناء الفهرس
+
+الاستخدام:
+    python migrate_db.py [مسار_قاعدة_البيانات] [--rebuild-index]
+"""
+
+import os
+import sqlite3
+import argparse
+import logging
+from contextlib import contextmanager
+
+from search_index import (
+    FTS_TABLE, FTS_COLUMNS, SOURCE_COLUMNS, INDEX_COLUMNS, HIJRI_MAX, GREGORIAN_MAX, index_values,
+)
+from arabic_text import register_functions
+from library_stats import VERSION_TABLE
+
+logger = logging.getLogger(__name__)
+
+DB_PATH = os.getenv("LIBRARY_DB_PATH", "library.db")
+
+# عدد الكتب في كل دفعة عند حساب أعمدة الظل
+_INDEX_BATCH = 2000
+
+
+@contextmanager
+def transaction(conn):
+    """معاملة صريحة (الاتصال في وضع autocommit): كل الأوامر تُطبق معاً أو لا يُطبق شيء"""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+
+def _execute_all(conn, statements):
+    """تنفيذ الأوامر واحداً واحداً داخل المعاملة الحالية (executescript ينهي المعاملة قبل التنفيذ)"""
+    for statement in statements:
+        conn.execute(statement)
+
+
+def create_fts_table(conn):
+    """إنشاء جدول الفهرس (المشغلات ومحتواه من أعمدة الظل في create_index_columns)"""
+    conn.execute(f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+            {', '.join(FTS_COLUMNS)},
+            tokenize = 'unicode61 remove_diacritics 2',
+            prefix = '2 3'
+        )
+    """)
+
+
+def create_fts_triggers(conn):
+    """مشغلات تنسخ أعمدة الظل إلى الفهرس (SQL فقط، تعمل من أي اتصال)"""
+    columns = ', '.join(FTS_COLUMNS)
+    values = ', '.join(f'new.{column}' for column in INDEX_COLUMNS)
+
+    _execute_all(conn, (
+        f"DROP TRIGGER IF EXISTS {FTS_TABLE}_ai",
+        f"DROP TRIGGER IF EXISTS {FTS_TABLE}_ad",
+        f"DROP TRIGGER IF EXISTS {FTS_TABLE}_au",
+        f"""
+        CREATE TRIGGER {FTS_TABLE}_ai AFTER INSERT ON books BEGIN
+            INSERT INTO {FTS_TABLE}(rowid, {columns}) VALUES (new.id, {values});
+        END
+        """,
+        f"""
+        CREATE TRIGGER {FTS_TABLE}_ad AFTER DELETE ON books BEGIN
+            DELETE FROM {FTS_TABLE} WHERE rowid = old.id;
+        END
+        """,
+        # إعادة الفهرسة فقط عند تعديل أعمدة الظل (تعديل السنة مثلاً لا يمس الفهرس)
+        f"""
+        CREATE TRIGGER {FTS_TABLE}_au AFTER UPDATE OF {', '.join(INDEX_COLUMNS)} ON books BEGIN
+            DELETE FROM {FTS_TABLE} WHERE rowid = old.id;
+            INSERT INTO {FTS_TABLE}(rowid, {columns}) VALUES (new.id, {values});
+        END
+        """,
+    ))
+
+
+def fill_index_columns(conn):
+    """حساب أعمدة الظل من الأعمدة المصدرية (تُكتب فقط الصفوف التي تغيرت قيمها)"""
+    update_sql = (
+        "UPDATE books SET " + ', '.join(f"{column} = ?" for column in INDEX_COLUMNS) +
+        " WHERE id = ? AND (" + ' OR '.join(f"{column} IS NOT ?" for column in INDEX_COLUMNS) + ")"
+    )
+
+    changed = 0
+    last_id = 0
+    while True:
+        rows = conn.execute(f"""
+            SELECT id, {', '.join(SOURCE_COLUMNS)} FROM books WHERE id > ? ORDER BY id LIMIT ?
+        """, (last_id, _INDEX_BATCH)).fetchall()
+        if not rows:
+            return changed
+
+        for row in rows:
+            values = index_values(dict(zip(SOURCE_COLUMNS, row[1:])))
+            changed += conn.execute(update_sql, values + [row[0]] + values).rowcount
+        last_id = rows[-1][0]
+
+
+def create_version_schema(conn):
+    """جدول رقم إصدار الفهرس ومشغلات زيادته عند أي تغيير في جدول الكتب"""
+    _execute_all(conn, (
+        f"""
+        CREATE TABLE IF NOT EXISTS {VERSION_TABLE} (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL
+        )
+        """,
+        f"INSERT OR IGNORE INTO {VERSION_TABLE} (id, version) VALUES (1, 0)",
+    ) + tuple(
+        f"""
+        CREATE TRIGGER IF NOT EXISTS {VERSION_TABLE}_{suffix} AFTER {event} ON books BEGIN
+            UPDATE {VERSION_TABLE} SET version = version + 1 WHERE id = 1;
+        END
+        """
+        for suffix, event in (('ai', 'INSERT'), ('ad', 'DELETE'), ('au', 'UPDATE'))
+    ))
+
+
+# السنوات حتى HIJRI_MAX هجرية، وما بعدها حتى GREGORIAN_MAX ميلادية، وغير ذلك قيمة غير صالحة
+# التحويل التقريبي: الميلادي = الهجري × 0.970229 + 621.5643
+_YEAR_NUMBER = "CAST(year AS REAL)"
+_YEAR_HIJRI_SQL = f"""CASE
+    WHEN {_YEAR_NUMBER} BETWEEN 1 AND {HIJRI_MAX} THEN CAST({_YEAR_NUMBER} AS INTEGER)
+    WHEN {_YEAR_NUMBER} BETWEEN {HIJRI_MAX + 1} AND {GREGORIAN_MAX}
+        THEN CAST(round(({_YEAR_NUMBER} - 621.5643) / 0.970229) AS INTEGER)
+END"""
+_YEAR_GREGORIAN_SQL = f"""CASE
+    WHEN {_YEAR_NUMBER} BETWEEN 1 AND {HIJRI_MAX}
+        THEN CAST(round({_YEAR_NUMBER} * 0.970229 + 621.5643) AS INTEGER)
+    WHEN {_YEAR_NUMBER} BETWEEN {HIJRI_MAX + 1} AND {GREGORIAN_MAX} THEN CAST({_YEAR_NUMBER} AS INTEGER)
+END"""
+
+
+def create_year_columns(conn):
+    """أعمدة السنة الرقمية (هجري وميلادي) محسوبة من العمود النصي year، مع فهارسها"""
+    existing = {row[1] for row in conn.execute("PRAGMA table_xinfo(books)")}
+
+    # أعمدة مولدة (VIRTUAL): تُحسب تلقائياً عند أي إضافة أو تعديل بدون مشغلات
+    if 'year_hijri' not in existing:
+        conn.execute(f"ALTER TABLE books ADD COLUMN year_hijri INTEGER GENERATED ALWAYS AS ({_YEAR_HIJRI_SQL}) VIRTUAL")
+    if 'year_gregorian' not in existing:
+        conn.execute(f"ALTER TABLE books ADD COLUMN year_gregorian INTEGER GENERATED ALWAYS AS ({_YEAR_GREGORIAN_SQL}) VIRTUAL")
+
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_year_hijri ON books(year_hijri)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_year_gregorian ON books(year_gregorian)")
+
+
+def create_indexes(conn):
+    """فهارس الاستعلامات المباشرة على جدول الكتب"""
+    # رقم السجل غير فريد في البيانات الحالية (سجلات مكررة)، لذلك الفهرس عادي وليس UNIQUE
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_record_id ON books(record_id)")
+
+
+def rebuild_fts_index(conn):
+    """إعادة حساب أعمدة الظل ثم إعادة بناء الفهرس بالكامل منها"""
+    with transaction(conn):
+        changed = fill_index_columns(conn)
+        if changed:
+            logger.info(f"تم تحديث أعمدة الظل لـ {changed:,} كتاب")
+
+        conn.execute(f"DELETE FROM {FTS_TABLE}")
+        conn.execute(f"""
+            INSERT INTO {FTS_TABLE}(rowid, {', '.join(FTS_COLUMNS)})
+            SELECT id, {', '.join(INDEX_COLUMNS)} FROM books
+        """)
+        conn.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('optimize')")
+
+    count = conn.execute(f"SELECT COUNT(*) FROM {FTS_TABLE}").fetchone()[0]
+    return count
+
+
+# الأعمدة النصية التي كانت تستخدم 'nan' بدلاً من NULL
+_SENTINEL_COLUMNS = ('title', 'author', 'publisher', 'year', 'pages', 'classification', 'subject', 'isbn', 'FULLTEXT_SEARCH')
+
+
+def replace_nan_sentinels(conn):
+    """تحويل القيمة النصية 'nan' إلى NULL في كل الأعمدة"""
+    for column in _SENTINEL_COLUMNS:
+        cursor = conn.execute(f"UPDATE books SET {column} = NULL WHERE {column} = 'nan'")
+        if cursor.rowcount:
+            logger.info(f"العمود {column}: تم تحويل {cursor.rowcount:,} قيمة 'nan' إلى NULL")
+
+
+def create_query_indexes(conn):
+    """فهارس جزئية (تغطي استعلامات الإحصائيات بالكامل) مطابقة لأشكال الاستعلامات الفعلية"""
+    _execute_all(conn, (
+        # العنوان يُبحث عبر FTS، والسنة عبر year_hijri/year_gregorian
+        "DROP INDEX IF EXISTS idx_title",
+        "DROP INDEX IF EXISTS idx_year",
+
+        # عدّ القيم المختلفة وأكثر القيم تكراراً في الإحصائيات (WHERE col IS NOT NULL)
+        "DROP INDEX IF EXISTS idx_author",
+        "DROP INDEX IF EXISTS idx_subject",
+        "CREATE INDEX idx_author ON books(author) WHERE author IS NOT NULL",
+        "CREATE INDEX idx_subject ON books(subject) WHERE subject IS NOT NULL",
+        "CREATE INDEX IF NOT EXISTS idx_publisher ON books(publisher) WHERE publisher IS NOT NULL",
+        "CREATE INDEX IF NOT EXISTS idx_classification ON books(classification) WHERE classification IS NOT NULL",
+    ))
+
+
+def create_search_index(conn):
+    """جدول فهرس البحث (يُملأ مع أعمدة الظل في create_index_columns)"""
+    create_fts_table(conn)
+
+
+def create_index_columns(conn):
+    """
+    أعمدة الظل fts_* بصيغة الفهرس، ومشغلات بدون دوال Python تنسخها إلى الفهرس
+    (المشغلات السابقة كانت تستدعي ar_index فتفشل أي كتابة من اتصال لم يسجلها)
+    """
+    existing = {row[1] for row in conn.execute("PRAGMA table_xinfo(books)")}
+    for column in INDEX_COLUMNS:
+        if column not in existing:
+            conn.execute(f"ALTER TABLE books ADD COLUMN {column} TEXT")
+
+    # حذف المشغلات القديمة قبل ملء الأعمدة حتى لا تُستدعى ar_index
+    for suffix in ('ai', 'ad', 'au'):
+        conn.execute(f"DROP TRIGGER IF EXISTS {FTS_TABLE}_{suffix}")
+    fill_index_columns(conn)
+
+    create_fts_triggers(conn)
+    conn.execute(f"DELETE FROM {FTS_TABLE}")
+    conn.execute(f"""
+        INSERT INTO {FTS_TABLE}(rowid, {', '.join(FTS_COLUMNS)})
+        SELECT id, {', '.join(INDEX_COLUMNS)} FROM books
+    """)
+    count = conn.execute(f"SELECT COUNT(*) FROM {FTS_TABLE}").fetchone()[0]
+    logger.info(f"تم بناء فهرس البحث من أعمدة الظل: {count:,} سجل")
+
+
+# الترحيلات بالترتيب: رقم إصدار القاعدة بعد الترحيل = موقعه في القائمة
+# (كل ترحيل آمن للتكرار حتى تعمل الأداة على قواعد رُحلت جزئياً قبل ترقيم الإصدارات)
+MIGRATIONS = [
+    create_search_index,
+    create_version_schema,
+    create_indexes,
+    create_year_columns,
+    replace_nan_sentinels,
+    create_query_indexes,
+    create_index_columns,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def get_schema_version(conn):
+    """إصدار مخطط قاعدة البيانات المسجل في الملف"""
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(db_path=DB_PATH, rebuild_index=False):
+    """تطبيق الترحيلات التي لم تُطبق بعد"""
+    # وضع autocommit: المعاملات صريحة (transaction) حتى يُطبق كل ترحيل كاملاً أو لا يُطبق
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    # مشغلات الفهرس في القواعد الأقدم من ترحيل create_index_columns تستدعي ar_index
+    register_functions(conn)
+
+    try:
+        # وضع WAL يسمح للبوت بالقراءة أثناء الكتابة، ويبقى محفوظاً في الملف
+        conn.execute("PRAGMA journal_mode = WAL")
+
+        version = get_schema_version(conn)
+        if version > SCHEMA_VERSION:
+            raise RuntimeError(f"إصدار قاعدة البيانات ({version}) أحدث من هذه الأداة ({SCHEMA_VERSION})")
+
+        for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            logger.info(f"تطبيق الترحيل {number}: {migration.__name__}")
+            with transaction(conn):
+                migration(conn)
+                conn.execute(f"PRAGMA user_version = {number}")
+
+        if rebuild_index and version > 0:
+            count = rebuild_fts_index(conn)
+            logger.info(f"تمت إعادة بناء فهرس البحث: {count:,} سجل")
+
+        if version < SCHEMA_VERSION:
+            # تحديث إحصائيات المخطط ليختار SQLite الفهارس الصحيحة
+            conn.execute("ANALYZE")
+            logger.info(f"قاعدة البيانات محدثة إلى الإصدار {SCHEMA_VERSION}")
+        else:
+            logger.info(f"قاعدة البيانات محدثة بالفعل (الإصدار {SCHEMA_VERSION})")
+
+    finally:
+        conn.close()
+
+
+def main():
+    """تشغيل أداة الترحيل"""
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+
+    parser = argparse.ArgumentParser(description="ترحيل قاعدة بيانات المكتبة")
+    parser.add_argument('db_path', nargs='?', default=DB_PATH, help="مسار ملف قاعدة البيانات")
+    parser.add_argument('--rebuild-index', action='store_true', help="إعادة بناء فهرس البحث بالكامل")
+    args = parser.parse_args()
+
+    migrate(args.db_path, rebuild_index=args.rebuild_index)
+
+
+if __name__ == '__main__':
+    main()
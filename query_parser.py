@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""
+فهم نص السؤال قبل البحث: نية السؤال (إحصائيات، رقم سجل، بحث) وحقوله (المؤلف، الموضوع، السنة)
+كل العبارات المعروفة (كلمات الحشو، علامات الحقول، أسئلة الإحصائيات) في شجرة كلمات واحدة
+تُقرأ بمرور واحد على كلمات السؤال بأطول تطابق، بدون تعابير نمطية متتالية
+"""
+
+import re
+import functools
+from collections import namedtuple
+
+from arabic_text import normalize_arabic
+from search_index import build_fielded_match, parse_year_range, search_books_page, search_year_page
+from metrics import timed
+
+# عبارات أسئلة الإحصائيات
+STATS_PHRASES = (
+    'كم عدد', 'كم كتاب', 'عدد الكتب', 'إجمالي', 'الإجمالي',
+    'كم مخطوطة', 'عدد المخطوطات', 'كم العناوين', 'عدد العناوين',
+    'كم مؤلف', 'عدد المؤلفين', 'احصائيات', 'إحصاء',
+    'عطني احصائية', 'اعطني احصائية', 'احصائية', 'الاحصائيات', 'الاحصائية',
+    'عطني معلومات', 'اعطني معلومات', 'معلومات عامة',
+    'كم لديك', 'كم عندك', 'ماذا لديك', 'ماذا عندك',
+    'وش عندك', 'ايش عندك', 'شو عندك', 'كم فيه', 'كم موجود',
+    'ملخص', 'نظرة عامة', 'تقرير', 'عدد السجلات',
+)
+
+# كلمات الحشو التي تُحذف من نص البحث
+STOPWORDS = (
+    'ابحث', 'ابحث لي', 'ابحث لي عن', 'ابحث عن', 'بحث عن', 'ابغى', 'ابغي', 'ابي', 'اريد', 'احتاج',
+    'اعطني', 'عطني', 'هات', 'لي', 'عن', 'في', 'من', 'حول', 'او', 'مع',
+    'هل', 'هل يوجد', 'هل توجد', 'هل عندك', 'هل لديك', 'يوجد', 'توجد', 'عندك', 'لديك', 'عندكم', 'لديكم',
+    'ما', 'ما هي', 'ما هو', 'ماهي', 'ماهو', 'اين', 'وين', 'اي',
+    'كتب', 'كتاب', 'الكتب', 'كتابا', 'الكتاب',
+    'المتوفرة', 'المتوفر', 'متوفر', 'متوفرة', 'المتاحة', 'الموجودة',
+    'في المكتبة', 'بالمكتبة', 'من فضلك', 'لو سمحت', 'فضلا',
+    # لاحقة السنة: 1400 هـ، 1980 م
+    'هـ', 'م',
+)
+
+# علامات الحقول: الكلمات التالية لها قيمة الحقل حتى العلامة التالية أو كلمة حشو
+AUTHOR_MARKERS = (
+    'المؤلف', 'للمؤلف', 'لمؤلف', 'مؤلفات', 'مؤلفها', 'مؤلفه', 'تاليف', 'بقلم',
+    'للشيخ', 'للامام', 'للعلامة', 'للدكتور', 'كتب الشيخ', 'كتب الامام',
+)
+SUBJECT_MARKERS = (
+    'موضوع', 'الموضوع', 'في موضوع', 'عن موضوع', 'بموضوع', 'مجال', 'في مجال',
+)
+YEAR_MARKERS = (
+    'سنة', 'سنه', 'عام', 'في سنة', 'في عام', 'صدرت سنة', 'صدرت عام', 'صادرة سنة', 'طبعة سنة', 'طبعت سنة',
+    'من سنة', 'من عام', 'بين سنة', 'بين عام', 'بين', 'خلال',
+)
+RECORD_MARKERS = (
+    'رقم السجل', 'سجل رقم', 'السجل رقم', 'السجل', 'سجل', 'رقم', 'record',
+)
+
+# كلمات الربط بين سنتين في المدى
+_RANGE_WORDS = {'الي', 'حتي', 'و', 'لغايه', '-'}
+
+# الكلمات، ومدى السنوات (1390-1400) والسنوات بالنجمة (14xx) ككلمة واحدة، والأرقام منفصلة عن الحروف (1400هـ)
+_TOKEN_RE = re.compile(r'\d{1,4}\s*[-–—]\s*\d{1,4}|\d{1,3}[x*?؟]+|\d+|[^\W\d_]+|-', re.UNICODE)
+
+_END = None
+
+
+class ParsedQuery(namedtuple('ParsedQuery', 'intent text author subject year_range record_id')):
+    """نتيجة التحليل: intent = 'stats' أو 'record' أو 'search'، والحقول نصوص موحدة أو None"""
+    __slots__ = ()
+
+    @property
+    def structured(self):
+        """هل في السؤال حقول محددة (وليس نص بحث حر فقط)"""
+        return bool(self.author or self.subject or self.year_range)
+
+    def canonical(self):
+        """نص يُحلَّل إلى نفس النتيجة (لحفظ البحث وإعادته، مثلاً بعد تصحيح الكلمات)"""
+        parts = [self.text] if self.text else []
+        if self.author:
+            parts += [AUTHOR_MARKERS[0], self.author]
+        if self.subject:
+            parts += [SUBJECT_MARKERS[0], self.subject]
+        if self.year_range:
+            _, first, last = self.year_range
+            parts += [YEAR_MARKERS[0], str(first) if first == last else f'{first}-{last}']
+        return ' '.join(parts)
+
+
+def _phrase_words(phrase):
+    return _TOKEN_RE.findall(normalize_arabic(phrase))
+
+
+def _build_trie():
+    """شجرة الكلمات: كل عقدة قاموس {كلمة: عقدة}، ونهاية العبارة نوعها تحت المفتاح _END"""
+    trie = {}
+    groups = (
+        ('stop', STOPWORDS), ('stats', STATS_PHRASES), ('author', AUTHOR_MARKERS),
+        ('subject', SUBJECT_MARKERS), ('year', YEAR_MARKERS), ('record', RECORD_MARKERS),
+    )
+    for kind, phrases in groups:
+        for phrase in phrases:
+            node = trie
+            for word in _phrase_words(phrase):
+                node = node.setdefault(word, {})
+            # عبارة في أكثر من مجموعة: الأخيرة (الأكثر تحديداً) أولى
+            node[_END] = kind
+    return trie
+
+
+_TRIE = _build_trie()
+
+
+def _longest_match(tokens, start):
+    """أطول عبارة معروفة تبدأ من الموضع start: (النوع، موضع النهاية) أو (None، start)"""
+    node = _TRIE
+    kind, end = None, start
+    for i in range(start, len(tokens)):
+        node = node.get(tokens[i])
+        if node is None:
+            break
+        if _END in node:
+            kind, end = node[_END], i + 1
+    return kind, end
+
+
+def _read_year(tokens, i):
+    """قراءة سنة أو مدى سنوات من الموضع i: (المدى، الموضع التالي) أو (None، i)"""
+    if i >= len(tokens):
+        return None, i
+
+    first = tokens[i]
+    # "1390 الى 1400" أو "1390 و 1400" (مع تكرار "سنة" اختيارياً)
+    j = i + 1
+    if first.isdigit() and j < len(tokens) and tokens[j] in _RANGE_WORDS:
+        j += 1
+        kind, after_marker = _longest_match(tokens, j)
+        if kind == 'year':
+            j = after_marker
+        if j < len(tokens) and tokens[j].isdigit():
+            year_range = parse_year_range(f'{first}-{tokens[j]}')
+            if year_range is not None:
+                return year_range, j + 1
+
+    year_range = parse_year_range(first)
+    return (year_range, i + 1) if year_range is not None else (None, i)
+
+
+@timed('parse')
+@functools.lru_cache(maxsize=4096)
+def parse_query(text):
+    """تحليل نص السؤال إلى ParsedQuery"""
+    tokens = _TOKEN_RE.findall(normalize_arabic(text))
+    slots = {'text': [], 'author': [], 'subject': []}
+    intent = 'search'
+    year_range = None
+    record_id = None
+    stripped = False
+
+    slot = 'text'
+    i = 0
+    while i < len(tokens):
+        kind, end = _longest_match(tokens, i)
+
+        if kind is None:
+            token = tokens[i]
+            # مدى سنوات أو سنة بالنجمة بدون علامة (الرقم المجرد يبقى نصاً، قد يكون رقم سجل)
+            if token[0].isdigit() and not token.isdigit() and parse_year_range(token) is not None:
+                year_range = parse_year_range(token)
+                slot = 'text'
+            elif token != '-':
+                slots[slot].append(token)
+            i += 1
+            continue
+
+        if kind == 'stats':
+            intent = 'stats'
+            i = end
+            continue
+
+        if kind in ('author', 'subject'):
+            slot = kind
+            i = end
+            continue
+
+        if kind == 'year':
+            found, next_i = _read_year(tokens, end)
+            if found is not None:
+                year_range = found
+                slot = 'text'
+                i = next_i
+                continue
+            if tokens[i] == 'بين':
+                # "بين" ليست علامة سنة إذا لم تتبعها سنة
+                kind = 'stop'
+
+        if kind == 'record' and end < len(tokens) and tokens[end].isdigit():
+            if record_id is None:
+                record_id = tokens[end]
+            i = end + 1
+            continue
+
+        # كلمة حشو (أو علامة بدون قيمة): تنهي الحقل الحالي
+        stripped = True
+        slot = 'text'
+        i = end
+
+    if intent != 'stats' and record_id is not None:
+        intent = 'record'
+
+    values = {name: ' '.join(words) or None for name, words in slots.items()}
+    if stripped and not values['text'] and not (values['author'] or values['subject'] or year_range):
+        # السؤال كله كلمات حشو ("كتب"): يُبحث بنصه كما هو
+        values['text'] = ' '.join(token for token in tokens if token != '-') or None
+
+    return ParsedQuery(intent, values['text'], values['author'], values['subject'], year_range, record_id)
+
+
+def search_parsed_page(cursor, parsed, fields, limit=10, after=None, backward=False):
+    """
+    صفحة نتائج لسؤال محلل: النص الحر في كل الحقول، والمؤلف والموضوع في أعمدتهما (FTS)
+    والسنة على عمود السنة المفهرس؛ بنفس صيغة صفوف search_books_page
+    """
+    match = build_fielded_match((
+        (parsed.text, None),
+        (parsed.author, ['author']),
+        (parsed.subject, ['subject']),
+    ))
+
+    if match is None:
+        if parsed.year_range is None:
+            return [], False
+        return search_year_page(cursor, parsed.year_range, fields, limit=limit, after=after, backward=backward)
+
+    return search_books_page(
+        cursor, None, fields, limit=limit, after=after, backward=backward,
+        match=match, year_range=parsed.year_range,
+    )
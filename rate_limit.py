@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+حماية البوت من الإغراق: حد معدل لكل مستخدم ولكل محادثة (دلو الرموز)
+ودمج الرسائل المتتابعة السريعة من نفس المستخدم في بحث واحد
+كل الحالة في حلقة الأحداث نفسها، فلا حاجة لأقفال
+"""
+
+import os
+import time
+import asyncio
+import logging
+import functools
+from collections import OrderedDict
+
+from metrics import register_collector
+
+logger = logging.getLogger(__name__)
+
+# حد المستخدم: عدد البحوث في الدقيقة، وأقصى دفعة متتالية
+RATE_USER_PER_MINUTE = float(os.getenv("RATE_USER_PER_MINUTE", "20"))
+RATE_USER_BURST = float(os.getenv("RATE_USER_BURST", "5"))
+# حد المحادثة (المجموعات): لكل أعضاء المحادثة معاً
+RATE_CHAT_PER_MINUTE = float(os.getenv("RATE_CHAT_PER_MINUTE", "60"))
+RATE_CHAT_BURST = float(os.getenv("RATE_CHAT_BURST", "15"))
+# مدة انتظار الرسائل المتتابعة قبل دمجها في بحث واحد بالثواني (0 لتعطيل الدمج)
+DEBOUNCE_SECONDS = float(os.getenv("DEBOUNCE_SECONDS", "0.4"))
+# أقصى طول لنص البحث بعد الدمج
+MAX_MERGED_LENGTH = 300
+
+# أقصى عدد مفاتيح محفوظة (الأقدم استخداماً يُحذف ويبدأ من جديد بدلو ممتلئ)
+_MAX_KEYS = 10000
+# لا نكرر رسالة التنبيه لنفس المستخدم أكثر من مرة خلال هذه المدة
+_WARN_INTERVAL = 30.0
+
+SLOW_DOWN_TEXT = "⏳ طلبات كثيرة خلال وقت قصير، الرجاء الانتظار قليلاً ثم المحاولة مرة أخرى."
+
+
+class RateLimiter:
+    """دلو رموز لكل مفتاح: يمتلئ بمعدل ثابت ويُخصم منه رمز لكل طلب"""
+
+    def __init__(self, per_minute, burst, max_keys=_MAX_KEYS):
+        self.rate = per_minute / 60.0
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+
+    def allow(self, key, now=None):
+        """خصم رمز إن وُجد، وإلا False"""
+        now = time.monotonic() if now is None else now
+        tokens, updated = self._buckets.pop(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+
+        self._buckets[key] = (tokens, now)
+        if len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+        return allowed
+
+    def reserve(self, key, now=None):
+        """حجز رمز وإرجاع مدة الانتظار بالثواني حتى يحين دوره (الرصيد قد يصبح سالباً)"""
+        now = time.monotonic() if now is None else now
+        tokens, updated = self._buckets.pop(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate) - 1
+
+        self._buckets[key] = (tokens, now)
+        if len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+        return 0.0 if tokens >= 0 else -tokens / self.rate
+
+
+class MessageGate:
+    """بوابة أمام معالجات البحث: حد المعدل ودمج الرسائل المتتابعة"""
+
+    def __init__(self, user_limiter, chat_limiter, debounce=DEBOUNCE_SECONDS):
+        self.user_limiter = user_limiter
+        self.chat_limiter = chat_limiter
+        self.debounce = debounce
+        self.limited = 0
+        self.merged = 0
+        self._bursts = {}
+        self._warned = OrderedDict()
+
+    async def allow(self, update):
+        """التحقق من حد المستخدم والمحادثة، مع رد تنبيه مختصر عند التجاوز"""
+        user_id = update.effective_user.id if update.effective_user else None
+        chat_id = update.effective_chat.id if update.effective_chat else None
+
+        # المحادثة الخاصة هي المستخدم نفسه، فيكفي حد المستخدم
+        allowed = self.user_limiter.allow(user_id)
+        if allowed and chat_id != user_id:
+            allowed = self.chat_limiter.allow(chat_id)
+        if allowed:
+            return True
+
+        self.limited += 1
+        now = time.monotonic()
+        if self._warned.get(user_id, float('-inf')) + _WARN_INTERVAL <= now:
+            self._warned.pop(user_id, None)
+            self._warned[user_id] = now
+            if len(self._warned) > _MAX_KEYS:
+                self._warned.popitem(last=False)
+            await update.effective_message.reply_text(SLOW_DOWN_TEXT)
+
+        logger.info(f"تم تجاوز حد الطلبات: المستخدم {user_id} في المحادثة {chat_id}")
+        return False
+
+    def debounced(self, handler):
+        """مزخرف لمعالج الرسائل النصية: المعالج يستقبل نص البحث المدمج وسيطاً ثالثاً"""
+        @functools.wraps(handler)
+        async def wrapper(update, context):
+            text = (update.effective_message.text or '').strip()
+            user_id = update.effective_user.id if update.effective_user else None
+            key = (update.effective_chat.id, user_id)
+
+            burst = self._bursts.get(key)
+            if burst is not None:
+                # رسالة ضمن دفعة جارية: تُضاف إليها بدون بحث أو خصم رمز
+                burst.append(text)
+                self.merged += 1
+                return
+
+            if not await self.allow(update):
+                return
+
+            if not self.debounce:
+                await handler(update, context, text)
+                return
+
+            # الانتظار يتم في مهمة مستقلة حتى لا يمنع وصول بقية رسائل المحادثة
+            self._bursts[key] = [text]
+            context.application.create_task(self._flush(key, handler, update, context), update=update)
+
+        return wrapper
+
+    async def _flush(self, key, handler, update, context):
+        """تنفيذ بحث واحد بالرسائل المجمعة بعد انتهاء مدة الانتظار (الرد على أول رسالة)"""
+        try:
+            await asyncio.sleep(self.debounce)
+        finally:
+            texts = self._bursts.pop(key)
+
+        # حذف المكرر مع الحفاظ على الترتيب
+        query = ' '.join(dict.fromkeys(text for text in texts if text))[:MAX_MERGED_LENGTH].strip()
+        await handler(update, context, query)
+
+
+message_gate = MessageGate(
+    RateLimiter(RATE_USER_PER_MINUTE, RATE_USER_BURST),
+    RateLimiter(RATE_CHAT_PER_MINUTE, RATE_CHAT_BURST),
+)
+
+
+@register_collector
+def gate_metrics():
+    """عدادات بوابة الرسائل لخادم المقاييس"""
+    return [
+        ('bot_rate_limited_total', 'counter', "الرسائل المرفوضة بحد الطلبات", [({}, message_gate.limited)]),
+        ('bot_messages_merged_total', 'counter', "الرسائل المدمجة في بحث سابق", [({}, message_gate.merged)]),
+    ]
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+ذاكرة مؤقتة لنتائج البحث (LRU مع مدة صلاحية)
+المفتاح: نص البحث بعد توحيد الحروف والمسافات + اسم دالة البحث ووسائطها (نوع البحث، الحد الأقصى...)
+الأخطاء لا تُحفظ: الاستثناء يصل إلى المستدعي كما هو
+تُفرغ تلقائياً عند تغير رقم إصدار الفهرس (أي عند تحديث قاعدة البيانات) أو استبدال ملفها
+"""
+
+import os
+import time
+import logging
+import threading
+import functools
+from collections import OrderedDict
+
+from arabic_text import tokenize, normalize_arabic
+from library_db import get_cursor, add_reload_listener, note_cache_lookup
+from library_stats import get_catalog_version
+from metrics import register_collector
+
+logger = logging.getLogger(__name__)
+
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "2048"))
+RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL", "600"))
+# أقصى مدة بالثواني قبل التحقق من رقم إصدار الفهرس مرة أخرى
+RESULT_CACHE_VERSION_CHECK = float(os.getenv("RESULT_CACHE_VERSION_CHECK", "5"))
+
+
+class ResultCache:
+    """ذاكرة مؤقتة محدودة الحجم، آمنة للاستخدام من عدة خيوط"""
+
+    def __init__(self, maxsize=RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL,
+                 version_check_interval=RESULT_CACHE_VERSION_CHECK):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.version_check_interval = version_check_interval
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = None
+        self._version_checked_at = float('-inf')
+
+    def get(self, key):
+        """إرجاع (True, القيمة) إذا وُجدت وصالحة، وإلا (False, None)"""
+        with self._lock:
+            entry = self._data.get(key)
+
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return True, value
+                del self._data[key]
+
+            self.misses += 1
+            return False, None
+
+    def put(self, key, value):
+        """حفظ قيمة مع حذف الأقدم استخداماً عند امتلاء الذاكرة"""
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        """إفراغ الذاكرة المؤقتة"""
+        with self._lock:
+            self._data.clear()
+
+    def reset(self):
+        """إفراغ الذاكرة ونسيان رقم الإصدار (بعد استبدال ملف قاعدة البيانات)"""
+        with self._lock:
+            self._data.clear()
+            self._version = None
+            self._version_checked_at = float('-inf')
+
+    def check_version(self):
+        """إفراغ الذاكرة إذا تغير رقم إصدار الفهرس (يُفحص مرة كل فترة فقط)"""
+        now = time.monotonic()
+        if now - self._version_checked_at < self.version_check_interval:
+            return
+
+        self._version_checked_at = now
+        version = get_catalog_version(get_cursor())
+
+        if version != self._version:
+            if self._version is not None:
+                logger.info(f"تغيرت قاعدة البيانات (الإصدار {version})، تم إفراغ ذاكرة النتائج")
+            self.clear()
+            self._version = version
+
+    def info(self):
+        """عدادات الإصابة والإخفاق وحجم الذاكرة الحالي"""
+        with self._lock:
+            size = len(self._data)
+
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'size': size,
+            'maxsize': self.maxsize,
+        }
+
+    def cached(self, func):
+        """مزخرف لدوال البحث: الوسيط الأول هو نص البحث"""
+        @functools.wraps(func)
+        def wrapper(query, *args, **kwargs):
+            self.check_version()
+
+            # النص الموحد كاملاً وليس كلماته فقط: "140*" و"140" و"1390-1400" بحوث مختلفة
+            key = (func.__name__, ' '.join(normalize_arabic(query).split()), args, tuple(sorted(kwargs.items())))
+            found, value = self.get(key)
+            note_cache_lookup(found)
+            if found:
+                return value
+
+            value = func(query, *args, **kwargs)
+            self.put(key, value)
+            return value
+
+        return wrapper
+
+
+class PrefixCache(ResultCache):
+    """نتائج كاملة (غير مقطوعة) لنصوص البحث، يُخدم منها أي بحث أطول يبدأ بنفس النص
+
+    كل كلمة بحث تطابق بداية كلمة في الكتاب، فإطالة الكلمات أو إضافة كلمات تعطي
+    جزءاً من النتائج السابقة، يُصفّى في الذاكرة بدلاً من قاعدة البيانات
+    (مناسب للاستعلامات المضمنة التي تُرسل مع كل حرف يكتبه المستخدم)
+    """
+
+    def store(self, query, rows, texts):
+        """حفظ نتائج كاملة لنص بحث، texts(row) تعيد النصوص المفهرسة للكتاب"""
+        entries = [(frozenset(word for text in texts(row) for word in tokenize(text)), row) for row in rows]
+        self.put(normalize_arabic(query).strip(), (tokenize(query), entries))
+
+    def lookup(self, query):
+        """نتائج البحث مصفاة من أطول نص محفوظ يبدأ به، أو None"""
+        self.check_version()
+
+        text = normalize_arabic(query).strip()
+        words = tokenize(text)
+        now = time.monotonic()
+
+        with self._lock:
+            for end in range(len(text), 0, -1):
+                entry = self._data.get(text[:end])
+                if entry is None or entry[0] <= now:
+                    continue
+
+                cached_words, entries = entry[1]
+                # التجذيع قد يغير الكلمة أثناء الكتابة، فنتأكد أن كل كلمة محفوظة بداية لكلمة في البحث الجديد
+                if all(any(word.startswith(cached) for word in words) for cached in cached_words):
+                    self._data.move_to_end(text[:end])
+                    self.hits += 1
+                    break
+            else:
+                self.misses += 1
+                note_cache_lookup(False)
+                return None
+
+        note_cache_lookup(True)
+
+        return [
+            row for tokens, row in entries
+            if all(any(token.startswith(word) for token in tokens) for word in words)
+        ]
+
+
+# ذاكرة مشتركة لكل دوال البحث في البوت
+search_cache = ResultCache()
+cached_search = search_cache.cached
+add_reload_listener(search_cache.reset)
+
+# ذاكرة البادئات للاستعلامات المضمنة
+prefix_cache = PrefixCache()
+add_reload_listener(prefix_cache.reset)
+
+
+@register_collector
+def cache_metrics():
+    """عدادات الذاكرتين لخادم المقاييس"""
+    infos = {'search': search_cache.info(), 'prefix': prefix_cache.info()}
+    return [
+        ('bot_result_cache_hits_total', 'counter', "إصابات ذاكرة النتائج",
+         [({'cache': name}, info['hits']) for name, info in infos.items()]),
+        ('bot_result_cache_misses_total', 'counter', "إخفاقات ذاكرة النتائج",
+         [({'cache': name}, info['misses']) for name, info in infos.items()]),
+        ('bot_result_cache_entries', 'gauge', "عدد النتائج المحفوظة",
+         [({'cache': name}, info['size']) for name, info in infos.items()]),
+    ]
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""
+فهرس البحث النصي الكامل (FTS5) لجدول الكتب، وتحليل نصوص البحث (الكلمات والسنوات)
+يُستخدم من البوتين بدلاً من LIKE '%...%' التي تمسح الجدول كاملاً
+النصوص مخزنة في الفهرس بعد التوحيد والتجذيع (arabic_text.index_text)، ويحسبها التطبيق عند الكتابة
+في أعمدة ظل بجدول الكتب تنسخها المشغلات إلى الفهرس (فلا تحتاج الكتابة دوال Python داخل SQLite)
+"""
+
+import re
+
+from arabic_text import tokenize, normalize_arabic, index_text
+
+# اسم جدول الفهرس وأعمدته (بنفس ترتيب الإنشاء في migrate_db.py)
+FTS_TABLE = 'books_fts'
+FTS_COLUMNS = ('record_id', 'title', 'author', 'publisher', 'subject', 'classification', 'fulltext')
+
+# عمود جدول الكتب المصدري لكل عمود في الفهرس
+SOURCE_COLUMNS = ('record_id', 'title', 'author', 'publisher', 'subject', 'classification', 'FULLTEXT_SEARCH')
+# أعمدة الظل في جدول الكتب: النص المصدري بصيغة الفهرس (يملؤها كل من يكتب في جدول الكتب)
+INDEX_COLUMNS = tuple(f'fts_{column}' for column in FTS_COLUMNS)
+
+def index_values(book):
+    """قيم أعمدة الظل لكتاب (قاموس بأسماء أعمدة جدول الكتب)، بترتيب INDEX_COLUMNS"""
+    return [index_text(book.get(column)) for column in SOURCE_COLUMNS]
+
+
+# أوزان الحقول في ترتيب النتائج: العنوان > المؤلف > الموضوع > الناشر > التصنيف
+# النص الكامل يكرر الحقول السابقة لذلك وزنه منخفض
+FIELD_WEIGHTS = {
+    'record_id': 1.0,
+    'title': 10.0,
+    'author': 8.0,
+    'subject': 4.0,
+    'publisher': 2.0,
+    'classification': 1.5,
+    'fulltext': 0.5,
+}
+
+# دالة الترتيب الممررة إلى FTS5 (الأوزان بنفس ترتيب الأعمدة)
+RANK_FUNCTION = 'bm25(' + ', '.join(str(FIELD_WEIGHTS[column]) for column in FTS_COLUMNS) + ')'
+
+
+# السنوات حتى 1500 هجرية، وما بعدها حتى 2100 ميلادية (نفس حدود عمودي year_hijri و year_gregorian)
+HIJRI_MAX = 1500
+GREGORIAN_MAX = 2100
+
+_YEAR_RANGE_RE = re.compile(r'^(\d{1,4})\s*[-–—]\s*(\d{1,4})$')
+_YEAR_WILDCARD_RE = re.compile(r'^(\d{1,3})([x*?؟]+)$', re.IGNORECASE)
+
+
+def parse_year_range(text):
+    """
+    تحويل نص السنة إلى (العمود، من، إلى)
+    أمثلة: "1400"، "1390-1400"، "14xx" (1400-1499)، "139x" (1390-1399)
+    السنوات بعد 1500 تُعامل كميلادية، وإلا فهي هجرية
+    """
+    text = normalize_arabic(text).strip()
+
+    match = _YEAR_RANGE_RE.match(text)
+    if match:
+        first, last = sorted((int(match.group(1)), int(match.group(2))))
+    elif text.isdigit():
+        first = last = int(text)
+    else:
+        match = _YEAR_WILDCARD_RE.match(text)
+        if not match or len(match.group(1)) + len(match.group(2)) != 4:
+            return None
+        width = 10 ** len(match.group(2))
+        first = int(match.group(1)) * width
+        last = first + width - 1
+
+    if first < 1 or last > GREGORIAN_MAX:
+        return None
+
+    column = 'year_gregorian' if first > HIJRI_MAX else 'year_hijri'
+    return column, first, last
+
+
+def build_match_query(text, columns=None, prefix=True, match_any=False):
+    """تحويل نص المستخدم إلى تعبير MATCH آمن (كل الكلمات مطلوبة بأي ترتيب، أو أي منها)"""
+    # نفس التوحيد والتجذيع المستخدم عند الفهرسة
+    words = tokenize(text)
+    if not words:
+        return None
+
+    star = '*' if prefix else ''
+    operator = ' OR ' if match_any else ' AND '
+    expr = operator.join(f'"{word}"{star}' for word in dict.fromkeys(words))
+
+    if columns:
+        expr = '{' + ' '.join(columns) + '} : (' + expr + ')'
+
+    return expr
+
+
+def search_books(cursor, text, fields, columns=None, limit=10, distinct=False, match_any=False):
+    """بحث مرتب حسب الصلة (bm25 بأوزان الحقول) وإرجاع الحقول المطلوبة من جدول الكتب"""
+    match = build_match_query(text, columns, match_any=match_any)
+    if match is None:
+        return []
+
+    select = ', '.join(f'b.{field}' for field in fields)
+    cursor.execute(f"""
+        SELECT {'DISTINCT ' if distinct else ''}{select}
+        FROM {FTS_TABLE}
+        JOIN books b ON b.id = {FTS_TABLE}.rowid
+        WHERE {FTS_TABLE} MATCH ? AND rank MATCH ?
+        ORDER BY rank
+        LIMIT ?
+    """, (match, RANK_FUNCTION, limit))
+
+    return cursor.fetchall()
+
+
+def build_fielded_match(parts):
+    """تعبير MATCH يتطلب كل الأجزاء معاً؛ parts: قائمة (النص، الأعمدة أو None لكل الأعمدة)"""
+    matches = [build_match_query(text, columns) for text, columns in parts if text]
+    matches = [match for match in matches if match]
+    return ' AND '.join(matches) if matches else None
+
+
+def search_books_page(cursor, text, fields, columns=None, limit=10, after=None, backward=False, match_any=False,
+                      match=None, year_range=None):
+    """
+    صفحة من نتائج البحث بمؤشر المفتاح (الترتيب، رقم الصف) بدلاً من OFFSET
+    after: مؤشر آخر صف في الصفحة السابقة (أو أول صف إذا backward)
+    match: تعبير MATCH جاهز بدلاً من النص، year_range: (العمود، من، إلى) لتقييد السنة
+    تُرجع (الصفوف، يوجد_المزيد)؛ كل صف = الحقول المطلوبة + (الترتيب، رقم الصف)
+    """
+    if match is None:
+        match = build_match_query(text, columns, match_any=match_any)
+    if match is None:
+        return [], False
+
+    select = ', '.join(f'b.{field}' for field in fields)
+    params = [match, RANK_FUNCTION]
+    keyset = ''
+
+    if year_range is not None:
+        column, first, last = year_range
+        keyset = f"AND b.{column} BETWEEN ? AND ?"
+        params.extend((first, last))
+
+    if after is not None:
+        keyset += f" AND (rank, {FTS_TABLE}.rowid) {'<' if backward else '>'} (?, ?)"
+        params.extend(after)
+
+    order = 'DESC' if backward else 'ASC'
+    params.append(limit + 1)
+
+    cursor.execute(f"""
+        SELECT {select}, rank, {FTS_TABLE}.rowid
+        FROM {FTS_TABLE}
+        JOIN books b ON b.id = {FTS_TABLE}.rowid
+        WHERE {FTS_TABLE} MATCH ? AND rank MATCH ? {keyset}
+        ORDER BY rank {order}, {FTS_TABLE}.rowid {order}
+        LIMIT ?
+    """, params)
+
+    rows = cursor.fetchall()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    if backward:
+        rows.reverse()
+
+    return rows, has_more
+
+
+def search_year_page(cursor, year_range, fields, limit=10, after=None, backward=False):
+    """
+    صفحة من الكتب في مدى سنوات عبر فهرس عمود السنة الرقمي
+    مؤشر المفتاح (السنة، رقم الصف)؛ كل صف = الحقول المطلوبة + (السنة، رقم الصف)
+    """
+    column, first, last = year_range
+
+    keyset = ''
+    params = [first, last]
+    if after is not None:
+        keyset = f"AND ({column}, id) {'<' if backward else '>'} (?, ?)"
+        params.extend(after)
+    order = 'DESC' if backward else 'ASC'
+    params.append(limit + 1)
+
+    cursor.execute(f"""
+        SELECT {', '.join(fields)}, {column}, id
+        FROM books
+        WHERE {column} BETWEEN ? AND ? {keyset}
+        ORDER BY {column} {order}, id {order}
+        LIMIT ?
+    """, params)
+
+    rows = cursor.fetchall()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    if backward:
+        rows.reverse()
+
+    return rows, has_more
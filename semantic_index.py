@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+الفهرس الدلالي للكتب (TF-IDF مضغوط بـ LSA)
+يُبنى مسبقاً من جدول الكتب ويُحفظ مصفوفات NumPy، ويُقرأ عند البحث بالذاكرة المعينة (mmap)
+فيجد الكتب القريبة من معنى السؤال وإن لم تتطابق كلماته حرفياً
+بعد تعديل الفهرس يبقى الفهرس الدلالي مستخدماً: تُستبعد الكتب التي تغيرت حقولها منذ بنائه (ببصمة لكل كتاب)
+والكتب الجديدة لا تظهر فيه حتى يُعاد بناؤه
+NumPy اختيارية: بدونها (أو بدون ملفات الفهرس) يعمل البحث بالكلمات فقط
+
+الاستخدام (بعد كل استيراد كبير للفهرس):
+    python semantic_index.py
+    python semantic_index.py --db library.db --out semantic_index --dims 128
+"""
+
+import os
+import json
+import math
+import hashlib
+import bisect
+import logging
+import argparse
+import threading
+from collections import Counter
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from arabic_text import tokenize
+from library_db import add_reload_listener
+from library_stats import get_catalog_version
+from search_index import search_books
+
+logger = logging.getLogger(__name__)
+
+SEMANTIC_INDEX_DIR = os.getenv("SEMANTIC_INDEX_DIR", "semantic_index")
+
+# عدد أبعاد المتجهات بعد الضغط
+DIMENSIONS = 128
+# أوزان الحقول في متجه الكتاب
+FIELD_WEIGHTS = {'title': 2.0, 'author': 2.0, 'subject': 1.0, 'publisher': 0.5}
+# أقل تشابه (جيب التمام) لقبول الكتاب كنتيجة
+MIN_SIMILARITY = 0.2
+# ثابت دمج الترتيبين (Reciprocal Rank Fusion)
+RRF_K = 60
+# أقصى عدد كلمات في الفهرس تطابق بداية كلمة غير معروفة في السؤال
+_MAX_PREFIX_TERMS = 20
+# عدد صفوف المصفوفة المتفرقة في كل دفعة ضرب (يحد الذاكرة المؤقتة أثناء البناء)
+_BATCH_ROWS = 1024
+
+_META_FILE = 'meta.json'
+_VECTORS_FILE = 'vectors.npy'
+_PROJECTION_FILE = 'projection.npy'
+_IDF_FILE = 'idf.npy'
+_ROWIDS_FILE = 'rowids.npy'
+_FINGERPRINTS_FILE = 'fingerprints.npy'
+
+_index = None
+_index_mtime = None
+# (إصدار الفهرس الدلالي، إصدار قاعدة البيانات) لآخر تحذير من عدم التطابق
+_stale_warning = None
+_lock = threading.Lock()
+
+
+# ==================== البناء ====================
+
+def _fingerprint(row):
+    """بصمة الحقول المفهرسة للكتاب (تتغير إذا عُدّل الكتاب بعد بناء الفهرس)"""
+    text = '\x1f'.join(value or '' for value in row)
+    digest = hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little', signed=True)
+
+
+def _book_terms(row):
+    """أوزان كلمات الكتاب (مجذعة كما في فهرس البحث)"""
+    counts = Counter()
+    for field, text in zip(FIELD_WEIGHTS, row):
+        for term in tokenize(text):
+            counts[term] += FIELD_WEIGHTS[field]
+    return counts
+
+
+def _csr(rows, cols, values, row_count):
+    """مصفوفة متفرقة بصيغة CSR من أزواج (صف، عمود، قيمة): (بدايات الصفوف، الأعمدة، القيم)"""
+    order = np.argsort(rows, kind='stable')
+    indptr = np.zeros(row_count + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=row_count), out=indptr[1:])
+    return indptr, cols[order], values[order]
+
+
+def _sparse_dot(matrix, dense, batch_rows=_BATCH_ROWS):
+    """ضرب مصفوفة متفرقة (CSR) في مصفوفة كثيفة، دفعة صفوف في كل مرة"""
+    indptr, indices, data = matrix
+    row_count = len(indptr) - 1
+    result = np.zeros((row_count, dense.shape[1]), dtype=np.float64)
+
+    for start in range(0, row_count, batch_rows):
+        stop = min(start + batch_rows, row_count)
+        low, high = indptr[start], indptr[stop]
+        if low == high:
+            continue
+
+        # مجموع حواصل ضرب كل صف (الصفوف الفارغة لا تُجمع)
+        products = data[low:high, None] * dense[indices[low:high]]
+        nonempty = np.flatnonzero(indptr[start + 1:stop + 1] > indptr[start:stop])
+        result[start + nonempty] = np.add.reduceat(products, indptr[start + nonempty] - low, axis=0)
+
+    return result
+
+
+def _randomized_svd(matrix, transposed, dims, power_iterations=4, seed=0):
+    """المتجهات المفردة اليمنى الأهم (V) لمصفوفة متفرقة (CSR ومنقولها) بدون بنائها كثيفة"""
+    rng = np.random.default_rng(seed)
+    sample = rng.standard_normal((len(transposed[0]) - 1, dims + 10))
+
+    basis, _ = np.linalg.qr(_sparse_dot(matrix, sample))
+    for _ in range(power_iterations):
+        basis, _ = np.linalg.qr(_sparse_dot(transposed, basis))
+        basis, _ = np.linalg.qr(_sparse_dot(matrix, basis))
+
+    # B = Qᵀ A ثم تحليل B الصغيرة
+    small = _sparse_dot(transposed, basis).T
+    _, _, vt = np.linalg.svd(small, full_matrices=False)
+    return vt[:dims].T
+
+
+def _normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def build_semantic_index(conn, out_dir=SEMANTIC_INDEX_DIR, dims=DIMENSIONS):
+    """بناء الفهرس من جدول الكتب وحفظه في مجلد (الملف الوصفي يُكتب أخيراً)"""
+    if np is None:
+        raise RuntimeError("مكتبة numpy غير مثبتة: pip install numpy")
+
+    cursor = conn.cursor()
+    catalog_version = get_catalog_version(cursor)
+
+    cursor.execute(f"SELECT id, {', '.join(FIELD_WEIGHTS)} FROM books ORDER BY id")
+    rowids = []
+    fingerprints = []
+    documents = []
+    for row in cursor:
+        rowids.append(row[0])
+        fingerprints.append(_fingerprint(row[1:]))
+        documents.append(_book_terms(row[1:]))
+
+    document_frequency = Counter()
+    for terms in documents:
+        document_frequency.update(terms.keys())
+
+    vocabulary = sorted(document_frequency)
+    term_ids = {term: i for i, term in enumerate(vocabulary)}
+    total = len(documents)
+    idf = np.array([math.log((1 + total) / (1 + document_frequency[term])) + 1 for term in vocabulary])
+
+    # TF-IDF بتكرار لوغاريتمي، وكل كتاب بطول 1
+    rows, cols, values = [], [], []
+    for i, terms in enumerate(documents):
+        weights = [(term_ids[term], (1 + math.log(count)) * idf[term_ids[term]]) for term, count in terms.items()]
+        norm = math.sqrt(sum(weight * weight for _, weight in weights)) or 1.0
+        for term_id, weight in weights:
+            rows.append(i)
+            cols.append(term_id)
+            values.append(weight / norm)
+
+    rows = np.array(rows, dtype=np.int64)
+    cols = np.array(cols, dtype=np.int64)
+    values = np.array(values)
+    matrix = _csr(rows, cols, values, total)
+    transposed = _csr(cols, rows, values, len(vocabulary))
+    dims = min(dims, total, len(vocabulary))
+
+    projection = _randomized_svd(matrix, transposed, dims)
+    vectors = _normalize_rows(_sparse_dot(matrix, projection))
+
+    os.makedirs(out_dir, exist_ok=True)
+    for name, array in ((_VECTORS_FILE, vectors), (_PROJECTION_FILE, projection),
+                        (_IDF_FILE, idf), (_ROWIDS_FILE, np.array(rowids, dtype=np.int64)),
+                        (_FINGERPRINTS_FILE, np.array(fingerprints, dtype=np.int64))):
+        path = os.path.join(out_dir, name)
+        with open(path + '.tmp', 'wb') as f:
+            np.save(f, array.astype(np.float32) if array.dtype == np.float64 else array)
+        os.replace(path + '.tmp', path)
+
+    meta = {'catalog_version': catalog_version, 'dimensions': dims, 'vocabulary': vocabulary}
+    meta_path = os.path.join(out_dir, _META_FILE)
+    with open(meta_path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False)
+    os.replace(meta_path + '.tmp', meta_path)
+
+    logger.info(f"تم بناء الفهرس الدلالي: {total:,} كتاب، {len(vocabulary):,} كلمة، {dims} بعد")
+    return total
+
+
+# ==================== البحث ====================
+
+class SemanticIndex:
+    """الفهرس المحمل: متجهات الكتب بالذاكرة المعينة ومصفوفة إسقاط كلمات السؤال"""
+
+    def __init__(self, path):
+        with open(os.path.join(path, _META_FILE), encoding='utf-8') as f:
+            meta = json.load(f)
+
+        self.catalog_version = meta['catalog_version']
+        self.vocabulary = meta['vocabulary']
+        self.vectors = np.load(os.path.join(path, _VECTORS_FILE), mmap_mode='r')
+        self.projection = np.load(os.path.join(path, _PROJECTION_FILE), mmap_mode='r')
+        self.idf = np.load(os.path.join(path, _IDF_FILE))
+        self.rowids = np.load(os.path.join(path, _ROWIDS_FILE))
+        # الفهارس المبنية قبل إضافة البصمات لا يمكن التحقق من كتبها
+        fingerprints_path = os.path.join(path, _FINGERPRINTS_FILE)
+        self.fingerprints = np.load(fingerprints_path) if os.path.exists(fingerprints_path) else None
+
+    def _term_ids(self, term):
+        """رقم الكلمة في الفهرس، أو أرقام الكلمات التي تبدأ بها (مثل البحث بالبادئة)"""
+        i = bisect.bisect_left(self.vocabulary, term)
+        if i < len(self.vocabulary) and self.vocabulary[i] == term:
+            return [i]
+
+        ids = []
+        while i < len(self.vocabulary) and len(ids) < _MAX_PREFIX_TERMS and self.vocabulary[i].startswith(term):
+            ids.append(i)
+            i += 1
+        return ids
+
+    def query_vector(self, text):
+        """متجه السؤال في نفس فضاء الكتب، أو None إذا لم تُعرف أي كلمة منه"""
+        vector = np.zeros(self.projection.shape[1], dtype=np.float32)
+        for term, count in Counter(tokenize(text)).items():
+            ids = self._term_ids(term)
+            if ids:
+                weight = (1 + math.log(count)) / len(ids)
+                vector += (weight * self.idf[ids, None] * self.projection[ids]).sum(axis=0)
+
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else None
+
+    def search(self, text, limit=15, min_similarity=MIN_SIMILARITY):
+        """أرقام صفوف أقرب الكتب للسؤال مرتبة حسب التشابه"""
+        vector = self.query_vector(text)
+        if vector is None:
+            return []
+
+        scores = self.vectors @ vector
+        limit = min(limit, len(scores))
+        if not limit:
+            return []
+
+        top = np.argpartition(-scores, limit - 1)[:limit]
+        top = top[np.argsort(-scores[top])]
+        return [int(self.rowids[i]) for i in top if scores[i] >= min_similarity]
+
+
+    def unchanged(self, cursor, rowids):
+        """الكتب التي لم تتغير حقولها المفهرسة منذ بناء الفهرس (المعدلة والمحذوفة تُستبعد)"""
+        if not rowids:
+            return []
+
+        cursor.execute(
+            f"SELECT id, {', '.join(FIELD_WEIGHTS)} FROM books WHERE id IN ({', '.join('?' for _ in rowids)})",
+            rowids
+        )
+        current = {row[0]: _fingerprint(row[1:]) for row in cursor.fetchall()}
+        positions = np.searchsorted(self.rowids, rowids)
+        return [rowid for rowid, i in zip(rowids, positions) if current.get(rowid) == int(self.fingerprints[i])]
+
+
+def get_semantic_index(path=SEMANTIC_INDEX_DIR):
+    """الفهرس المحمل، ويُعاد تحميله إذا أُعيد بناؤه؛ None إذا لم يُبنَ أو لم تُثبت numpy"""
+    global _index, _index_mtime
+
+    if np is None:
+        return None
+
+    try:
+        mtime = os.stat(os.path.join(path, _META_FILE)).st_mtime_ns
+    except OSError:
+        return None
+
+    if _index is not None and mtime == _index_mtime:
+        return _index
+
+    with _lock:
+        if _index is None or mtime != _index_mtime:
+            try:
+                _index = SemanticIndex(path)
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning(f"تعذر تحميل الفهرس الدلالي: {e}")
+                return None
+            _index_mtime = mtime
+            logger.info(f"تم تحميل الفهرس الدلالي: {len(_index.rowids):,} كتاب")
+
+    return _index
+
+
+def semantic_search(cursor, text, limit=15):
+    """أرقام صفوف الكتب الأقرب دلالياً (قائمة فارغة بدون فهرس)
+
+    إذا بُني الفهرس لإصدار أقدم تُستبعد الكتب التي تغيرت أو حُذفت بعده فقط
+    """
+    global _stale_warning
+
+    index = get_semantic_index()
+    if index is None:
+        return []
+
+    catalog_version = get_catalog_version(cursor)
+    if index.catalog_version == catalog_version:
+        return index.search(text, limit)
+
+    stale = (index.catalog_version, catalog_version)
+    if index.fingerprints is None:
+        if _stale_warning != stale:
+            _stale_warning = stale
+            logger.warning(
+                f"الفهرس الدلالي للإصدار {index.catalog_version} والفهرس الحالي {catalog_version}، "
+                f"وهو بدون بصمات للتحقق من الكتب: البحث الدلالي متوقف حتى يُعاد بناؤه بـ semantic_index.py"
+            )
+        return []
+
+    if _stale_warning != stale:
+        _stale_warning = stale
+        logger.warning(
+            f"الفهرس الدلالي للإصدار {index.catalog_version} والفهرس الحالي {catalog_version}: "
+            f"تُستبعد الكتب المعدلة بعده، والكتب الجديدة لا تظهر حتى يُعاد بناؤه بـ semantic_index.py"
+        )
+
+    # طلب نتائج إضافية لتعويض الكتب المستبعدة
+    return index.unchanged(cursor, index.search(text, limit * 2))[:limit]
+
+
+def reset_semantic_index():
+    """نسيان الفهرس المحمل (بعد استبدال ملف قاعدة البيانات يُعاد تحميله عند أول بحث)"""
+    global _index, _index_mtime
+
+    with _lock:
+        _index = None
+        _index_mtime = None
+
+
+add_reload_listener(reset_semantic_index)
+
+
+def hybrid_search(cursor, text, fields, limit=15):
+    """
+    دمج نتائج البحث بالكلمات ونتائج البحث الدلالي بترتيب RRF
+    البحث بالكلمات: كل الكلمات أولاً، ثم أي كلمة إذا لم تكفِ النتائج (الأسئلة الطبيعية نادراً ما تطابق كاملة)
+    """
+    keyword = [row[0] for row in search_books(cursor, text, ('id',), limit=limit)]
+    if len(keyword) < limit:
+        seen = set(keyword)
+        for (rowid,) in search_books(cursor, text, ('id',), limit=limit, match_any=True):
+            if rowid not in seen:
+                keyword.append(rowid)
+                seen.add(rowid)
+
+    scores = Counter()
+    for ranking in (keyword[:limit], semantic_search(cursor, text, limit)):
+        for rank, rowid in enumerate(ranking):
+            scores[rowid] += 1.0 / (RRF_K + rank + 1)
+
+    rowids = [rowid for rowid, _ in scores.most_common(limit)]
+    if not rowids:
+        return []
+
+    cursor.execute(
+        f"SELECT id, {', '.join(fields)} FROM books WHERE id IN ({', '.join('?' for _ in rowids)})",
+        rowids
+    )
+    rows = {row[0]: row[1:] for row in cursor.fetchall()}
+    return [rows[rowid] for rowid in rowids if rowid in rows]
+
+
+def main():
+    """بناء الفهرس الدلالي من سطر الأوامر"""
+    import sqlite3
+
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+
+    parser = argparse.ArgumentParser(description="بناء الفهرس الدلالي للكتب")
+    parser.add_argument('--db', default=os.getenv("LIBRARY_DB_PATH", "library.db"), help="مسار قاعدة البيانات")
+    parser.add_argument('--out', default=SEMANTIC_INDEX_DIR, help="مجلد ملفات الفهرس")
+    parser.add_argument('--dims', type=int, default=DIMENSIONS, help="عدد أبعاد المتجهات")
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(f"file:{args.db}?mode=ro", uri=True)
+    try:
+        build_semantic_index(conn, args.out, args.dims)
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
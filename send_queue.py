@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+جدولة الرسائل الصادرة إلى تليجرام
+- FloodControlLimiter: يوزع الطلبات حسب حدود تليجرام (عام، ولكل محادثة) ويعيد المحاولة بعد RetryAfter
+- PendingReply: رد واحد لكل طلب، رسالة الانتظار لا تُرسل إلا إذا تأخر العمل ثم تُعدّل بالنتيجة
+  (أو بالنتيجة الجزئية تدريجياً، مثل إجابة تُكتب أثناء وصولها)
+"""
+
+import os
+import time
+import asyncio
+import logging
+
+from telegram.error import BadRequest, RetryAfter, TelegramError
+from telegram.ext import BaseRateLimiter
+
+from rate_limit import RateLimiter
+from metrics import Counter, STAGE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# حدود تليجرام: نحو 30 رسالة في الثانية للبوت، ورسالة في الثانية للمحادثة، و20 في الدقيقة للمجموعة
+SEND_GLOBAL_PER_SECOND = float(os.getenv("SEND_GLOBAL_PER_SECOND", "30"))
+SEND_CHAT_PER_MINUTE = float(os.getenv("SEND_CHAT_PER_MINUTE", "60"))
+SEND_GROUP_PER_MINUTE = float(os.getenv("SEND_GROUP_PER_MINUTE", "20"))
+# عدد الطلبات المسموح بها دفعة واحدة قبل بدء التوزيع
+SEND_CHAT_BURST = 3
+# عدد مرات إعادة المحاولة بعد رد 429
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", "3"))
+
+# مدة الانتظار قبل إرسال رسالة "جاري البحث" (النتائج الأسرع تُرسل مباشرة في رسالة واحدة)
+PLACEHOLDER_DELAY = float(os.getenv("PLACEHOLDER_DELAY", "0.5"))
+# أقل مدة بين تعديلين للنتيجة الجزئية (تليجرام يحد تعديلات المحادثة الواحدة)
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))
+# حد طول رسالة تليجرام
+MESSAGE_LIMIT = 4096
+
+SEND_RETRIES = Counter('bot_send_retries_total', "إعادة إرسال الطلبات بعد رد 429 من تليجرام", ('endpoint',))
+
+
+def _seconds(retry_after):
+    """مدة RetryAfter بالثواني (رقم أو timedelta حسب إصدار المكتبة)"""
+    return retry_after.total_seconds() if hasattr(retry_after, 'total_seconds') else float(retry_after)
+
+
+class FloodControlLimiter(BaseRateLimiter):
+    """محدد معدل لطلبات Bot API: الطلبات الموجهة لمحادثة تنتظر دورها بدلاً من رفضها بـ 429"""
+
+    def __init__(self, global_per_second=SEND_GLOBAL_PER_SECOND, chat_per_minute=SEND_CHAT_PER_MINUTE,
+                 group_per_minute=SEND_GROUP_PER_MINUTE, max_retries=SEND_MAX_RETRIES):
+        self.max_retries = max_retries
+        self.retries = 0
+        self._global = RateLimiter(global_per_second * 60, global_per_second)
+        self._chats = RateLimiter(chat_per_minute, SEND_CHAT_BURST)
+        self._groups = RateLimiter(group_per_minute, SEND_CHAT_BURST)
+        self._paused_until = 0.0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def _wait_turn(self, chat_id):
+        """انتظار دور الطلب في الحد العام وحد المحادثة، وأي إيقاف مؤقت طلبه تليجرام"""
+        now = time.monotonic()
+        chats = self._groups if isinstance(chat_id, int) and chat_id < 0 else self._chats
+        delay = max(self._global.reserve(None, now), chats.reserve(chat_id, now), self._paused_until - now)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get('chat_id')
+        if chat_id is None:
+            # طلبات لا تُرسل رسائل (getUpdates، answerCallbackQuery...) لا تخضع للتوزيع
+            if endpoint == 'getUpdates':
+                # الاستطلاع الطويل ينتظر التحديثات عمداً، فلا يُحسب زمنه
+                return await callback(*args, **kwargs)
+            with STAGE_SECONDS.time(stage='send', operation=endpoint):
+                return await callback(*args, **kwargs)
+
+        if isinstance(chat_id, str) and chat_id.lstrip('-').isdigit():
+            chat_id = int(chat_id)
+
+        attempt = 0
+        while True:
+            with STAGE_SECONDS.time(stage='send_wait', operation=endpoint):
+                await self._wait_turn(chat_id)
+            try:
+                with STAGE_SECONDS.time(stage='send', operation=endpoint):
+                    return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+
+                # إيقاف كل الإرسال حتى انتهاء المدة، كما يطلب تليجرام
+                delay = _seconds(e.retry_after)
+                self._paused_until = max(self._paused_until, time.monotonic() + delay)
+                self.retries += 1
+                SEND_RETRIES.inc(endpoint=endpoint)
+                logger.warning(f"تجاوز حد الإرسال ({endpoint})، إعادة المحاولة بعد {delay:.0f} ث")
+
+
+class PendingReply:
+    """رد على رسالة في رسالة واحدة قدر الإمكان
+
+    رسالة الانتظار تُرسل فقط إذا لم تكتمل النتيجة خلال PLACEHOLDER_DELAY،
+    وعندها تُعدّل بالنتيجة بدلاً من إرسال رسالة جديدة
+    """
+
+    def __init__(self, message, text, delay=PLACEHOLDER_DELAY, edit_interval=STREAM_EDIT_INTERVAL, **kwargs):
+        self.message = message
+        self.text = text
+        self.delay = delay
+        self.edit_interval = edit_interval
+        self.kwargs = kwargs
+        self._placeholder = None
+        self._sending = False
+        self._task = None
+        self._shown = None
+        self._last_update = float('-inf')
+
+    async def __aenter__(self):
+        self._task = asyncio.create_task(self._send_placeholder())
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._settle()
+
+    async def _send_placeholder(self):
+        await asyncio.sleep(self.delay)
+        self._sending = True
+        self._placeholder = await self.message.reply_text(self.text, **self.kwargs)
+
+    async def _settle(self):
+        """إلغاء رسالة الانتظار إن لم تُرسل بعد، أو انتظار اكتمال إرسالها"""
+        task, self._task = self._task, None
+        if task is None:
+            return
+
+        if not self._sending:
+            task.cancel()
+            return
+
+        try:
+            await task
+        except Exception as e:
+            logger.warning(f"تعذر إرسال رسالة الانتظار: {e}")
+
+    async def update(self, text, **kwargs):
+        """
+        عرض نتيجة جزئية في نفس الرسالة (أول جزء يحل مكان رسالة الانتظار)
+        التحديثات الأسرع من edit_interval تُتجاهل، والنتيجة النهائية تُرسل بـ send
+        """
+        now = time.monotonic()
+        if now - self._last_update < self.edit_interval:
+            return
+
+        text = text[:MESSAGE_LIMIT]
+        if text == self._shown:
+            return
+        self._last_update = now
+
+        await self._settle()
+        try:
+            if self._placeholder is None:
+                self._placeholder = await self.message.reply_text(text, **kwargs)
+            else:
+                await self._placeholder.edit_text(text, **kwargs)
+            self._shown = text
+        except TelegramError as e:
+            # التحديث الجزئي ليس ضرورياً: النتيجة النهائية تُرسل على أي حال
+            logger.warning(f"تعذر تحديث الرد الجزئي: {e}")
+
+    async def send(self, text, **kwargs):
+        """إرسال النتيجة: تعديل رسالة الانتظار إن أُرسلت، وإلا رد جديد"""
+        await self._settle()
+
+        if self._placeholder is not None:
+            placeholder, self._placeholder = self._placeholder, None
+            if text == self._shown:
+                return placeholder
+            try:
+                return await placeholder.edit_text(text, **kwargs)
+            except BadRequest as e:
+                if 'not modified' not in str(e).lower():
+                    raise
+                return placeholder
+
+        return await self.message.reply_text(text, **kwargs)
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+اقتراحات التصحيح الإملائي ("هل تقصد")
+قاموس كلمات العناوين والمؤلفين والموضوعات مع فهرس حذف (على طريقة SymSpell)
+فتصحيح كلمة خاطئة بحث واحد في الذاكرة بدلاً من عدة بحوث فاشلة في قاعدة البيانات
+عند تغير الفهرس يُعاد بناء القاموس في الخلفية، ويبقى القاموس السابق مستخدماً حتى يكتمل الجديد
+"""
+
+import os
+import time
+import bisect
+import logging
+import threading
+from collections import Counter, defaultdict
+
+from arabic_text import light_stem, split_words
+from library_db import add_reload_listener, get_cursor, submit_db
+from library_stats import get_catalog_version
+
+logger = logging.getLogger(__name__)
+
+# الحقول التي تُبنى منها كلمات القاموس
+VOCABULARY_COLUMNS = ('title', 'author', 'subject')
+
+# أقصى مسافة تعديل، والكلمات الأقصر من هذا الطول تُصحح بتعديل واحد فقط
+MAX_EDIT_DISTANCE = 2
+_SHORT_WORD = 5
+# الكلمات الأقصر من هذا لا تُصحح
+_MIN_WORD = 3
+
+# أقل مدة بالثواني بين إعادتي بناء للقاموس (الاستيراد بدفعات يغير الإصدار مرات متتالية)
+SPELLING_REBUILD_INTERVAL = float(os.getenv("SPELLING_REBUILD_INTERVAL", "60"))
+
+_index = None
+_index_version = None
+_building = False
+_last_build = float('-inf')
+_lock = threading.Lock()
+
+
+def _deletes(word, distance):
+    """كل الصيغ الناتجة عن حذف حتى distance حرف من الكلمة"""
+    results = {word}
+    current = {word}
+    for _ in range(distance):
+        current = {w[:i] + w[i + 1:] for w in current for i in range(len(w))}
+        results |= current
+    return results
+
+
+def edit_distance(a, b):
+    """مسافة التعديل مع اعتبار تبديل حرفين متجاورين تعديلاً واحداً"""
+    previous2 = None
+    previous = list(range(len(b) + 1))
+
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        previous2, previous = previous, current
+
+    return previous[len(b)]
+
+
+class SpellingIndex:
+    """قاموس الكلمات المكتوبة (بعد التوحيد) مع عددها، وكلماتها المجذعة كما في فهرس البحث"""
+
+    def __init__(self, words):
+        """words: عدّاد الكلمات بعد التوحيد"""
+        self.counts = Counter(words)
+        self.sorted_terms = sorted({light_stem(word) for word in self.counts})
+
+        self.deletes = defaultdict(list)
+        for word in self.counts:
+            if len(word) >= _MIN_WORD and not word.isdigit():
+                for variant in _deletes(word, MAX_EDIT_DISTANCE):
+                    self.deletes[variant].append(word)
+
+    def is_known(self, word):
+        """الكلمة المجذعة موجودة أو بداية لكلمة موجودة (البحث يطابق بدايات الكلمات)"""
+        term = light_stem(word)
+        i = bisect.bisect_left(self.sorted_terms, term)
+        return i < len(self.sorted_terms) and self.sorted_terms[i].startswith(term)
+
+    def suggest(self, word):
+        """أقرب كلمة في القاموس (الأقل تعديلاً ثم الأكثر تكراراً)، أو None"""
+        max_distance = 1 if len(word) < _SHORT_WORD else MAX_EDIT_DISTANCE
+
+        candidates = set()
+        for variant in _deletes(word, max_distance):
+            candidates.update(self.deletes.get(variant, ()))
+
+        best = None
+        for candidate in candidates:
+            distance = edit_distance(word, candidate)
+            if distance <= max_distance:
+                key = (distance, -self.counts[candidate])
+                if best is None or key < best[0]:
+                    best = (key, candidate)
+
+        return best[1] if best else None
+
+    def correct(self, text):
+        """النص بعد تصحيح الكلمات غير المعروفة، أو None إذا لم يتغير شيء"""
+        corrected = []
+        changed = False
+
+        for word in split_words(text):
+            if len(word) >= _MIN_WORD and not word.isdigit() and not self.is_known(word):
+                suggestion = self.suggest(word)
+                if suggestion is not None:
+                    word = suggestion
+                    changed = True
+            corrected.append(word)
+
+        return ' '.join(corrected) if changed else None
+
+
+def build_spelling_index(cursor):
+    """بناء القاموس من جدول الكتب"""
+    words = Counter()
+    cursor.execute(f"SELECT {', '.join(VOCABULARY_COLUMNS)} FROM books")
+    for row in cursor:
+        for text in row:
+            if text:
+                words.update(split_words(text))
+    return SpellingIndex(words)
+
+
+def _rebuild_spelling_index():
+    """بناء قاموس جديد على خيط قاعدة بيانات في الخلفية ثم استبدال القديم به"""
+    global _index, _index_version, _building
+
+    try:
+        cursor = get_cursor()
+        # الإصدار قبل القراءة: أي تغيير أثناء البناء يظهر كإصدار أحدث فيُعاد البناء لاحقاً
+        version = get_catalog_version(cursor)
+        index = build_spelling_index(cursor)
+        with _lock:
+            _index = index
+            _index_version = version
+        logger.info(f"تم بناء قاموس التصحيح: {len(index.counts):,} كلمة (الإصدار {version})")
+    except Exception as e:
+        logger.error(f"تعذر إعادة بناء قاموس التصحيح: {e}")
+    finally:
+        with _lock:
+            _building = False
+
+
+def get_spelling_index(cursor):
+    """القاموس من الذاكرة؛ عند تغير رقم إصدار الفهرس يُعاد بناؤه في الخلفية ويُرجع القاموس الحالي"""
+    global _index, _index_version, _building, _last_build
+
+    version = get_catalog_version(cursor)
+    if _index is not None and version == _index_version:
+        return _index
+
+    with _lock:
+        if _index is None:
+            # أول بناء (عند التشغيل): لا يوجد قاموس سابق يُستخدم أثناء الانتظار
+            _index = build_spelling_index(cursor)
+            _index_version = version
+            _last_build = time.monotonic()
+            logger.info(f"تم بناء قاموس التصحيح: {len(_index.counts):,} كلمة (الإصدار {version})")
+            return _index
+
+        now = time.monotonic()
+        if version != _index_version and not _building and now - _last_build >= SPELLING_REBUILD_INTERVAL:
+            _building = True
+            _last_build = now
+            submit_db(_rebuild_spelling_index)
+
+        return _index
+
+
+def reset_spelling_index():
+    """بعد استبدال ملف قاعدة البيانات: القاموس الحالي قديم، فيُعاد بناؤه في الخلفية عند أول طلب"""
+    global _index_version, _last_build
+
+    with _lock:
+        _index_version = None
+        _last_build = float('-inf')
+
+
+add_reload_listener(reset_spelling_index)
+
+
+def suggest_query(cursor, text):
+    """نص بحث مصحح أو None"""
+    return get_spelling_index(cursor).correct(text)
@@ -5,11 +5,26 @@
 يبحث في قاعدة بيانات المكتبة ويجيب على الأسئلة
 """
 
-import sqlite3
 import logging
 import os
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
+import sqlite3
+import hashlib
+from collections import OrderedDict
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InlineQueryResultArticle, InputTextMessageContent
+from telegram.ext import CommandHandler, MessageHandler, CallbackQueryHandler, InlineQueryHandler, filters, ContextTypes
+
+from search_index import search_books_page, search_year_page, parse_year_range
+from query_parser import parse_query, search_parsed_page
+from arabic_text import normalize_arabic
+from library_db import get_connection, get_cursor, close_all, run_db, watch_for_reload
+from migrate_db import SCHEMA_VERSION, get_schema_version
+from library_stats import get_stats_snapshot
+from result_cache import cached_search, prefix_cache
+from bot_runner import application_builder, run_bot, error_handler
+from rate_limit import message_gate
+from send_queue import PendingReply
+from spelling import suggest_query, get_spelling_index
+from metrics import track_handler, timed, EMPTY_RESULTS
 
 # إعداد السجلات
 logging.basicConfig(
@@ -18,83 +33,86 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# اتصال قاعدة البيانات
-DB_PATH = 'library.db'
-
-def search_database(query, search_type='all', limit=10):
-    """البحث في قاعدة البيانات"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    results = []
-    
-    try:
-        if search_type == 'title':
-            cursor.execute("""
-                SELECT record_id, title, author, publisher, year, classification
-                FROM books 
-                WHERE title LIKE ? 
-                LIMIT ?
-            """, (f'%{query}%', limit))
-        
-        elif search_type == 'author':
-            cursor.execute("""
-                SELECT record_id, title, author, publisher, year, classification
-                FROM books 
-                WHERE author LIKE ? 
-                LIMIT ?
-            """, (f'%{query}%', limit))
-        
-        elif search_type == 'subject':
-            cursor.execute("""
-                SELECT record_id, title, author, publisher, year, subject
-                FROM books 
-                WHERE subject LIKE ? 
-                LIMIT ?
-            """, (f'%{query}%', limit))
+# التوكن من المتغيرات البيئية (آمن للرفع على GitHub)
+TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+
+# عدد التحديثات التي تُعالج بالتوازي (حتى لا يوقف بحث بطيء بقية المحادثات)
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "32"))
+
+# الحقول المعروضة في نتائج البحث
+RESULT_FIELDS = ('record_id', 'title', 'author', 'publisher', 'year', 'classification')
+SUBJECT_RESULT_FIELDS = ('record_id', 'title', 'author', 'publisher', 'year', 'subject')
+FULL_BOOK_FIELDS = ('record_id', 'title', 'author', 'publisher', 'year', 'pages', 'classification', 'subject', 'isbn')
+
+# أعمدة الفهرس لكل نوع بحث (None = كل الحقول)
+SEARCH_COLUMNS = {'title': ['title'], 'author': ['author'], 'subject': ['subject']}
+
+# عدد النتائج في الصفحة، وأقصى طول لنص الصفحة (حد تليجرام 4096 حرف)
+PAGE_SIZE = 10
+PAGE_TEXT_LIMIT = 3500
+
+# الاستعلامات المضمنة (@bot نص): عدد النتائج في كل دفعة، ومدة احتفاظ تليجرام بها، وأقصى مدة للاستعلام
+INLINE_RESULTS = 25
+INLINE_CACHE_TIME = int(os.getenv("INLINE_CACHE_TIME", "300"))
+INLINE_QUERY_TIMEOUT = 1.0
+# حقول الكتاب + النص الكامل (لتصفية النتائج المحفوظة في ذاكرة البادئات)
+INLINE_FIELDS = FULL_BOOK_FIELDS + ('FULLTEXT_SEARCH',)
+
+# عمليات البحث الأخيرة: المعرف المختصر في أزرار الصفحات ← (نص البحث، نوع البحث)
+MAX_SEARCH_SESSIONS = 10000
+_search_sessions = OrderedDict()
+
+@cached_search
+def search_database(query, search_type='all', after=None, backward=False, limit=PAGE_SIZE):
+    """
+    البحث في قاعدة البيانات: صفحة واحدة تبدأ بعد المؤشر after (الترتيب، رقم الصف)
+    تُرجع (النتائج، يوجد_المزيد)؛ أخطاء قاعدة البيانات (مثل تجاوز المهلة) تصل إلى المستدعي
+    ولا تُحفظ في الذاكرة المؤقتة كنتيجة فارغة
+    """
+    cursor = get_cursor()
+    
+    if search_type == 'year':
+        year_range = parse_year_range(query)
+        if year_range is None:
+            return [], False
         
-        elif search_type == 'year':
-            cursor.execute("""
-                SELECT record_id, title, author, publisher, year, classification
-                FROM books 
-                WHERE year = ? 
-                LIMIT ?
-            """, (query, limit))
-        
-        else:  # بحث شامل
-            cursor.execute("""
-                SELECT record_id, title, author, publisher, year, classification
-                FROM books 
-                WHERE FULLTEXT_SEARCH LIKE ? 
-                LIMIT ?
-            """, (f'%{query}%', limit))
-        
-        results = cursor.fetchall()
-    
-    except Exception as e:
-        logger.error(f"خطأ في البحث: {e}")
-    
-    finally:
-        conn.close()
-    
-    return results
+        # مؤشر المفتاح (السنة، رقم الصف) على فهرس عمود السنة الرقمي
+        return search_year_page(cursor, year_range, RESULT_FIELDS, limit=limit, after=after, backward=backward)
+    
+    if search_type == 'parsed':
+        # سؤال محلل إلى حقول (المؤلف، الموضوع، السنة) في استعلام مفهرس واحد
+        return search_parsed_page(
+            cursor, parse_query(query), RESULT_FIELDS, limit=limit, after=after, backward=backward,
+        )
+    
+    fields = SUBJECT_RESULT_FIELDS if search_type == 'subject' else RESULT_FIELDS
+    
+    # 'all': كل الكلمات في أي حقل، 'any': أي كلمة (بحث أكثر مرونة)
+    return search_books_page(
+        cursor, query, fields,
+        columns=SEARCH_COLUMNS.get(search_type),
+        limit=limit,
+        after=after,
+        backward=backward,
+        match_any=(search_type == 'any'),
+    )
 
 def format_result(book):
     """تنسيق نتيجة البحث"""
     record_id, title, author, publisher, year, extra = book
     
-    text = f"📖 **{title}**\n\n"
+    text = f"📖 **{title or 'بدون عنوان'}**\n\n"
     
-    if author and author != 'nan':
+    if author:
         text += f"✍️ المؤلف: {author}\n"
     
-    if publisher and publisher != 'nan':
+    if publisher:
         text += f"🏢 الناشر: {publisher}\n"
     
-    if year and year != 'nan':
+    if year:
         text += f"📅 السنة: {year}\n"
     
-    if extra and extra != 'nan':
+    if extra:
         text += f"🔢 التصنيف: {extra}\n"
     
     text += f"🆔 رقم السجل: {record_id}\n"
@@ -103,6 +121,7 @@ def format_result(book):
     return text
 
 # أوامر البوت
+@track_handler
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """رسالة الترحيب"""
     welcome_text = """
@@ -117,6 +136,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 📖 /title - بحث بالعنوان
 📑 /subject - بحث بالموضوع
 📅 /year - بحث بالسنة
+🆔 /id - بحث برقم السجل
 📊 /stats - إحصائيات المكتبة
 ❓ /help - المساعدة
 
@@ -127,6 +147,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await update.message.reply_text(welcome_text, parse_mode='Markdown')
 
+@track_handler
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """المساعدة"""
     help_text = """
@@ -143,7 +164,8 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 /author اسم المؤلف
 /title عنوان الكتاب
 /subject الموضوع
-/year 1400
+/year 1400 (أو مدى: /year 1390-1400 ، أو عقد/قرن: /year 139x ، /year 14xx)
+/id 511 (أو /id 51* لكل الأرقام التي تبدأ بـ 51)
 
 **3️⃣ أمثلة:**
 - /author السيوطي
@@ -156,43 +178,34 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await update.message.reply_text(help_text, parse_mode='Markdown')
 
+def format_dated_book(book):
+    """(العنوان، السنة) لأقدم أو أحدث كتاب؛ العنوان قد يكون NULL، ولا يوجد كتاب إذا لم تُعرف أي سنة"""
+    if not book:
+        return "غير معروف"
+    title, year = book
+    title = title or 'بدون عنوان'
+    return f"{title[:40]}{'...' if len(title) > 40 else ''} ({year})"
+
+@track_handler
 async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """عرض الإحصائيات"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    # إجمالي الكتب
-    cursor.execute("SELECT COUNT(*) FROM books")
-    total_books = cursor.fetchone()[0]
-    
-    # عدد المؤلفين
-    cursor.execute("SELECT COUNT(DISTINCT author) FROM books WHERE author != 'nan'")
-    total_authors = cursor.fetchone()[0]
-    
-    # أقدم كتاب
-    cursor.execute("SELECT title, year FROM books WHERE year != 'nan' ORDER BY year LIMIT 1")
-    oldest = cursor.fetchone()
-    
-    # أحدث كتاب
-    cursor.execute("SELECT title, year FROM books WHERE year != 'nan' ORDER BY year DESC LIMIT 1")
-    newest = cursor.fetchone()
-    
-    conn.close()
+    stats = await run_db(get_detailed_stats)
     
     stats_text = f"""
 📊 **إحصائيات المكتبة:**
 
-📚 إجمالي الكتب: **{total_books:,}**
-✍️ عدد المؤلفين: **{total_authors:,}**
+📚 إجمالي الكتب: **{stats['total_books']:,}**
+✍️ عدد المؤلفين: **{stats['total_authors']:,}**
 
-📅 أقدم كتاب: {oldest[0][:40]}... ({oldest[1]})
-📅 أحدث كتاب: {newest[0][:40]}... ({newest[1]})
+📅 أقدم كتاب: {format_dated_book(stats['oldest'])}
+📅 أحدث كتاب: {format_dated_book(stats['newest'])}
 
 🔍 جاهز للبحث في أي وقت!
 """
     
     await update.message.reply_text(stats_text, parse_mode='Markdown')
 
+@track_handler
 async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """أمر البحث العام"""
     if not context.args:
@@ -202,6 +215,7 @@ async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = ' '.join(context.args)
     await perform_search(update, query, 'all')
 
+@track_handler
 async def author_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """البحث بالمؤلف"""
     if not context.args:
@@ -211,6 +225,7 @@ async def author_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = ' '.join(context.args)
     await perform_search(update, query, 'author')
 
+@track_handler
 async def title_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """البحث بالعنوان"""
     if not context.args:
@@ -220,6 +235,7 @@ async def title_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = ' '.join(context.args)
     await perform_search(update, query, 'title')
 
+@track_handler
 async def subject_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """البحث بالموضوع"""
     if not context.args:
@@ -229,224 +245,318 @@ async def subject_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = ' '.join(context.args)
     await perform_search(update, query, 'subject')
 
+@track_handler
 async def year_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """البحث بالسنة"""
     if not context.args:
-        await update.message.reply_text("❌ الرجاء كتابة السنة\nمثال: /year 1400")
+        await update.message.reply_text("❌ الرجاء كتابة السنة\nمثال: /year 1400 أو /year 1390-1400 أو /year 14xx")
+        return
+    
+    query = ' '.join(context.args)
+    if parse_year_range(query) is None:
+        await update.message.reply_text("❌ صيغة السنة غير صحيحة\nأمثلة: /year 1400 ، /year 1390-1400 ، /year 14xx ، /year 139x")
         return
     
-    query = context.args[0]
     await perform_search(update, query, 'year')
 
+def remember_search(query, search_type):
+    """حفظ البحث وإرجاع معرف مختصر يناسب callback_data (حد 64 بايت)"""
+    sid = hashlib.sha1(f'{search_type}|{query}'.encode('utf-8')).hexdigest()[:10]
+    
+    _search_sessions[sid] = (query, search_type)
+    _search_sessions.move_to_end(sid)
+    while len(_search_sessions) > MAX_SEARCH_SESSIONS:
+        _search_sessions.popitem(last=False)
+    
+    return sid
+
+@timed('format')
+def render_page(sid, rows, page, has_prev, has_next):
+    """نص الصفحة وأزرار التنقل، بمؤشر المفتاح لأول وآخر نتيجة معروضة"""
+    response = f"✅ نتائج البحث (صفحة {page}):\n\n"
+    shown = []
+    
+    for book in rows:
+        entry = format_result(book[:6])
+        
+        # لا نتجاوز حد الرسالة: ما لم يُعرض يظهر في الصفحة التالية
+        if shown and len(response) + len(entry) > PAGE_TEXT_LIMIT:
+            has_next = True
+            break
+        
+        response += entry
+        shown.append(book)
+    
+    buttons = []
+    if has_prev:
+        rank, rowid = shown[0][-2:]
+        buttons.append(InlineKeyboardButton("⬅️ السابق", callback_data=f"pg|{sid}|{page - 1}|p|{rank!r}|{rowid}"))
+    if has_next:
+        rank, rowid = shown[-1][-2:]
+        buttons.append(InlineKeyboardButton("التالي ➡️", callback_data=f"pg|{sid}|{page + 1}|n|{rank!r}|{rowid}"))
+    
+    markup = InlineKeyboardMarkup([buttons]) if buttons else None
+    return response, markup
+
+async def send_first_page(reply: PendingReply, query: str, search_type: str, rows, has_more, note: str = ''):
+    """إرسال الصفحة الأولى من النتائج مع أزرار التنقل (في مكان رسالة الانتظار)"""
+    sid = remember_search(query, search_type)
+    response, markup = render_page(sid, rows, 1, False, has_more)
+    await reply.send(note + response, parse_mode='Markdown', reply_markup=markup)
+
 async def perform_search(update: Update, query: str, search_type: str):
     """تنفيذ البحث وعرض النتائج"""
-    await update.message.reply_text(f"🔍 جاري البحث عن: **{query}**...", parse_mode='Markdown')
+    if not await message_gate.allow(update):
+        return
+    
+    async with PendingReply(update.message, f"🔍 جاري البحث عن: **{query}**...", parse_mode='Markdown') as reply:
+        rows, has_more = await run_db(search_database, query, search_type)
+        
+        if not rows:
+            EMPTY_RESULTS.inc(handler='perform_search')
+            await reply.send("😔 لم أجد أي نتائج. جرب كلمات بحث أخرى.")
+            return
+        
+        await send_first_page(reply, query, search_type, rows, has_more)
+
+@track_handler
+async def page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """الانتقال بين صفحات النتائج من المؤشر المحفوظ في الزر (بدون OFFSET)"""
+    callback = update.callback_query
+    await callback.answer()
     
-    results = search_database(query, search_type, limit=10)
+    try:
+        _, sid, page, direction, rank, rowid = callback.data.split('|')
+        page, after = int(page), (float(rank), int(rowid))
+    except ValueError:
+        return
     
-    if not results:
-        await update.message.reply_text("😔 لم أجد أي نتائج. جرب كلمات بحث أخرى.")
+    session = _search_sessions.get(sid)
+    if session is None:
+        await callback.edit_message_text("⌛ انتهت صلاحية هذا البحث، الرجاء البحث مرة أخرى.")
         return
     
-    # عرض النتائج
-    response = f"✅ وجدت **{len(results)}** نتيجة:\n\n"
+    query, search_type = session
+    backward = direction == 'p'
+    rows, has_more = await run_db(search_database, query, search_type, after=after, backward=backward)
     
-    for book in results:
-        response += format_result(book)
-        
-        # تقسيم الرسائل إذا كانت طويلة
-        if len(response) > 3500:
-            await update.message.reply_text(response, parse_mode='Markdown')
-            response = ""
-    
-    if response:
-        await update.message.reply_text(response, parse_mode='Markdown')
-
-import re
-
-def detect_stats_question(query):
-    """التعرف على أسئلة الإحصائيات"""
-    # كلمات تدل على سؤال عن العدد أو الإحصائيات
-    count_keywords = [
-        'كم عدد', 'كم كتاب', 'عدد الكتب', 'إجمالي', 'اجمالي', 
-        'كم مخطوطة', 'عدد المخطوطات', 'كم العناوين', 'عدد العناوين',
-        'كم مؤلف', 'عدد المؤلفين', 'احصائيات', 'إحصائيات', 'إحصاء',
-        'عطني احصائية', 'اعطني احصائية', 'أعطني إحصائية', 'عطني إحصائية',
-        'احصائية', 'إحصائية', 'الاحصائيات', 'الإحصائيات',
-        'عطني معلومات', 'اعطني معلومات', 'معلومات عامة',
-        'كم لديك', 'كم عندك', 'ماذا لديك', 'ماذا عندك',
-        'وش عندك', 'ايش عندك', 'شو عندك', 'كم فيه', 'كم موجود',
-        'ملخص', 'نظرة عامة', 'تقرير', 'عدد السجلات'
-    ]
-    
-    for keyword in count_keywords:
-        if keyword in query:
-            return True
-    return False
-
-def extract_record_id(query):
-    """استخراج رقم السجل من النص"""
-    # البحث عن أنماط مثل: رقم السجل 123، سجل 123، رقم 123، أو مجرد رقم
-    patterns = [
-        r'رقم\s*السجل\s*[:=]?\s*(\d+)',
-        r'سجل\s*رقم\s*[:=]?\s*(\d+)',
-        r'سجل\s*[:=]?\s*(\d+)',
-        r'رقم\s*[:=]?\s*(\d+)',
-        r'السجل\s*[:=]?\s*(\d+)',
-        r'record\s*[:=]?\s*(\d+)',
-        r'^(\d+)$',  # رقم فقط
-    ]
-    
-    for pattern in patterns:
-        match = re.search(pattern, query, re.IGNORECASE)
-        if match:
-            return match.group(1)
-    return None
-
-def search_by_record_id(record_id):
-    """البحث برقم السجل"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    cursor.execute("""
-        SELECT record_id, title, author, publisher, year, pages, classification, subject, isbn
-        FROM books 
-        WHERE record_id = ? OR record_id LIKE ?
-    """, (record_id, f'%{record_id}%'))
-    
-    results = cursor.fetchall()
-    conn.close()
-    return results
-
-def flexible_search(query, limit=15):
-    """بحث مرن في جميع الحقول"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    # تنظيف وتقسيم كلمات البحث
-    words = query.strip().split()
-    
-    results = []
-    
-    # البحث في كل الحقول
-    if len(words) == 1:
-        word = words[0]
-        cursor.execute("""
-            SELECT DISTINCT record_id, title, author, publisher, year, classification
+    if not rows:
+        EMPTY_RESULTS.inc(handler='page_callback')
+        await callback.edit_message_text("😔 لا توجد نتائج أخرى.")
+        return
+    
+    if backward:
+        has_prev, has_next = has_more, True
+    else:
+        has_prev, has_next = True, has_more
+    
+    response, markup = render_page(sid, rows, max(page, 1), has_prev, has_next)
+    await callback.edit_message_text(response, parse_mode='Markdown', reply_markup=markup)
+
+@cached_search
+def search_by_record_id(record_id, prefix=False, limit=50):
+    """البحث برقم السجل: مطابقة تامة عبر الفهرس، أو (اختيارياً) كل الأرقام التي تبدأ به"""
+    cursor = get_cursor()
+    fields = ', '.join(FULL_BOOK_FIELDS)
+    
+    if prefix:
+        # مدى على فهرس idx_record_id بدلاً من LIKE '%...%'
+        cursor.execute(f"""
+            SELECT {fields}
             FROM books 
-            WHERE title LIKE ? 
-               OR author LIKE ? 
-               OR subject LIKE ?
-               OR publisher LIKE ?
-               OR classification LIKE ?
-               OR record_id LIKE ?
-               OR FULLTEXT_SEARCH LIKE ?
+            WHERE record_id >= ? AND record_id < ?
+            ORDER BY record_id
             LIMIT ?
-        """, (f'%{word}%', f'%{word}%', f'%{word}%', f'%{word}%', f'%{word}%', f'%{word}%', f'%{word}%', limit))
+        """, (record_id, record_id + '\U0010ffff', limit))
     else:
-        # بحث بعدة كلمات
-        like_pattern = '%' + '%'.join(words) + '%'
-        cursor.execute("""
-            SELECT DISTINCT record_id, title, author, publisher, year, classification
+        cursor.execute(f"""
+            SELECT {fields}
             FROM books 
-            WHERE title LIKE ? 
-               OR author LIKE ? 
-               OR FULLTEXT_SEARCH LIKE ?
-               OR (title LIKE ? AND author LIKE ?)
+            WHERE record_id = ?
             LIMIT ?
-        """, (like_pattern, like_pattern, like_pattern, f'%{words[0]}%', f'%{words[-1]}%', limit))
+        """, (record_id, limit))
     
-    results = cursor.fetchall()
-    conn.close()
-    return results
+    return cursor.fetchall()
 
 def format_full_book_info(book):
     """تنسيق معلومات الكتاب الكاملة"""
     record_id, title, author, publisher, year, pages, classification, subject, isbn = book
     
-    text = f"📖 **{title}**\n\n"
+    text = f"📖 **{title or 'بدون عنوان'}**\n\n"
     text += f"🆔 رقم السجل: {record_id}\n"
     
-    if author and author != 'nan':
+    if author:
         text += f"✍️ المؤلف: {author}\n"
     
-    if publisher and publisher != 'nan':
+    if publisher:
         text += f"🏢 الناشر: {publisher}\n"
     
-    if year and year != 'nan':
+    if year:
         text += f"📅 السنة: {year}\n"
     
-    if pages and pages != 'nan':
+    if pages:
         text += f"📄 الصفحات: {pages}\n"
     
-    if classification and classification != 'nan':
+    if classification:
         text += f"🔢 التصنيف: {classification}\n"
     
-    if subject and subject != 'nan':
+    if subject:
         subject_short = subject[:100] + "..." if len(str(subject)) > 100 else subject
         text += f"📑 الموضوع: {subject_short}\n"
     
-    if isbn and isbn != 'nan':
+    if isbn:
         text += f"📕 ISBN: {isbn}\n"
     
     text += "─" * 30 + "\n"
     return text
 
+@timed('format')
+def format_records(results):
+    """تنسيق نتائج البحث برقم السجل"""
+    response = f"✅ تم العثور على **{len(results)}** سجل:\n\n"
+    for book in results[:5]:
+        response += format_full_book_info(book)
+    return response
+
+async def show_records(update: Update, record_id: str, prefix: bool = False):
+    """البحث برقم السجل وعرض النتائج"""
+    label = f"{record_id}*" if prefix else record_id
+    async with PendingReply(update.message, f"🔍 جاري البحث عن سجل رقم: **{label}**...", parse_mode='Markdown') as reply:
+        results = await run_db(search_by_record_id, record_id, prefix=prefix)
+        
+        if results:
+            await reply.send(format_records(results), parse_mode='Markdown')
+            return
+        
+        EMPTY_RESULTS.inc(handler='show_records')
+        if prefix:
+            await reply.send(f"😔 لا توجد أرقام سجلات تبدأ بـ: {record_id}")
+        else:
+            await reply.send(
+                f"😔 لم أجد سجل برقم: {record_id}\n\n"
+                f"💡 تأكد من صحة الرقم، أو ابحث عن الأرقام التي تبدأ به: /id {record_id}*"
+            )
+
+@track_handler
+async def id_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """البحث برقم السجل: /id 511 (مطابقة تامة) أو /id 51* (كل الأرقام التي تبدأ بـ 51)"""
+    if not context.args:
+        await update.message.reply_text("❌ الرجاء كتابة رقم السجل\nمثال: /id 511 أو /id 51*")
+        return
+    
+    record_id = normalize_arabic(context.args[0])
+    prefix = record_id.endswith('*')
+    record_id = record_id.rstrip('*')
+    
+    if not record_id.isdigit():
+        await update.message.reply_text("❌ رقم السجل يجب أن يكون أرقاماً فقط\nمثال: /id 511")
+        return
+    
+    if not await message_gate.allow(update):
+        return
+    
+    await show_records(update, record_id, prefix=prefix)
+
+@cached_search
+def search_inline_page(query, after=None):
+    """دفعة من نتائج الاستعلام المضمن من الفهرس (تطابق بداية كل كلمة)"""
+    return search_books_page(get_cursor(), query, INLINE_FIELDS, limit=INLINE_RESULTS, after=after)
+
+def inline_book_texts(row):
+    """النصوص المفهرسة للكتاب بنفس أعمدة فهرس البحث"""
+    record_id, title, author, publisher, year, pages, classification, subject, isbn, fulltext = row[:10]
+    return [text for text in (record_id, title, author, publisher, subject, classification, fulltext) if text]
+
+def search_inline(query, after=None):
+    """نتائج الاستعلام المضمن: من ذاكرة البادئات إن أمكن، وإلا من الفهرس"""
+    if after is None:
+        rows = prefix_cache.lookup(query)
+        if rows is not None:
+            return rows, False
+    
+    rows, has_more = search_inline_page(query, after=after)
+    
+    if after is None and not has_more:
+        # نتائج كاملة: الأحرف التالية التي يكتبها المستخدم تُخدم من الذاكرة
+        prefix_cache.store(query, rows, inline_book_texts)
+    
+    return rows, has_more
+
+def inline_article(row):
+    """بطاقة كتاب في نتائج الاستعلام المضمن"""
+    book = row[:9]
+    record_id, title, author, publisher, year = book[:5]
+    description = ' • '.join(str(value) for value in (author, year, f"رقم السجل {record_id}") if value)
+    
+    # نص عادي بدون تنسيق: عنوان واحد فيه رمز Markdown غير مغلق يُفشل الدفعة كلها
+    message = format_full_book_info(book).replace('**', '')
+    
+    return InlineQueryResultArticle(
+        id=str(row[-1]),
+        title=title or 'بدون عنوان',
+        description=description,
+        input_message_content=InputTextMessageContent(message),
+    )
+
+@track_handler
+async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """الاستعلام المضمن: @bot نص البحث في أي محادثة"""
+    query = update.inline_query.query.strip()
+    offset = update.inline_query.offset
+    
+    if len(query) < 2:
+        await update.inline_query.answer([], cache_time=INLINE_CACHE_TIME)
+        return
+    
+    after = None
+    if offset:
+        rank, rowid = offset.split('|')
+        after = (float(rank), int(rowid))
+    
+    try:
+        rows, has_more = await run_db(search_inline, query, after, timeout=INLINE_QUERY_TIMEOUT)
+    except sqlite3.OperationalError:
+        # تجاوز المهلة: نتائج فارغة أفضل من انتظار المستخدم أثناء الكتابة
+        rows, has_more = [], False
+    
+    if not rows:
+        EMPTY_RESULTS.inc(handler='inline_query')
+    
+    next_offset = ''
+    if has_more:
+        rank, rowid = rows[-1][-2:]
+        next_offset = f"{rank!r}|{rowid}"
+    
+    await update.inline_query.answer(
+        [inline_article(row) for row in rows],
+        cache_time=INLINE_CACHE_TIME,
+        next_offset=next_offset,
+    )
+
+@cached_search
+def suggest_correction(query, search_type='all'):
+    """نص البحث بعد تصحيح الكلمات غير الموجودة في القاموس، أو None (السؤال المحلل يُصحح حقلاً حقلاً)"""
+    cursor = get_cursor()
+    if search_type != 'parsed':
+        return suggest_query(cursor, query)
+    
+    parsed = parse_query(query)
+    corrected = {}
+    for slot in ('text', 'author', 'subject'):
+        value = getattr(parsed, slot)
+        suggestion = suggest_query(cursor, value) if value else None
+        if suggestion:
+            corrected[slot] = suggestion
+    
+    return parsed._replace(**corrected).canonical() if corrected else None
+
 def get_detailed_stats():
-    """الحصول على إحصائيات تفصيلية من قاعدة البيانات"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    stats = {}
-    
-    # إجمالي الكتب/العناوين
-    cursor.execute("SELECT COUNT(*) FROM books")
-    stats['total_books'] = cursor.fetchone()[0]
-    
-    # عدد المؤلفين الفريدين
-    cursor.execute("SELECT COUNT(DISTINCT author) FROM books WHERE author != 'nan' AND author IS NOT NULL")
-    stats['total_authors'] = cursor.fetchone()[0]
-    
-    # عدد الناشرين
-    cursor.execute("SELECT COUNT(DISTINCT publisher) FROM books WHERE publisher != 'nan' AND publisher IS NOT NULL")
-    stats['total_publishers'] = cursor.fetchone()[0]
-    
-    # عدد التصنيفات
-    cursor.execute("SELECT COUNT(DISTINCT classification) FROM books WHERE classification != 'nan' AND classification IS NOT NULL")
-    stats['total_classifications'] = cursor.fetchone()[0]
-    
-    # عدد الموضوعات
-    cursor.execute("SELECT COUNT(DISTINCT subject) FROM books WHERE subject != 'nan' AND subject IS NOT NULL")
-    stats['total_subjects'] = cursor.fetchone()[0]
-    
-    # أكثر 5 مؤلفين
-    cursor.execute("""
-        SELECT author, COUNT(*) as count 
-        FROM books 
-        WHERE author != 'nan' AND author IS NOT NULL
-        GROUP BY author 
-        ORDER BY count DESC 
-        LIMIT 5
-    """)
-    stats['top_authors'] = cursor.fetchall()
-    
-    # أكثر 5 موضوعات
-    cursor.execute("""
-        SELECT subject, COUNT(*) as count 
-        FROM books 
-        WHERE subject != 'nan' AND subject IS NOT NULL
-        GROUP BY subject 
-        ORDER BY count DESC 
-        LIMIT 5
-    """)
-    stats['top_subjects'] = cursor.fetchall()
-    
-    conn.close()
-    return stats
+    """الحصول على إحصائيات تفصيلية (من اللقطة المحفوظة، تُحدث فقط عند تغير الكتب)"""
+    return get_stats_snapshot(get_cursor())
 
 async def handle_stats_question(update: Update, query: str):
     """الرد على أسئلة الإحصائيات"""
-    stats = get_detailed_stats()
+    stats = await run_db(get_detailed_stats)
     
     response = f"""📊 **إحصائيات مجمع الملك عبد العزيز**
 
@@ -461,7 +571,7 @@ async def handle_stats_question(update: Update, query: str):
     if stats['top_authors']:
         response += "🔝 **أكثر المؤلفين كتباً:**\n"
         for i, (author, count) in enumerate(stats['top_authors'][:5], 1):
-            if author and author != 'nan':
+            if author:
                 author_short = author[:40] + "..." if len(author) > 40 else author
                 response += f"   {i}. {author_short} ({count} كتاب)\n"
         response += "\n"
@@ -470,52 +580,8 @@ async def handle_stats_question(update: Update, query: str):
     
     await update.message.reply_text(response, parse_mode='Markdown')
 
-async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """معالجة الرسائل النصية العادية"""
-    query = update.message.text.strip()
-    
-    if len(query) < 2:
-        await update.message.reply_text("❌ الرجاء كتابة كلمة بحث أطول")
-        return
-    
-    # التحقق إذا كان السؤال عن إحصائيات
-    if detect_stats_question(query):
-        await handle_stats_question(update, query)
-        return
-    
-    # التحقق إذا كان البحث برقم السجل
-    record_id = extract_record_id(query)
-    if record_id:
-        await update.message.reply_text(f"🔍 جاري البحث عن سجل رقم: **{record_id}**...", parse_mode='Markdown')
-        results = search_by_record_id(record_id)
-        
-        if results:
-            response = f"✅ تم العثور على **{len(results)}** سجل:\n\n"
-            for book in results[:5]:
-                response += format_full_book_info(book)
-            await update.message.reply_text(response, parse_mode='Markdown')
-        else:
-            await update.message.reply_text(f"😔 لم أجد سجل برقم: {record_id}\n\n💡 تأكد من صحة الرقم أو جرب البحث بالعنوان")
-        return
-    
-    # البحث المرن في جميع الحقول
-    await update.message.reply_text(f"🔍 جاري البحث عن: **{query}**...", parse_mode='Markdown')
-    
-    results = flexible_search(query, limit=10)
-    
-    if not results:
-        # محاولة بحث أكثر مرونة
-        words = query.split()
-        if len(words) > 1:
-            # جرب البحث بكل كلمة على حدة
-            for word in words:
-                if len(word) > 2:
-                    results = flexible_search(word, limit=10)
-                    if results:
-                        break
-    
-    if not results:
-        suggestions = """😔 لم أجد نتائج مطابقة.
+# رد البحث بدون نتائج
+NO_RESULTS_TIPS = """😔 لم أجد نتائج مطابقة.
 
 💡 **نصائح للبحث:**
 • جرب كلمة واحدة بدلاً من جملة
@@ -528,41 +594,76 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 • الفقه
 • التفسير
 • رقم السجل 511"""
-        await update.message.reply_text(suggestions)
+
+@message_gate.debounced
+@track_handler
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, query: str):
+    """معالجة الرسائل النصية العادية (الرسائل المتتابعة السريعة تصل مدمجة في نص واحد)"""
+    if len(query) < 2:
+        await update.message.reply_text("❌ الرجاء كتابة كلمة بحث أطول")
         return
     
-    # عرض النتائج
-    response = f"✅ وجدت **{len(results)}** نتيجة:\n\n"
-    
-    for book in results:
-        response += format_result(book)
-        
-        if len(response) > 3500:
-            await update.message.reply_text(response, parse_mode='Markdown')
-            response = ""
-    
-    if response:
-        await update.message.reply_text(response, parse_mode='Markdown')
-
-async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """معالجة الأخطاء"""
-    logger.error(f"حدث خطأ: {context.error}")
+    # تحليل السؤال مرة واحدة: النية (إحصائيات، رقم سجل، بحث) وحقول البحث بعد حذف كلمات الحشو
+    parsed = parse_query(query)
     
-    if update and update.message:
-        await update.message.reply_text("😔 عذراً، حدث خطأ. الرجاء المحاولة مرة أخرى.")
-
-def main():
-    """تشغيل البوت"""
-    # التوكن من المتغيرات البيئية (آمن للرفع على GitHub)
-    TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+    if parsed.intent == 'stats':
+        await handle_stats_question(update, query)
+        return
     
-    if not TOKEN:
-        print("❌ خطأ: لم يتم تعيين TELEGRAM_BOT_TOKEN")
-        print("قم بتعيين المتغير البيئي أو أضف التوكن في Railway")
+    if parsed.intent == 'record':
+        await show_records(update, parsed.record_id)
         return
     
-    # إنشاء التطبيق
-    application = Application.builder().token(TOKEN).build()
+    # رقم فقط: مطابقة تامة سريعة برقم السجل، وإذا لم يوجد نكمل بالبحث العادي
+    number = normalize_arabic(query)
+    if number.isdigit():
+        results = await run_db(search_by_record_id, number)
+        if results:
+            await update.message.reply_text(format_records(results), parse_mode='Markdown')
+            return
+    
+    # البحث المرن في جميع الحقول (النتيجة تحل مكان رسالة الانتظار)
+    async with PendingReply(update.message, f"🔍 جاري البحث عن: **{query}**...", parse_mode='Markdown') as reply:
+        # سؤال بحقول محددة: استعلام مفهرس واحد بالحقول، وإلا نص البحث بدون كلمات الحشو
+        if parsed.structured:
+            search_type = 'parsed'
+        else:
+            search_type = 'all'
+            query = parsed.text or query
+        
+        results, has_more = await run_db(search_database, query, search_type)
+        note = ''
+        
+        if not results:
+            # "هل تقصد": بحث واحد بالكلمات المصححة من القاموس قبل توسيع البحث
+            corrected = await run_db(suggest_correction, query, search_type)
+            if corrected:
+                results, has_more = await run_db(search_database, corrected, search_type)
+                if results:
+                    note = f"🔎 هل تقصد: **{corrected}**؟ هذه نتائجها:\n\n"
+                    query = corrected
+        
+        if not results and search_type == 'all' and len(query.split()) > 1:
+            # محاولة بحث أكثر مرونة: أي كلمة من كلمات البحث في استعلام واحد مرتب بالصلة
+            search_type = 'any'
+            results, has_more = await run_db(search_database, query, search_type)
+        
+        if not results:
+            EMPTY_RESULTS.inc(handler='handle_message')
+            await reply.send(NO_RESULTS_TIPS)
+            return
+        
+        # عرض الصفحة الأولى مع أزرار التنقل
+        await send_first_page(reply, query, search_type, results, has_more, note)
+
+def build_application():
+    """إنشاء التطبيق وتسجيل المعالجات (يُستدعى أيضاً داخل كل عملية عاملة)"""
+    # مهمة الخلفية: مراقبة استبدال ملف قاعدة البيانات دون إعادة تشغيل البوت
+    application = (
+        application_builder(TOKEN, background_tasks=(watch_for_reload,))
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .build()
+    )
     
     # إضافة المعالجات
     application.add_handler(CommandHandler("start", start))
@@ -573,6 +674,13 @@ def main():
     application.add_handler(CommandHandler("title", title_command))
     application.add_handler(CommandHandler("subject", subject_command))
     application.add_handler(CommandHandler("year", year_command))
+    application.add_handler(CommandHandler("id", id_command))
+    
+    # أزرار التنقل بين صفحات النتائج
+    application.add_handler(CallbackQueryHandler(page_callback, pattern=r'^pg\|'))
+    
+    # الاستعلامات المضمنة (@bot نص البحث)
+    application.add_handler(InlineQueryHandler(inline_query))
     
     # معالج الرسائل النصية
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
@@ -580,9 +688,33 @@ def main():
     # معالج الأخطاء
     application.add_error_handler(error_handler)
     
+    return application
+
+def main():
+    """تشغيل البوت"""
+    if not TOKEN:
+        print("❌ خطأ: لم يتم تعيين TELEGRAM_BOT_TOKEN")
+        print("قم بتعيين المتغير البيئي أو أضف التوكن في Railway")
+        return
+    
+    # التحقق من ترحيل قاعدة البيانات
+    version = get_schema_version(get_connection())
+    if version != SCHEMA_VERSION:
+        print(f"❌ خطأ: إصدار قاعدة البيانات {version} والمطلوب {SCHEMA_VERSION}")
+        print("قم بتشغيل: python migrate_db.py")
+        return
+    
+    # حساب لقطة الإحصائيات وقاموس التصحيح مرة واحدة عند التشغيل
+    get_detailed_stats()
+    get_spelling_index(get_cursor())
+    
     # تشغيل البوت
     print("🤖 البوت يعمل الآن...")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    # Webhook إذا عُيّن WEBHOOK_URL (مع عمليات عاملة إذا عُيّن BOT_WORKERS)، وإلا الاستطلاع
+    run_bot(build_application)
+    
+    # إغلاق اتصالات قاعدة البيانات
+    close_all()
 
 if __name__ == '__main__':
     main()
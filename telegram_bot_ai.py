@@ -5,12 +5,26 @@
 يستخدم Claude API للإجابة الذكية على الأسئلة
 """
 
-import sqlite3
 import logging
-import json
 import os
+import time
+import asyncio
 from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
+from telegram.ext import CommandHandler, MessageHandler, filters, ContextTypes
+
+from semantic_index import hybrid_search, get_semantic_index
+from query_parser import parse_query, search_parsed_page
+from library_db import get_connection, get_cursor, close_all, run_db, watch_for_reload
+from migrate_db import SCHEMA_VERSION, get_schema_version
+from library_stats import get_stats_snapshot
+from result_cache import cached_search
+from bot_runner import application_builder, run_bot, error_handler
+from rate_limit import message_gate
+from send_queue import PendingReply
+from ai_cache import answer_cache
+from ai_prompt import build_messages
+from circuit_breaker import ai_breaker
+from metrics import Counter, STAGE_SECONDS, track_handler, timed, EMPTY_RESULTS
 
 # إعداد السجلات
 logging.basicConfig(
@@ -20,24 +34,37 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # إعدادات
-DB_PATH = 'library.db'
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 ANTHROPIC_API_KEY = os.getenv("ANTHROPIC_API_KEY", "")  # اختياري - للنسخة الذكية
 
+# حدود التزامن: التحديثات المعالجة بالتوازي، وطلبات الذكاء الاصطناعي المتزامنة ومهلتها بالثواني
+# (مهلة الطلب تبدأ بعد الحصول على دوره، ولانتظار الدور مهلة خاصة به)
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "32"))
+AI_MAX_CONCURRENCY = int(os.getenv("AI_MAX_CONCURRENCY", "4"))
+AI_TIMEOUT = float(os.getenv("AI_TIMEOUT", "30"))
+AI_QUEUE_TIMEOUT = float(os.getenv("AI_QUEUE_TIMEOUT", "30"))
+# مدة انتظار بداية الإجابة الذكية قبل عرض نتائج البحث (والإجابة تحل محلها عند اكتمالها)
+AI_RESULTS_AFTER = float(os.getenv("AI_RESULTS_AFTER", "2"))
+# إعادة المحاولة داخل مكتبة anthropic (قاطع الدائرة يتولى الأعطال المتكررة)
+AI_MAX_RETRIES = int(os.getenv("AI_MAX_RETRIES", "0"))
+AI_MODEL = os.getenv("AI_MODEL", "claude-sonnet-4-20250514")
+AI_MAX_TOKENS = int(os.getenv("AI_MAX_TOKENS", "1024"))
+
+_ai_client = None
+_ai_semaphore = asyncio.Semaphore(AI_MAX_CONCURRENCY)
+
+# الحقول المرسلة كسياق للذكاء الاصطناعي
+CONTEXT_FIELDS = ('record_id', 'title', 'author', 'publisher', 'year', 'classification', 'subject', 'pages')
+
+# نتائج طلبات الذكاء الاصطناعي: ok، empty، error، timeout (توقف البث)، skipped (الدائرة مفتوحة)، busy (انتظار الدور)
+AI_REQUESTS = Counter('bot_ai_requests_total', "طلبات الذكاء الاصطناعي حسب النتيجة", ('result',))
+
+@cached_search
 def get_relevant_books(query, limit=15):
-    """البحث في قاعدة البيانات"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+    """البحث في قاعدة البيانات (بالكلمات وبالمعنى معاً)"""
+    cursor = get_cursor()
     
-    cursor.execute("""
-        SELECT record_id, title, author, publisher, year, classification, subject, pages
-        FROM books 
-        WHERE FULLTEXT_SEARCH LIKE ? 
-        LIMIT ?
-    """, (f'%{query}%', limit))
-    
-    results = cursor.fetchall()
-    conn.close()
+    results = hybrid_search(cursor, query, CONTEXT_FIELDS, limit=limit)
     
     # تحويل النتائج إلى قاموس
     books = []
@@ -55,88 +82,122 @@ def get_relevant_books(query, limit=15):
     
     return books
 
-def get_stats():
-    """الحصول على إحصائيات المكتبة"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+@cached_search
+def get_structured_books(query, limit=15):
+    """كتب السؤال المحلل إلى حقول (رقم السجل، أو المؤلف والموضوع والسنة) باستعلام مفهرس واحد"""
+    cursor = get_cursor()
+    parsed = parse_query(query)
     
-    cursor.execute("SELECT COUNT(*) FROM books")
-    total = cursor.fetchone()[0]
-    
-    cursor.execute("SELECT COUNT(DISTINCT author) FROM books WHERE author != 'nan'")
-    authors = cursor.fetchone()[0]
+    if parsed.record_id:
+        cursor.execute(f"SELECT {', '.join(CONTEXT_FIELDS)} FROM books WHERE record_id = ? LIMIT ?", (parsed.record_id, limit))
+        rows = cursor.fetchall()
+    else:
+        rows, _ = search_parsed_page(cursor, parsed, CONTEXT_FIELDS, limit=limit)
     
-    cursor.execute("""
-        SELECT subject, COUNT(*) as count 
-        FROM books 
-        WHERE subject != 'nan' 
-        GROUP BY subject 
-        ORDER BY count DESC 
-        LIMIT 5
-    """)
-    top_subjects = cursor.fetchall()
+    return [dict(zip(CONTEXT_FIELDS, row)) for row in rows]
+
+def get_stats():
+    """الحصول على إحصائيات المكتبة (من اللقطة المحفوظة، تُحدث فقط عند تغير الكتب)"""
+    return get_stats_snapshot(get_cursor())
+
+def get_ai_client():
+    """عميل Claude غير المتزامن (يُنشأ مرة واحدة)"""
+    global _ai_client
     
-    conn.close()
+    if _ai_client is None:
+        import anthropic
+        _ai_client = anthropic.AsyncAnthropic(api_key=ANTHROPIC_API_KEY, timeout=AI_TIMEOUT, max_retries=AI_MAX_RETRIES)
     
-    return {
-        'total_books': total,
-        'total_authors': authors,
-        'top_subjects': top_subjects
-    }
+    return _ai_client
+
+async def answer_with_ai(query, books_context, on_text=None):
+    """
+    الإجابة الذكية مع الذاكرة الدائمة: السؤال نفسه بنفس الكتب لا يُرسل لـ Claude مرة أخرى
+    والأسئلة المتطابقة المتزامنة تنتظر طلباً واحداً
+    on_text: دالة عادية تستقبل كل جزء جديد من الإجابة أثناء وصوله (لطالب الإجابة الأول فقط)
+    """
+    key = answer_cache.make_key(query, [book['record_id'] for book in books_context])
+    return await answer_cache.get_or_compute(key, lambda: request_ai_answer(query, books_context, on_text))
 
-def answer_with_ai(query, books_context):
+async def request_ai_answer(query, books_context, on_text=None):
     """
-    استخدام Claude API للإجابة الذكية
+    استخدام Claude API للإجابة الذكية (الإجابة تصل تدريجياً)
     هذه الوظيفة تتطلب Anthropic API Key
+    لا يُرسل الطلب إذا كان قاطع الدائرة مفتوحاً، ويُسجل فيه فقط ما يخص الخدمة نفسها:
+    أخطاء API وتوقف البث (المهلة تبدأ بعد الحصول على الدور، فلا يُحسب انتظاره)
+    الأخطاء المحلية (أخطاء برمجية) لا تُخفى: تصل إلى معالج الأخطاء
     """
+    if not ai_breaker.allow():
+        AI_REQUESTS.inc(result='skipped')
+        return None
+    
+    latency = None
+    recorded = False
     try:
         import anthropic
+        client = get_ai_client()
         
-        client = anthropic.Anthropic(api_key=ANTHROPIC_API_KEY)
+        # التعليمات الثابتة في system، والسؤال مع قائمة الكتب المختصرة في رسالة المستخدم
+        with STAGE_SECONDS.time(stage='format', operation='build_messages'):
+            system, messages = build_messages(query, books_context)
         
-        # بناء السياق
-        context = "قاعدة بيانات المكتبة:\n\n"
-        for book in books_context:
-            context += f"- {book['title']}"
-            if book['author'] != 'nan':
-                context += f" | المؤلف: {book['author']}"
-            if book['subject'] != 'nan':
-                context += f" | الموضوع: {book['subject']}"
-            context += "\n"
+        # إرسال الطلب لـ Claude (بحد أقصى لعدد الطلبات المتزامنة)
+        parts = []
+        try:
+            with STAGE_SECONDS.time(stage='ai_wait', operation='semaphore'):
+                async with asyncio.timeout(AI_QUEUE_TIMEOUT):
+                    await _ai_semaphore.acquire()
+        except TimeoutError:
+            AI_REQUESTS.inc(result='busy')
+            logger.warning("طلبات الذكاء الاصطناعي مشغولة، تم الاكتفاء بنتائج البحث")
+            return None
+        try:
+            started = time.monotonic()
+            async with asyncio.timeout(AI_TIMEOUT), client.messages.stream(
+                model=AI_MODEL,
+                max_tokens=AI_MAX_TOKENS,
+                system=system,
+                messages=messages,
+            ) as stream:
+                async for text in stream.text_stream:
+                    if latency is None:
+                        latency = time.monotonic() - started
+                        STAGE_SECONDS.observe(latency, stage='ai', operation='first_token')
+                    # حلقة البث لا تنتظر تليجرام: تعديل الرسالة في مهمة منفصلة خارج حد التزامن
+                    parts.append(text)
+                    if on_text is not None:
+                        on_text(text)
+            STAGE_SECONDS.observe(time.monotonic() - started, stage='ai', operation='complete')
+        finally:
+            _ai_semaphore.release()
         
-        # إرسال الطلب لـ Claude
-        message = client.messages.create(
-            model="claude-sonnet-4-20250514",
-            max_tokens=1024,
-            messages=[
-                {
-                    "role": "user",
-                    "content": f"""أنت مساعد مكتبة ذكي. لديك قاعدة بيانات بـ 3,931 كتاب إسلامي.
-
-السؤال: {query}
-
-الكتب المتاحة في قاعدة البيانات:
-{context}
-
-المطلوب:
-1. أجب على السؤال بناءً على الكتب المتوفرة فقط
-2. اذكر أسماء الكتب ذات الصلة
-3. كن مختصراً ومفيداً
-4. إذا لم تجد كتب مناسبة، اقترح كلمات بحث بديلة
-
-الجواب:"""
-                }
-            ]
-        )
-        
-        return message.content[0].text
+        answer = ''.join(parts) or None
+        recorded = True
+        ai_breaker.record(answer is not None, latency)
+        AI_REQUESTS.inc(result='ok' if answer is not None else 'empty')
+        return answer
     
     except ImportError:
         return None
-    except Exception as e:
+    except TimeoutError:
+        # توقف البث أو بطؤه بعد إرسال الطلب
+        recorded = True
+        ai_breaker.record(False)
+        AI_REQUESTS.inc(result='timeout')
+        logger.warning("تجاوزت الإجابة الذكية المهلة، تم الاكتفاء بنتائج البحث")
+        return None
+    except anthropic.APIError as e:
+        recorded = True
+        ai_breaker.record(False)
+        AI_REQUESTS.inc(result='error')
         logger.error(f"خطأ في AI: {e}")
         return None
+    finally:
+        # أي نهاية بدون نتيجة من الخدمة (إلغاء، خطأ محلي...) تحرر طلب التجربة
+        if not recorded:
+            ai_breaker.release()
 
+@timed('format')
 def format_simple_results(books):
     """تنسيق النتائج البسيطة (بدون AI)"""
     if not books:
@@ -147,10 +208,10 @@ def format_simple_results(books):
     for i, book in enumerate(books[:10], 1):
         response += f"{i}. 📖 **{book['title']}**\n"
         
-        if book['author'] and book['author'] != 'nan':
+        if book['author']:
             response += f"   ✍️ {book['author']}\n"
         
-        if book['year'] and book['year'] != 'nan':
+        if book['year']:
             response += f"   📅 {book['year']}\n"
         
         response += "\n"
@@ -158,6 +219,7 @@ def format_simple_results(books):
     return response
 
 # أوامر البوت
+@track_handler
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """رسالة الترحيب"""
     welcome = """
@@ -185,10 +247,9 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await update.message.reply_text(welcome, parse_mode='Markdown')
 
-async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """عرض الإحصائيات"""
-    stats = get_stats()
-    
+@timed('format')
+def format_stats(stats):
+    """نص الإحصائيات"""
     text = f"""
 📊 **إحصائيات المكتبة:**
 
@@ -199,41 +260,111 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 """
     
     for i, (subject, count) in enumerate(stats['top_subjects'], 1):
-        if subject and subject != 'nan':
+        if subject:
             text += f"{i}. {subject[:50]} ({count} كتاب)\n"
     
-    await update.message.reply_text(text, parse_mode='Markdown')
+    return text
 
-async def handle_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """معالجة الأسئلة"""
-    query = update.message.text.strip()
-    
+@track_handler
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """عرض الإحصائيات"""
+    stats = await run_db(get_stats)
+    await update.message.reply_text(format_stats(stats), parse_mode='Markdown')
+
+async def answer_query(update: Update, query: str):
+    """البحث والإجابة على سؤال"""
     if len(query) < 3:
         await update.message.reply_text("❌ الرجاء كتابة سؤال أطول (3 أحرف على الأقل)")
         return
     
-    # إرسال رسالة الانتظار
-    wait_msg = await update.message.reply_text("🔍 جاري البحث...")
+    # تحليل السؤال: أسئلة الإحصائيات والحقول المحددة يُجاب عنها من الفهرس مباشرة بدون AI
+    parsed = parse_query(query)
     
-    # البحث في قاعدة البيانات
-    books = get_relevant_books(query, limit=15)
-    
-    # محاولة استخدام AI
-    ai_response = answer_with_ai(query, books)
-    
-    if ai_response:
-        # إجابة ذكية بالـ AI
-        response = f"🧠 **إجابة ذكية:**\n\n{ai_response}"
-    else:
-        # إجابة بسيطة بدون AI
-        response = format_simple_results(books)
-    
-    # حذف رسالة الانتظار
-    await wait_msg.delete()
+    if parsed.intent == 'stats':
+        stats = await run_db(get_stats)
+        await update.message.reply_text(format_stats(stats), parse_mode='Markdown')
+        return
     
-    # إرسال الإجابة
-    await update.message.reply_text(response, parse_mode='Markdown')
+    # رسالة الانتظار تُرسل فقط إذا تأخرت الإجابة، ثم تُعدّل بالإجابة بدلاً من حذفها وإرسال رسالة جديدة
+    async with PendingReply(update.message, "🔍 جاري البحث...") as reply:
+        if parsed.intent == 'record' or parsed.structured:
+            books = await run_db(get_structured_books, query)
+            if not books:
+                EMPTY_RESULTS.inc(handler='answer_query')
+            await reply.send(format_simple_results(books), parse_mode='Markdown')
+            return
+        
+        # البحث في قاعدة البيانات (بنص السؤال بدون كلمات الحشو)
+        books = await run_db(get_relevant_books, parsed.text or query, limit=15)
+        if not books:
+            EMPTY_RESULTS.inc(handler='answer_query')
+        
+        simple_results = format_simple_results(books)
+        results_shown = False
+        started = asyncio.Event()
+        changed = asyncio.Event()
+        finished = asyncio.Event()
+        partial = []
+        
+        # محاولة استخدام AI: الإجابة تظهر في الرسالة أثناء كتابتها (نص عادي حتى اكتمالها)
+        def add_partial(text):
+            partial.append(text)
+            started.set()
+            changed.set()
+        
+        async def show_partial():
+            """تعديل الرسالة بآخر نص وصل، مرة كل فترة تعديل على الأكثر، حتى اكتمال الإجابة"""
+            while True:
+                await changed.wait()
+                changed.clear()
+                if finished.is_set():
+                    return
+                if not results_shown:
+                    await reply.update(f"🧠 إجابة ذكية:\n\n{''.join(partial)} ▌")
+                try:
+                    await asyncio.wait_for(finished.wait(), reply.edit_interval)
+                    return
+                except asyncio.TimeoutError:
+                    pass
+        
+        # سباق بين الإجابة الذكية ونتائج البحث الجاهزة: إذا لم تبدأ الإجابة خلال AI_RESULTS_AFTER
+        # تُعرض النتائج فوراً، ثم تحل الإجابة محلها إذا اكتملت خلال AI_TIMEOUT
+        ai_task = asyncio.create_task(answer_with_ai(query, books, on_text=add_partial))
+        progress_task = asyncio.create_task(show_partial())
+        started_task = asyncio.create_task(started.wait())
+        await asyncio.wait({ai_task, started_task}, timeout=AI_RESULTS_AFTER, return_when=asyncio.FIRST_COMPLETED)
+        started_task.cancel()
+        
+        if not ai_task.done() and not started.is_set():
+            results_shown = True
+            await reply.update(simple_results, parse_mode='Markdown')
+        
+        try:
+            # المهلة داخل طلب الذكاء الاصطناعي نفسه (تبدأ بعد الحصول على دوره)
+            ai_response = await ai_task
+        finally:
+            # آخر تعديل جارٍ يكتمل قبل الإرسال النهائي (فلا تُرسل رسالتان)
+            finished.set()
+            changed.set()
+            await progress_task
+        
+        if ai_response:
+            # إجابة ذكية بالـ AI
+            response = f"🧠 **إجابة ذكية:**\n\n{ai_response}"
+        else:
+            # إجابة بسيطة بدون AI
+            response = simple_results
+        
+        # إرسال الإجابة
+        await reply.send(response, parse_mode='Markdown')
+
+@message_gate.debounced
+@track_handler
+async def handle_query(update: Update, context: ContextTypes.DEFAULT_TYPE, query: str):
+    """معالجة الأسئلة (الرسائل المتتابعة السريعة تصل مدمجة في سؤال واحد)"""
+    await answer_query(update, query)
 
+@track_handler
 async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """أمر البحث"""
     if not context.args:
@@ -242,10 +373,10 @@ async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     query = ' '.join(context.args)
     
-    # تحديث النص ليبدو كأنه سؤال عادي
-    update.message.text = query
-    await handle_query(update, context)
+    if await message_gate.allow(update):
+        await answer_query(update, query)
 
+@track_handler
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """المساعدة"""
     help_text = """
@@ -273,17 +404,14 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await update.message.reply_text(help_text, parse_mode='Markdown')
 
-async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """معالجة الأخطاء"""
-    logger.error(f"خطأ: {context.error}")
-    
-    if update and update.message:
-        await update.message.reply_text("😔 عذراً، حدث خطأ. الرجاء المحاولة مرة أخرى.")
-
-def main():
-    """تشغيل البوت"""
-    # إنشاء التطبيق
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+def build_application():
+    """إنشاء التطبيق وتسجيل المعالجات (يُستدعى أيضاً داخل كل عملية عاملة)"""
+    # مهمة الخلفية: مراقبة استبدال ملف قاعدة البيانات دون إعادة تشغيل البوت
+    application = (
+        application_builder(TELEGRAM_TOKEN, background_tasks=(watch_for_reload,))
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .build()
+    )
     
     # المعالجات
     application.add_handler(CommandHandler("start", start))
@@ -297,10 +425,33 @@ def main():
     # معالج الأخطاء
     application.add_error_handler(error_handler)
     
+    return application
+
+def main():
+    """تشغيل البوت"""
+    # التحقق من ترحيل قاعدة البيانات
+    version = get_schema_version(get_connection())
+    if version != SCHEMA_VERSION:
+        print(f"❌ خطأ: إصدار قاعدة البيانات {version} والمطلوب {SCHEMA_VERSION}")
+        print("قم بتشغيل: python migrate_db.py")
+        return
+    
+    # حساب لقطة الإحصائيات مرة واحدة عند التشغيل
+    get_stats()
+    
+    # تحميل الفهرس الدلالي إن وُجد (وإلا فالبحث بالكلمات فقط)
+    if get_semantic_index() is None:
+        print("ℹ️ الفهرس الدلالي غير متوفر، لبنائه: python semantic_index.py")
+    
     # تشغيل البوت
     print("🤖 البوت الذكي يعمل الآن...")
     print("🧠 مدعوم بالذكاء الاصطناعي!")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    # Webhook إذا عُيّن WEBHOOK_URL (مع عمليات عاملة إذا عُيّن BOT_WORKERS)، وإلا الاستطلاع
+    run_bot(build_application)
+    
+    # إغلاق اتصالات قاعدة البيانات
+    answer_cache.close()
+    close_all()
 
 if __name__ == '__main__':
     main()
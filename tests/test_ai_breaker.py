@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+مهلة طلب Claude وقاطع الدائرة مقابل خادم Anthropic وهمي محلي (ANTHROPIC_BASE_URL)
+- انتظار الدور له مهلته الخاصة ولا يُحسب على الخدمة
+- توقف البث بعد المهلة يُحسب فشلاً
+- الدائرة تُفتح بعد الأخطاء، ثم تجرب طلباً واحداً بعد المهلة وتُغلق إذا نجح
+"""
+
+import os
+import json
+import asyncio
+import unittest
+
+from aiohttp import web
+
+import telegram_bot_ai
+from circuit_breaker import CircuitBreaker, CLOSED, OPEN, HALF_OPEN
+
+_WORDS = ['إجابة ', 'تجريبية ', 'من ', 'الخادم ', 'الوهمي']
+
+
+class FakeAnthropic:
+    """خادم Messages API وهمي يبث الإجابة على دفعات (أو يرد بخطأ، أو يتأخر قبل أول رد)"""
+
+    def __init__(self):
+        self.requests = 0
+        self.fail = False
+        self.first_byte_delay = 0.0
+        self.chunk_delay = 0.0
+        self.runner = None
+        self.url = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post('/v1/messages', self.messages)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f'http://127.0.0.1:{port}'
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    async def messages(self, request):
+        self.requests += 1
+        body = await request.json()
+        if self.fail:
+            return web.json_response({'type': 'error', 'error': {'type': 'api_error', 'message': 'boom'}}, status=500)
+
+        await asyncio.sleep(self.first_byte_delay)
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+
+        async def event(name, data):
+            await response.write(f"event: {name}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode())
+
+        message = {'id': 'msg', 'type': 'message', 'role': 'assistant', 'model': body['model'], 'content': [],
+                   'stop_reason': None, 'stop_sequence': None, 'usage': {'input_tokens': 1, 'output_tokens': 1}}
+        await event('message_start', {'type': 'message_start', 'message': message})
+        await event('content_block_start', {'type': 'content_block_start', 'index': 0,
+                                            'content_block': {'type': 'text', 'text': ''}})
+        for word in _WORDS:
+            await asyncio.sleep(self.chunk_delay)
+            await event('content_block_delta', {'type': 'content_block_delta', 'index': 0,
+                                                'delta': {'type': 'text_delta', 'text': word}})
+        await event('content_block_stop', {'type': 'content_block_stop', 'index': 0})
+        await event('message_delta', {'type': 'message_delta', 'delta': {'stop_reason': 'end_turn', 'stop_sequence': None},
+                                      'usage': {'output_tokens': len(_WORDS)}})
+        await event('message_stop', {'type': 'message_stop'})
+        await response.write_eof()
+        return response
+
+
+class AIBreakerTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.server = FakeAnthropic()
+        await self.server.start()
+
+        self.saved = {name: getattr(telegram_bot_ai, name) for name in (
+            'ANTHROPIC_API_KEY', 'AI_TIMEOUT', 'AI_QUEUE_TIMEOUT', 'ai_breaker', '_ai_semaphore', '_ai_client')}
+        self.saved_base_url = os.environ.get('ANTHROPIC_BASE_URL')
+
+        # العميل يُنشأ من جديد ويقرأ عنوان الخادم الوهمي من ANTHROPIC_BASE_URL
+        os.environ['ANTHROPIC_BASE_URL'] = self.server.url
+        telegram_bot_ai.ANTHROPIC_API_KEY = 'test'
+        telegram_bot_ai._ai_client = None
+        telegram_bot_ai._ai_semaphore = asyncio.Semaphore(1)
+        telegram_bot_ai.AI_TIMEOUT = 1.0
+        telegram_bot_ai.AI_QUEUE_TIMEOUT = 1.0
+        self.breaker = telegram_bot_ai.ai_breaker = CircuitBreaker(
+            window=10, window_seconds=60, min_calls=2, error_rate=0.5, latency_budget=5, cooldown=0.3,
+        )
+
+    async def asyncTearDown(self):
+        if telegram_bot_ai._ai_client is not None:
+            await telegram_bot_ai._ai_client.close()
+        for name, value in self.saved.items():
+            setattr(telegram_bot_ai, name, value)
+        if self.saved_base_url is None:
+            os.environ.pop('ANTHROPIC_BASE_URL', None)
+        else:
+            os.environ['ANTHROPIC_BASE_URL'] = self.saved_base_url
+        await self.server.stop()
+
+    def ask(self):
+        return telegram_bot_ai.request_ai_answer('كتب الفقه', [])
+
+    async def test_answer_streams_and_records_success(self):
+        self.assertEqual(await self.ask(), ''.join(_WORDS))
+        self.assertEqual(self.breaker.stats()[:2], (1, 0.0))
+
+    async def test_queue_timeout_is_not_counted(self):
+        telegram_bot_ai.AI_QUEUE_TIMEOUT = 0.2
+        await telegram_bot_ai._ai_semaphore.acquire()
+        try:
+            self.assertIsNone(await self.ask())
+        finally:
+            telegram_bot_ai._ai_semaphore.release()
+
+        self.assertEqual(self.server.requests, 0)
+        self.assertEqual(self.breaker.stats()[0], 0)
+
+    async def test_upstream_timeout_is_a_failure(self):
+        telegram_bot_ai.AI_TIMEOUT = 0.3
+        self.server.first_byte_delay = 1
+
+        self.assertIsNone(await self.ask())
+        self.assertEqual(self.breaker.stats()[:2], (1, 1.0))
+
+    async def test_semaphore_wait_does_not_count_toward_deadline(self):
+        # كل بث يستغرق نحو 0.5 ث، والثاني ينتظر دوره نحو 0.5 ث: المجموع أكبر من المهلة
+        telegram_bot_ai.AI_TIMEOUT = 0.8
+        self.server.chunk_delay = 0.1
+
+        answers = await asyncio.gather(self.ask(), self.ask())
+
+        self.assertEqual(answers, [''.join(_WORDS)] * 2)
+        self.assertEqual(self.breaker.stats()[:2], (2, 0.0))
+
+    async def test_breaker_opens_half_opens_and_closes(self):
+        self.server.fail = True
+        self.assertIsNone(await self.ask())
+        self.assertIsNone(await self.ask())
+        self.assertEqual(self.breaker.state, OPEN)
+
+        # الدائرة مفتوحة: لا يُرسل الطلب
+        self.assertIsNone(await self.ask())
+        self.assertEqual(self.server.requests, 2)
+
+        # بعد المهلة: طلب تجربة واحد، والطلبات الأخرى تُتخطى حتى نتيجته
+        await asyncio.sleep(self.breaker.cooldown)
+        self.server.fail = False
+        self.server.first_byte_delay = 0.2
+        probe = asyncio.create_task(self.ask())
+        await asyncio.sleep(0.05)
+        self.assertEqual(self.breaker.state, HALF_OPEN)
+        self.assertIsNone(await self.ask())
+
+        self.assertEqual(await probe, ''.join(_WORDS))
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.assertEqual(self.server.requests, 3)
+
+    async def test_cancelled_probe_is_released(self):
+        self.breaker.state = OPEN
+        self.server.first_byte_delay = 1
+
+        probe = asyncio.create_task(self.ask())
+        await asyncio.sleep(0.2)
+        probe.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await probe
+
+        # الإلغاء المحلي لا يُحسب، ويُسمح بطلب تجربة جديد
+        self.assertEqual(self.breaker.state, HALF_OPEN)
+        self.assertTrue(self.breaker.allow())
+
+
+if __name__ == '__main__':
+    unittest.main()
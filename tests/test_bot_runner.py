@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""
+خادم Webhook مقابل Bot API وهمي محلي (TELEGRAM_BASE_URL)
+- الطلب بدون الرمز السري يُرفض بـ 403، والجسم التالف بـ 400، والتحديث السليم يصل إلى المعالج
+- مع التوزيع على عمليات عاملة: تحديثات المحادثة الواحدة تصل إلى نفس العملية وبترتيب إرسالها
+"""
+
+import os
+import time
+import socket
+import asyncio
+import unittest
+
+import aiohttp
+from aiohttp import web
+from telegram.ext import MessageHandler, filters
+
+import metrics
+import bot_runner
+
+_TOKEN = '123:TEST'
+_SECRET = 'test-secret'
+
+
+def free_port():
+    """منفذ محلي غير مستخدم"""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def make_update(update_id, chat_id, text):
+    """تحديث رسالة نصية خام كما يرسله تليجرام"""
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id, 'date': 0, 'text': text,
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'test'},
+        },
+    }
+
+
+class FakeBotAPI:
+    """خادم Bot API وهمي: يرد على getMe وsetWebhook ويسجل الرسائل المرسلة"""
+
+    def __init__(self):
+        self.webhooks = []
+        self.sent = []
+        self.runner = None
+        self.url = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self.call)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f'http://127.0.0.1:{port}/bot'
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    async def call(self, request):
+        method = request.match_info['method']
+        params = dict(await request.post())
+
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Test', 'username': 'test_bot'}
+        elif method == 'setWebhook':
+            self.webhooks.append(params)
+            result = True
+        elif method == 'sendMessage':
+            chat_id = int(params['chat_id'])
+            self.sent.append((chat_id, params['text']))
+            result = {'message_id': len(self.sent), 'date': 0, 'text': params['text'],
+                      'chat': {'id': chat_id, 'type': 'private'}}
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+    async def wait_for_messages(self, count, timeout=30):
+        deadline = time.monotonic() + timeout
+        while len(self.sent) < count and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        return self.sent
+
+
+async def reply_with_pid(update, context):
+    """يرد برقم العملية ونص الرسالة (الرسائل الأولى أبطأ، فيظهر أي خلل في الترتيب)"""
+    await asyncio.sleep(0.02 * (5 - int(update.message.text) % 5))
+    await update.message.reply_text(f'{os.getpid()} {update.message.text}')
+
+
+def build_worker_application():
+    """تطبيق العملية العاملة (يُستدعى في كل عملية بعد spawn، فيقرأ الإعدادات من البيئة)"""
+    application = bot_runner.application_builder(_TOKEN).concurrent_updates(8).build()
+    application.add_handler(MessageHandler(filters.TEXT, reply_with_pid))
+    return application
+
+
+class WebhookTestCase(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.api = await self.start_api()
+        self.port = free_port()
+        self.saved = {name: getattr(bot_runner, name) for name in (
+            'TELEGRAM_BASE_URL', 'WEBHOOK_URL', 'WEBHOOK_LISTEN', 'WEBHOOK_PORT', 'WEBHOOK_SECRET')}
+        self.saved_metrics_port = metrics.METRICS_PORT
+
+        bot_runner.TELEGRAM_BASE_URL = self.api.url
+        bot_runner.WEBHOOK_URL = 'https://example.com'
+        bot_runner.WEBHOOK_LISTEN = '127.0.0.1'
+        bot_runner.WEBHOOK_PORT = self.port
+        bot_runner.WEBHOOK_SECRET = _SECRET
+        metrics.METRICS_PORT = 0
+
+        self.stop_event = asyncio.Event()
+        self.session = aiohttp.ClientSession()
+
+    async def asyncTearDown(self):
+        await self.session.close()
+        for name, value in self.saved.items():
+            setattr(bot_runner, name, value)
+        metrics.METRICS_PORT = self.saved_metrics_port
+        await self.api.stop()
+
+    async def start_api(self):
+        api = FakeBotAPI()
+        await api.start()
+        return api
+
+    async def post(self, data=None, secret=_SECRET, body=None, timeout=30):
+        """إرسال تحديث إلى خادم Webhook (مع الانتظار حتى يبدأ الاستماع)"""
+        headers = {'X-Telegram-Bot-Api-Secret-Token': secret} if secret else {}
+        url = f'http://127.0.0.1:{self.port}/{bot_runner.WEBHOOK_PATH}'
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                async with self.session.post(url, json=data, data=body, headers=headers) as response:
+                    return response.status
+            except aiohttp.ClientConnectorError:
+                if time.monotonic() > deadline:
+                    raise
+                await asyncio.sleep(0.05)
+
+
+class ServeWebhookTest(WebhookTestCase):
+
+    async def test_secret_body_and_delivery(self):
+        received = []
+
+        async def record(update, context):
+            received.append((update.effective_chat.id, update.message.text))
+
+        application = bot_runner.application_builder(_TOKEN).build()
+        application.add_handler(MessageHandler(filters.TEXT, record))
+        server = asyncio.create_task(
+            bot_runner.serve_webhook(application, bot_runner.registered_update_types(application), self.stop_event))
+        try:
+            self.assertEqual(await self.post(make_update(1, 7, 'نص'), secret=None), 403)
+            self.assertEqual(await self.post(make_update(2, 7, 'نص'), secret='wrong'), 403)
+            self.assertEqual(await self.post(body=b'{not json'), 400)
+            self.assertEqual(await self.post(make_update(3, 7, 'فقه')), 200)
+
+            deadline = time.monotonic() + 5
+            while not received and time.monotonic() < deadline:
+                await asyncio.sleep(0.02)
+        finally:
+            self.stop_event.set()
+            await asyncio.wait_for(server, 10)
+
+        self.assertEqual(received, [(7, 'فقه')])
+        self.assertEqual(self.api.webhooks[0]['url'], f'https://example.com/{bot_runner.WEBHOOK_PATH}')
+        self.assertEqual(self.api.webhooks[0]['secret_token'], _SECRET)
+        self.assertEqual(self.api.webhooks[0]['allowed_updates'], '["message"]')
+
+
+class ShardedWebhookTest(WebhookTestCase):
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        # العمليات العاملة تبدأ بـ spawn فتقرأ الإعدادات من البيئة لا من هذه العملية
+        self.environ = {'TELEGRAM_BASE_URL': self.api.url, 'METRICS_PORT': '0', 'SEND_CHAT_PER_MINUTE': '6000'}
+        self.saved_environ = {name: os.environ.get(name) for name in self.environ}
+        os.environ.update(self.environ)
+
+    async def asyncTearDown(self):
+        for name, value in self.saved_environ.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        await super().asyncTearDown()
+
+    async def test_chat_updates_reach_one_worker_in_order(self):
+        chats = [11, 12, 13]
+        per_chat = 5
+        workers = 2
+
+        server = asyncio.create_task(bot_runner.serve_sharded(build_worker_application, workers, self.stop_event))
+        try:
+            self.assertEqual(await self.post(body=b'{not json'), 400)
+            update_id = 0
+            for number in range(per_chat):
+                for chat_id in chats:
+                    update_id += 1
+                    self.assertEqual(await self.post(make_update(update_id, chat_id, str(number))), 200)
+
+            sent = await self.api.wait_for_messages(len(chats) * per_chat)
+        finally:
+            self.stop_event.set()
+            await asyncio.wait_for(server, 60)
+
+        self.assertEqual(len(sent), len(chats) * per_chat)
+        pids = {}
+        for chat_id in chats:
+            replies = [text.split() for chat, text in sent if chat == chat_id]
+            # كل رسائل المحادثة عالجتها عملية واحدة وبترتيب إرسالها
+            self.assertEqual(len({pid for pid, _ in replies}), 1)
+            self.assertEqual([number for _, number in replies], [str(n) for n in range(per_chat)])
+            pids[chat_id] = replies[0][0]
+
+        # المحادثات ذات نفس رقم العملية العاملة تشترك في عملية، والأخرى في عملية مختلفة
+        for chat_id in chats:
+            for other in chats:
+                same_shard = chat_id % workers == other % workers
+                self.assertEqual(pids[chat_id] == pids[other], same_shard)
+
+
+if __name__ == '__main__':
+    unittest.main()
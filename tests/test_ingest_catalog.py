@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+اختبار الاستيراد ذهاباً وإياباً: تصدير الفهرس ثم استيراده لا يغير شيئاً
+(مع أرقام سجلات مكررة بعناوين مختلفة، ونص كامل بمسافة زائدة كما في البيانات الحالية)
+"""
+
+import os
+import csv
+import sqlite3
+import tempfile
+import unittest
+
+from ingest_catalog import BOOK_FIELDS, ingest
+from migrate_db import migrate
+
+_BOOKS_SQL = """
+    CREATE TABLE books (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        record_id TEXT, title TEXT, author TEXT, publisher TEXT, year TEXT,
+        pages TEXT, classification TEXT, subject TEXT, isbn TEXT, FULLTEXT_SEARCH TEXT
+    )
+"""
+
+_BOOKS = [
+    # record_id, title, author, publisher, year, pages, classification, subject, isbn, FULLTEXT_SEARCH
+    ('511', 'تاريخ الادب العربي /', 'بيومي ، السباعي', 'مكتبة الأنجلو المصرية', '1400', '300', '810', 'الادب العربي', None,
+     'تاريخ الادب العربي / بيومي ، السباعي الادب العربي مكتبة الأنجلو المصرية'),
+    # النص الكامل بمسافة في آخره (الناشر فارغ)
+    ('18620', 'الظمأ !', 'الجفري ، عبدالله عبدالرحمن', None, None, None, None, 'القصص القصيرة العربية', None,
+     'الظمأ ! الجفري ، عبدالله عبدالرحمن القصص القصيرة العربية '),
+    # رقم سجل مكرر بعنوانين مختلفين
+    ('700', 'صحيح البخاري', 'البخاري', None, '1390', None, None, 'الحديث', None, 'صحيح البخاري البخاري الحديث'),
+    ('700', 'فتح الباري', 'ابن حجر', None, '1379', None, None, 'الحديث', None, 'فتح الباري ابن حجر الحديث'),
+]
+
+
+def marc_record(record_id, title):
+    """سجل MARC بسيط (رقم السجل 001 والعنوان 245)"""
+    fields = [(b'001', record_id.encode()), (b'245', b'10\x1fa' + title.encode())]
+    directory = b''
+    data = b''
+    for tag, value in fields:
+        value += b'\x1e'
+        directory += tag + b'%04d%05d' % (len(value), len(data))
+        data += value
+    directory += b'\x1e'
+    base_address = 24 + len(directory)
+    length = base_address + len(data) + 1
+    leader = b'%05dnam a22%05d   4500' % (length, base_address)
+    return leader + directory + data + b'\x1d'
+
+
+class IngestRoundTripTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.dir.name, 'library.db')
+        self.csv_path = os.path.join(self.dir.name, 'export.csv')
+
+        conn = sqlite3.connect(self.db_path)
+        conn.execute(_BOOKS_SQL)
+        conn.executemany(
+            f"INSERT INTO books ({', '.join(BOOK_FIELDS)}, FULLTEXT_SEARCH) VALUES ({', '.join('?' * 10)})", _BOOKS,
+        )
+        conn.commit()
+        conn.close()
+        migrate(self.db_path)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def query(self, sql, params=()):
+        conn = sqlite3.connect(self.db_path)
+        try:
+            return conn.execute(sql, params).fetchall()
+        finally:
+            conn.close()
+
+    def export(self, rows=None):
+        """تصدير جدول الكتب (أو صفوف معدلة) إلى CSV بأسماء حقول الاستيراد"""
+        if rows is None:
+            rows = self.query(f"SELECT {', '.join(BOOK_FIELDS)} FROM books ORDER BY id")
+        with open(self.csv_path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(BOOK_FIELDS)
+            writer.writerows([['' if value is None else value for value in row] for row in rows])
+
+    def catalog_version(self):
+        return self.query("SELECT version FROM catalog_version WHERE id = 1")[0][0]
+
+    def test_round_trip_changes_nothing(self):
+        before = self.query("SELECT * FROM books ORDER BY id")
+        version = self.catalog_version()
+
+        self.export()
+        counts = ingest(self.csv_path, self.db_path)
+
+        self.assertEqual(counts['unchanged'], len(_BOOKS))
+        self.assertEqual((counts['inserted'], counts['updated'], counts['conflicts']), (0, 0, 0))
+        self.assertEqual(self.query("SELECT * FROM books ORDER BY id"), before)
+        self.assertEqual(self.catalog_version(), version)
+
+    def test_round_trip_with_one_record_per_batch(self):
+        # نسخ رقم السجل المتتالية تبقى في دفعة واحدة
+        version = self.catalog_version()
+
+        self.export()
+        counts = ingest(self.csv_path, self.db_path, batch_size=1)
+
+        self.assertEqual(counts['unchanged'], len(_BOOKS))
+        self.assertEqual(self.catalog_version(), version)
+
+    def test_corrupt_marc_leader_is_skipped(self):
+        marc_path = os.path.join(self.dir.name, 'export.mrc')
+        with open(marc_path, 'wb') as f:
+            f.write(marc_record('9001', 'الكتاب الاول'))
+            f.write(b'x1y2z' + b'0' * 40 + b'\x1e\x1d')
+            f.write(marc_record('9002', 'الكتاب الثاني'))
+
+        counts = ingest(marc_path, self.db_path)
+
+        self.assertEqual((counts['inserted'], counts['malformed']), (2, 1))
+        titles = self.query("SELECT record_id, title FROM books WHERE record_id IN ('9001', '9002') ORDER BY record_id")
+        self.assertEqual(titles, [('9001', 'الكتاب الاول'), ('9002', 'الكتاب الثاني')])
+
+    def test_changed_duplicate_is_reported_not_written(self):
+        rows = self.query(f"SELECT {', '.join(BOOK_FIELDS)} FROM books ORDER BY id")
+        rows[3] = rows[3][:1] + ('فتح الباري شرح صحيح البخاري',) + rows[3][2:]
+        self.export(rows)
+
+        counts = ingest(self.csv_path, self.db_path)
+
+        self.assertEqual(counts['conflicts'], 1)
+        self.assertEqual(counts['updated'], 0)
+        titles = [row[0] for row in self.query("SELECT title FROM books WHERE record_id = '700' ORDER BY id")]
+        self.assertEqual(titles, ['صحيح البخاري', 'فتح الباري'])
+
+    def test_unique_record_is_updated_and_indexed(self):
+        rows = self.query(f"SELECT {', '.join(BOOK_FIELDS)} FROM books ORDER BY id")
+        rows[0] = rows[0][:1] + ('تاريخ الادب العربي الحديث',) + rows[0][2:]
+        self.export(rows)
+
+        counts = ingest(self.csv_path, self.db_path)
+
+        self.assertEqual((counts['updated'], counts['unchanged']), (1, len(_BOOKS) - 1))
+        found = self.query("SELECT b.record_id FROM books_fts JOIN books b ON b.id = books_fts.rowid "
+                           "WHERE books_fts MATCH 'title:حديث'")
+        self.assertEqual(found, [('511',)])
+
+
+if __name__ == '__main__':
+    unittest.main()
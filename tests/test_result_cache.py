@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+قياس زمن عمل قاعدة البيانات مع الذاكرة المؤقتة: الإصابة تُسجل في مرحلة cache،
+ومرحلة db لا تُسجل إلا عند تنفيذ الاستعلام فعلاً
+"""
+
+import unittest
+from unittest import mock
+
+import result_cache
+from library_db import run_db
+from metrics import STAGE_SECONDS
+from result_cache import ResultCache, PrefixCache
+
+
+def stage_count(stage, operation):
+    """عدد القياسات المسجلة لمرحلة وعملية"""
+    for suffix, key, _, value in STAGE_SECONDS.samples():
+        if suffix == '_count' and key == (stage, operation):
+            return value
+    return 0
+
+
+class CacheStageTest(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        # رقم إصدار ثابت للفهرس: لا حاجة لقاعدة بيانات حقيقية
+        patcher = mock.patch.multiple(result_cache, get_cursor=mock.DEFAULT, get_catalog_version=lambda cursor: 1)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.queries = []
+
+    async def test_result_cache_hit_is_not_a_db_query(self):
+        cache = ResultCache()
+
+        @cache.cached
+        def search_titles(query):
+            self.queries.append(query)
+            return [query]
+
+        operation = search_titles.__qualname__
+        self.assertEqual(await run_db(search_titles, 'فقه'), ['فقه'])
+        self.assertEqual(await run_db(search_titles, 'فقه'), ['فقه'])
+        self.assertEqual(await run_db(search_titles, 'فقه'), ['فقه'])
+
+        self.assertEqual(self.queries, ['فقه'])
+        self.assertEqual(stage_count('db', operation), 1)
+        self.assertEqual(stage_count('cache', operation), 2)
+        self.assertEqual(stage_count('db_wait', operation), 3)
+
+    async def test_prefix_cache_hit_is_not_a_db_query(self):
+        cache = PrefixCache()
+
+        def search_prefix(query):
+            rows = cache.lookup(query)
+            if rows is None:
+                self.queries.append(query)
+                rows = [('تاريخ الادب العربي',)]
+                cache.store(query, rows, lambda row: row)
+            return rows
+
+        operation = search_prefix.__qualname__
+        await run_db(search_prefix, 'تاريخ')
+        self.assertEqual(await run_db(search_prefix, 'تاريخ الادب'), [('تاريخ الادب العربي',)])
+
+        self.assertEqual(self.queries, ['تاريخ'])
+        self.assertEqual(stage_count('db', operation), 1)
+        self.assertEqual(stage_count('cache', operation), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+الفهرس الدلالي بعد تعديل الفهرس: يبقى مستخدماً، وتُستبعد منه الكتب التي تغيرت بعد بنائه فقط
+"""
+
+import os
+import sqlite3
+import tempfile
+import unittest
+
+import semantic_index
+from migrate_db import migrate
+
+_BOOKS = [
+    ('تاريخ الادب العربي', 'بيومي', 'الادب العربي'),
+    ('تاريخ الادب الاندلسي', 'عباس', 'الادب العربي'),
+    ('الادب العربي الحديث', 'هيكل', 'الادب العربي'),
+    ('صحيح البخاري', 'البخاري', 'الحديث'),
+    ('فتح الباري', 'ابن حجر', 'الحديث'),
+    ('تفسير القرآن العظيم', 'ابن كثير', 'التفسير'),
+]
+
+
+@unittest.skipIf(semantic_index.np is None, "numpy غير مثبتة")
+class StaleSemanticIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.dir.name, 'library.db')
+        self.index_path = os.path.join(self.dir.name, 'semantic_index')
+
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("""
+            CREATE TABLE books (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                record_id TEXT, title TEXT, author TEXT, publisher TEXT, year TEXT,
+                pages TEXT, classification TEXT, subject TEXT, isbn TEXT, FULLTEXT_SEARCH TEXT
+            )
+        """)
+        conn.executemany(
+            "INSERT INTO books (record_id, title, author, subject) VALUES (?, ?, ?, ?)",
+            [(str(i), *book) for i, book in enumerate(_BOOKS, 1)],
+        )
+        conn.commit()
+        conn.close()
+        migrate(self.db_path)
+
+        self.conn = sqlite3.connect(self.db_path)
+        semantic_index.build_semantic_index(self.conn, self.index_path, dims=4)
+        semantic_index.reset_semantic_index()
+        self.index = semantic_index.get_semantic_index(self.index_path)
+
+    def tearDown(self):
+        self.conn.close()
+        semantic_index.reset_semantic_index()
+        self.dir.cleanup()
+
+    def search(self, text):
+        """البحث الدلالي بالفهرس المؤقت (بدلاً من المجلد الافتراضي)"""
+        original = semantic_index.get_semantic_index
+        semantic_index.get_semantic_index = lambda: self.index
+        try:
+            return semantic_index.semantic_search(self.conn.cursor(), text, limit=3)
+        finally:
+            semantic_index.get_semantic_index = original
+
+    def test_stale_index_drops_only_changed_books(self):
+        before = self.search('تاريخ الادب')
+        self.assertGreaterEqual(len(before), 2)
+
+        self.conn.execute("UPDATE books SET title = 'كتاب آخر' WHERE id = ?", (before[0],))
+        self.conn.commit()
+
+        after = self.search('تاريخ الادب')
+        self.assertNotIn(before[0], after)
+        self.assertIn(before[1], after)
+
+    def test_unrelated_edit_keeps_results(self):
+        before = self.search('تاريخ الادب')
+
+        self.conn.execute("UPDATE books SET year = '1400' WHERE id = ?", (before[0],))
+        self.conn.commit()
+
+        self.assertEqual(self.search('تاريخ الادب'), before)
+
+
+if __name__ == '__main__':
+    unittest.main()